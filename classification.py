@@ -0,0 +1,210 @@
+#
+# File: classification.py
+# Purpose: Classify max values of integer columns against the thresholds
+#
+# Notes:
+#   - Percentages are compared with exact integer arithmetic, so values
+#     near the maximum of bigint are not rounded to 100%.
+#
+
+from fractions import Fraction
+
+try:
+    import numpy
+except ImportError:
+    # batches are classified without vectorization
+    numpy = None
+
+CRITICAL = 'critical'
+WARNING = 'warning'
+INVESTIGATE = 'investigate'
+
+# maximum value of each integer type, by (type, unsigned)
+LIMITS = {
+    ('tinyint', False): 2 ** 7 - 1,
+    ('smallint', False): 2 ** 15 - 1,
+    ('mediumint', False): 2 ** 23 - 1,
+    ('int', False): 2 ** 31 - 1,
+    ('bigint', False): 2 ** 63 - 1,
+    ('tinyint', True): 2 ** 8 - 1,
+    ('smallint', True): 2 ** 16 - 1,
+    ('mediumint', True): 2 ** 24 - 1,
+    ('int', True): 2 ** 32 - 1,
+    ('bigint', True): 2 ** 64 - 1,
+}
+
+# integer synonyms accepted in COLUMN_TYPE
+TYPE_ALIASES = {
+    'integer': 'int',
+}
+
+# numpy int64 products must stay below this
+NUMPY_MAX = 2 ** 62
+
+# batches smaller than this are not worth converting to numpy arrays
+NUMPY_MIN_BATCH = 1000
+
+_limit_cache = {}
+_thresholds_cache = {}
+
+
+def get_limit(column_type):
+    """Returns the maximum value of a COLUMN_TYPE, None if not an integer.
+
+    For example, 4294967295 for 'int(10) unsigned'.
+    """
+    limit = _limit_cache.get(column_type, -1)
+    if limit != -1:
+        return limit
+    words = column_type.lower().split()
+    int_type = words[0].split('(')[0] if words else ''
+    int_type = TYPE_ALIASES.get(int_type, int_type)
+    limit = LIMITS.get((int_type, 'unsigned' in words))
+    _limit_cache[column_type] = limit
+    return limit
+
+
+def to_fraction(value):
+    """Returns the exact decimal value of a threshold as a Fraction."""
+    if isinstance(value, float):
+        # the decimal the user wrote, not its binary approximation
+        return Fraction(repr(value))
+    return Fraction(value)
+
+
+class Thresholds(object):
+    """Thresholds of the check, as exact fractions of 100.
+
+    A column is critical or warning when its max value is over that
+    percentage of its type. It is only reported as such if the row count
+    is at least row_count_max_ratio percent of its type, otherwise it is
+    an investigate column when display_investigate is set.
+    """
+    def __init__(
+            self, critical, warning, row_count_max_ratio=0,
+            display_investigate=False):
+        self.critical = to_fraction(critical)
+        self.warning = to_fraction(warning)
+        self.row_count_max_ratio = to_fraction(row_count_max_ratio or 0)
+        self.display_investigate = bool(display_investigate)
+
+    @classmethod
+    def from_options(cls, merged_options):
+        """Returns the thresholds of the options of a check."""
+        key = (
+            merged_options['critical'],
+            merged_options['warning'],
+            merged_options.get('row_count_max_ratio'),
+            merged_options.get('display_row_count_max_ratio_columns'))
+        thresholds = _thresholds_cache.get(key)
+        if thresholds is None:
+            thresholds = _thresholds_cache[key] = cls(*key)
+        return thresholds
+
+
+def is_over(value, limit, threshold):
+    """Returns True if value is over threshold percent of limit."""
+    return (
+        value * 100 * threshold.denominator > threshold.numerator * limit)
+
+
+def classify(value, limit, row_count, thresholds):
+    """Returns the category of a column max value, None if not flagged."""
+    if is_over(value, limit, thresholds.critical):
+        category = CRITICAL
+    elif is_over(value, limit, thresholds.warning):
+        category = WARNING
+    else:
+        return None
+    ratio = thresholds.row_count_max_ratio
+    if (row_count or 0) * 100 * ratio.denominator >= ratio.numerator * limit:
+        return category
+    if thresholds.display_investigate:
+        return INVESTIGATE
+    return None
+
+
+def get_percentage(value, limit):
+    """Returns value as a percentage of limit, for display."""
+    return float(Fraction(value * 100, limit))
+
+
+def classify_batch(items, thresholds, use_numpy=None):
+    """Classifies (value, column_type, row_count) tuples.
+
+    Returns a list of (category, overflow_percentage, row_count_ratio) in
+    the order of items. category is None for columns which are not
+    flagged and for non-integer types, whose percentages are 0. Values of
+    None are 0. With use_numpy, or by default for large batches when
+    numpy is installed, types whose products fit in int64 are classified
+    with numpy arrays.
+    """
+    if use_numpy is None:
+        use_numpy = numpy is not None and len(items) >= NUMPY_MIN_BATCH
+
+    # indexes of items by limit, so that each limit is one vector
+    by_limit = {}
+    classified = [(None, 0, 0)] * len(items)
+    for i, (value, column_type, row_count) in enumerate(items):
+        limit = get_limit(column_type)
+        if limit is not None:
+            by_limit.setdefault(limit, []).append(i)
+
+    for limit, indexes in by_limit.items():
+        values = [int(items[i][0] or 0) for i in indexes]
+        row_counts = [int(items[i][2] or 0) for i in indexes]
+        if use_numpy and fits_numpy(limit, values, row_counts, thresholds):
+            categories = classify_numpy(values, limit, row_counts, thresholds)
+        else:
+            categories = [
+                classify(value, limit, row_count, thresholds)
+                for value, row_count in zip(values, row_counts)]
+        for i, value, row_count, category in zip(
+                indexes, values, row_counts, categories):
+            classified[i] = (
+                category,
+                get_percentage(value, limit),
+                get_percentage(row_count, limit))
+    return classified
+
+
+def fits_numpy(limit, values, row_counts, thresholds):
+    """Returns True if the products of classify() fit in int64."""
+    largest = max(
+        [limit, abs(min(values)), abs(max(values))] + row_counts)
+    scale = 100 * max(
+        thresholds.critical.denominator, thresholds.warning.denominator,
+        thresholds.row_count_max_ratio.denominator,
+        thresholds.critical.numerator, thresholds.warning.numerator,
+        thresholds.row_count_max_ratio.numerator, 1)
+    return largest * scale < NUMPY_MAX
+
+
+def classify_numpy(values, limit, row_counts, thresholds):
+    """classify() of many values of one limit with numpy arrays."""
+    values = numpy.array(values, dtype=numpy.int64) * 100
+    row_counts = numpy.array(row_counts, dtype=numpy.int64) * 100
+
+    def over(array, threshold, strict=True):
+        left = array * threshold.denominator
+        right = threshold.numerator * limit
+        if strict:
+            return left > right
+        return left >= right
+
+    critical = over(values, thresholds.critical)
+    warning = ~critical & over(values, thresholds.warning)
+    enough_rows = over(
+        row_counts, thresholds.row_count_max_ratio, strict=False)
+    low_rows = INVESTIGATE if thresholds.display_investigate else None
+
+    categories = []
+    for is_critical, is_warning, is_enough in zip(
+            critical.tolist(), warning.tolist(), enough_rows.tolist()):
+        if is_critical:
+            categories.append(CRITICAL if is_enough else low_rows)
+        elif is_warning:
+            categories.append(WARNING if is_enough else low_rows)
+        else:
+            categories.append(None)
+    return categories
@@ -0,0 +1,336 @@
+#
+# File: dump_scanner.py
+# Purpose: Find max values of integer columns in logical dumps
+#
+# Notes:
+#   - Reads mysqldump files and the directories written by
+#     mysqldump --tab (table.sql with table.txt, .tsv or .csv), optionally
+#     gzipped, one line at a time, so memory does not grow with the size
+#     of the dump.
+#   - Files are independent and can be scanned by a process pool.
+#
+
+import csv
+import gzip
+import logging
+import multiprocessing
+import os
+import re
+
+import classification
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+# data files of mysqldump --tab and SELECT ... INTO OUTFILE, by delimiter
+TSV_EXTENSIONS = ('.txt', '.tsv')
+CSV_EXTENSIONS = ('.csv',)
+
+NAME = r'`((?:[^`]|``)+)`'
+USE_RE = re.compile(r'^USE %s;' % (NAME,))
+CREATE_TABLE_RE = re.compile(
+    r'^CREATE TABLE (?:IF NOT EXISTS )?(?:%s\.)?%s \($' % (NAME, NAME))
+COLUMN_RE = re.compile(
+    r'^\s+%s\s+([a-z]+(?:\([^)]*\))?(?:\s+unsigned)?(?:\s+zerofill)?)' % (
+        NAME,), re.IGNORECASE)
+PRIMARY_KEY_RE = re.compile(r'^\s+PRIMARY KEY \((.*)\)')
+KEY_RE = re.compile(
+    r'^\s+(?:UNIQUE |FULLTEXT |SPATIAL )?KEY %s \((.*)\)' % (NAME,))
+INSERT_RE = re.compile(
+    r'^(?:INSERT|REPLACE)(?: IGNORE)? INTO %s(?: \(([^)]*)\))? VALUES ' % (
+        NAME,))
+NAMES_RE = re.compile(NAME)
+
+# a quoted string, a parenthesis or comma, or any other token
+VALUE_TOKEN_RE = re.compile(r"'(?:[^'\\]|\\.|'')*'|[(),]|[^'(),\s]+")
+
+
+def unquote(name):
+    return name.replace('``', '`')
+
+
+def open_file(filename):
+    """Opens a file for reading, gunzipping it if its name ends with .gz."""
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rb')
+    return open(filename, 'rb')
+
+
+def split_extension(filename):
+    """Returns the name of a file and its extension, ignoring .gz."""
+    name = os.path.basename(filename)
+    if name.endswith('.gz'):
+        name = name[:-3]
+    return os.path.splitext(name)
+
+
+def strip_extension(filename):
+    return split_extension(filename)[0]
+
+
+class Table(object):
+    """Definition and running max values of a table in a dump."""
+    def __init__(self, schema, table):
+        self.schema = schema
+        self.table = table
+        self.column_names = []
+        self.column_types = {}
+        self.primary_key = set()
+        self.leading_columns = set()
+        self.row_count = 0
+        self.max_values = {}
+
+    def add_column(self, name, column_type):
+        self.column_names.append(name)
+        if classification.get_limit(column_type) is not None:
+            self.column_types[name] = column_type
+
+    def get_int_indexes(self, column_names=None):
+        """Returns (index, name) of the integer columns of rows.
+
+        column_names is the column list of an INSERT, all columns of the
+        table if not set.
+        """
+        if column_names is None:
+            column_names = self.column_names
+        return [
+            (i, name) for i, name in enumerate(column_names)
+            if name in self.column_types]
+
+    def add_rows(self, rows, int_indexes):
+        """Updates the row count and max values with rows of fields.
+
+        Fields are strings, and None or NULL for NULL values.
+        """
+        max_values = self.max_values
+        row_count = 0
+        for row in rows:
+            row_count += 1
+            for i, name in int_indexes:
+                try:
+                    value = int(row[i])
+                except (IndexError, TypeError, ValueError):
+                    # NULL or not an integer literal
+                    continue
+                if name not in max_values or value > max_values[name]:
+                    max_values[name] = value
+        self.row_count += row_count
+
+    def get_result(self):
+        """Returns the integer columns of the table and their max values."""
+        return dict(
+            schema=self.schema,
+            table=self.table,
+            row_count=self.row_count,
+            columns=[
+                dict(
+                    column_name=name,
+                    column_type=self.column_types[name],
+                    column_key='PRI' if name in self.primary_key else '',
+                    index_leading=name in self.leading_columns,
+                    max_value=self.max_values.get(name))
+                for name in self.column_names
+                if name in self.column_types])
+
+
+def parse_create_table(lines, table):
+    """Reads the column and key definitions of a CREATE TABLE."""
+    for line in lines:
+        if line.startswith(')'):
+            break
+        m = COLUMN_RE.match(line)
+        if m:
+            table.add_column(unquote(m.group(1)), m.group(2))
+            continue
+        m = PRIMARY_KEY_RE.match(line)
+        if m:
+            names = [unquote(name) for name in NAMES_RE.findall(m.group(1))]
+            table.primary_key.update(names)
+            table.leading_columns.update(names[:1])
+            continue
+        m = KEY_RE.match(line)
+        if m:
+            names = NAMES_RE.findall(m.group(2))
+            if names:
+                table.leading_columns.add(unquote(names[0]))
+    return table
+
+
+def iter_values(values):
+    """Yields the fields of each row of the VALUES of an INSERT."""
+    row = None
+    field = None
+    for m in VALUE_TOKEN_RE.finditer(values):
+        token = m.group()
+        if row is None:
+            if token == '(':
+                row = []
+                field = None
+        elif token == ',':
+            row.append(field)
+            field = None
+        elif token == ')':
+            row.append(field)
+            yield row
+            row = None
+        elif field is None:
+            field = token
+        else:
+            field += token
+
+
+def scan_sql_file(filename, default_schema=None):
+    """Returns the tables of a mysqldump file with their max values.
+
+    The schema is taken from USE statements, and is default_schema or the
+    name of the file before the first one.
+    """
+    if default_schema is None:
+        default_schema = strip_extension(filename)
+    schema = default_schema
+    tables = {}
+    with open_file(filename) as lines:
+        for line in lines:
+            if line.startswith('USE '):
+                m = USE_RE.match(line)
+                if m:
+                    schema = unquote(m.group(1))
+            elif line.startswith('CREATE TABLE'):
+                m = CREATE_TABLE_RE.match(line)
+                if m:
+                    table = Table(
+                        unquote(m.group(1)) if m.group(1) else schema,
+                        unquote(m.group(2)))
+                    tables[(table.schema, table.table)] = parse_create_table(
+                        lines, table)
+            elif line.startswith('INSERT') or line.startswith('REPLACE'):
+                m = INSERT_RE.match(line)
+                if not m:
+                    continue
+                table = tables.get((schema, unquote(m.group(1))))
+                if table is None or not table.column_types:
+                    # no definition, or no integer columns
+                    continue
+                column_names = None
+                if m.group(2):
+                    column_names = [
+                        unquote(name) for name in NAMES_RE.findall(m.group(2))]
+                table.add_rows(
+                    iter_values(line[m.end():]),
+                    table.get_int_indexes(column_names))
+    return [t.get_result() for t in tables.itervalues()]
+
+
+def iter_tsv_rows(lines):
+    """Yields the fields of mysqldump --tab data lines.
+
+    Fields are separated by tabs, NULL is \\N and a newline in a value is
+    escaped with a backslash, which continues the row on the next line.
+    """
+    pending = ''
+    for line in lines:
+        line = pending + line.rstrip('\r\n')
+        backslashes = len(line) - len(line.rstrip('\\'))
+        if backslashes % 2:
+            pending = line + '\n'
+            continue
+        pending = ''
+        yield line.split('\t')
+    if pending:
+        yield pending.rstrip('\n').split('\t')
+
+
+def scan_tab_files(schema, sql_filename, data_filename):
+    """Returns a table of mysqldump --tab with its max values."""
+    table = Table(schema, strip_extension(sql_filename))
+    with open_file(sql_filename) as lines:
+        for line in lines:
+            m = CREATE_TABLE_RE.match(line)
+            if m:
+                parse_create_table(lines, table)
+                break
+    if table.column_types:
+        with open_file(data_filename) as lines:
+            if split_extension(data_filename)[1] in CSV_EXTENSIONS:
+                rows = csv.reader(lines, escapechar='\\')
+            else:
+                rows = iter_tsv_rows(lines)
+            table.add_rows(rows, table.get_int_indexes())
+    return [table.get_result()]
+
+
+def get_data_filename(sql_filename):
+    """Returns the data file of a mysqldump --tab table, None if none."""
+    base = sql_filename[:-len('.sql')]
+    for extension in TSV_EXTENSIONS + CSV_EXTENSIONS:
+        for filename in (base + extension, base + extension + '.gz'):
+            if os.path.exists(filename):
+                return filename
+    return None
+
+
+def get_scan_tasks(paths):
+    """Returns the files to scan as tuples of scan_task() arguments.
+
+    Each path is a mysqldump file or a directory. In a directory, each
+    table.sql with a data file is a table of mysqldump --tab, whose schema
+    is the name of the directory, and any other .sql file is a dump.
+    """
+    tasks = []
+    for path in paths:
+        if not os.path.isdir(path):
+            tasks.append(('sql', path))
+            continue
+        schema = os.path.basename(os.path.normpath(path))
+        for name in sorted(os.listdir(path)):
+            filename = os.path.join(path, name)
+            if name.endswith('.sql'):
+                data_filename = get_data_filename(filename)
+                if data_filename:
+                    tasks.append(('tab', schema, filename, data_filename))
+                else:
+                    tasks.append(('sql', filename))
+            elif name.endswith('.sql.gz'):
+                tasks.append(('sql', filename))
+            elif split_extension(name)[1] in TSV_EXTENSIONS + CSV_EXTENSIONS:
+                sql_filename = os.path.join(
+                    path, strip_extension(name) + '.sql')
+                if not os.path.exists(sql_filename):
+                    log.warning(
+                        'Skipped %s, no %s with its column types.' % (
+                            filename, sql_filename))
+    return tasks
+
+
+def scan_task(task):
+    """Returns the tables of one task of get_scan_tasks()."""
+    if task[0] == 'tab':
+        return scan_tab_files(*task[1:])
+    return scan_sql_file(*task[1:])
+
+
+def scan_paths(paths, processes=1):
+    """Yields the tables of dump files and directories with max values.
+
+    Each table is a dict of schema, table, row_count and its integer
+    columns, with column_name, column_type, column_key, index_leading and
+    max_value, None for a table without rows. With processes over 1,
+    files are scanned by a process pool.
+    """
+    tasks = get_scan_tasks(paths)
+    if processes > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(min(processes, len(tasks)))
+        try:
+            for tables in pool.imap_unordered(scan_task, tasks):
+                for table in tables:
+                    yield table
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    else:
+        for task in tasks:
+            for table in scan_task(task):
+                yield table
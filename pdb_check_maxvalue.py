@@ -9,23 +9,50 @@
 #   - This is a translation of https://github.com/palominodb/palominodb-priv/tree/master/tools/mysql/int-overflow-check
 #
 
+import BaseHTTPServer
+import json
 import logging
+import os
 import pprint
 import Queue
+import socket
+import SocketServer
+import sqlite3
+import sys
 import threading
 import time
+import urllib2
+import uuid
 
 import MySQLdb
+import MySQLdb.cursors
 import datetime
+import hashlib
+import heapq
+import itertools
 import pynagios
 from pynagios import Plugin, Response, make_option
 import yaml
 
+import classification
+import dump_scanner
+
 try:
     from logging import NullHandler
 except ImportError:
     from logutils import NullHandler
 
+try:
+    import gevent
+    import gevent.lock
+    import gevent.monkey
+    import gevent.pool
+    import gevent.queue
+    import pymysql
+except ImportError:
+    # the async engine is not available
+    gevent = None
+
 # use this in all your library's subpackages/submodules
 log = logging.getLogger(__name__)
 log.setLevel(logging.DEBUG)
@@ -35,11 +62,52 @@ log.addHandler(NullHandler())
 
 pp = pprint.pprint
 
+# max number of results waiting for the main thread, workers block
+# when the main thread falls behind
+RESULTS_QUEUE_SIZE = 10000
+
+# seconds to wait for the workers to stop after the deadline
+DEADLINE_GRACE = 5
+
+# seconds to wait for the connection which kills expired queries
+KILL_CONNECT_TIMEOUT = 5
+
+# estimated cost of MAX() of a column which leads an index, in bytes read
+INDEX_LOOKUP_COST = 16384
+
+# number of tables whose partitions are read by each query
+PARTITIONS_BATCH_SIZE = 1000
+
+# number of tables planned and queued at once when metadata is streamed
+STREAM_BATCH_SIZE = 100
+
 
 class Error(Exception):
     pass
 
 
+class MetadataKilled(Error):
+    """The metadata query of a host was killed by the watchdog."""
+    def __init__(self, hostname, reason):
+        super(MetadataKilled, self).__init__(
+            'Metadata query of %s killed (%s).' % (hostname, reason))
+        self.reason = reason
+
+
+class LazyFormat(object):
+    """A value formatted by pprint.pformat() only when it is logged.
+
+    The level of log is DEBUG, so a message formatted before it is passed
+    to log.debug() is formatted even if no handler emits it. Pass this as
+    an argument of the message instead.
+    """
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return pprint.pformat(self.value)
+
+
 def fetchall(conn, query, args=None):
     """Executes query and returns all rows."""
     rows = None
@@ -64,196 +132,560 @@ def fetchone(conn, query, args=None):
     return row
 
 
+def add_metadata_row(schema_tables, added_columns, hostname, row):
+    """Adds a row of the metadata query to schema tables.
+
+    added_columns is the set of columns already added. Returns the
+    'schema.table' of the row.
+    """
+    schema = row[0]
+    table = row[1]
+    column = row[2]
+    column_type = row[3]
+    row_count = row[4]
+    seq_in_index = row[6]
+    auto_increment = row[7]
+    extra = row[8]
+    is_auto_increment = bool(
+        extra and 'auto_increment' in extra.lower())
+    data_length = row[9]
+    create_options = row[10]
+    # MAX() of a column which leads an index is a single lookup
+    index_leading = bool(seq_in_index and seq_in_index == 1)
+
+    schema_table = '%s.%s' % (schema, table)
+    column_to_add = '%s.%s.%s' % (schema, table, column)
+    if column_to_add in added_columns:
+        # prevent duplicates, the column is joined once
+        # for each index it leads
+        return schema_table
+
+    column_dict = dict(
+        column_name=column,
+        column_type=column_type,
+        auto_increment=is_auto_increment,
+        index_leading=index_leading)
+    added_columns.add(column_to_add)
+    if schema_table in schema_tables:
+        schema_tables[schema_table]['columns'].append(column_dict)
+    else:
+        schema_tables[schema_table] = dict(
+            hostname=hostname,
+            schema=schema,
+            table=table,
+            row_count=row_count,
+            data_length=data_length,
+            auto_increment=auto_increment,
+            partitioned=bool(
+                create_options and 'partitioned' in create_options.lower()),
+            columns=[column_dict])
+    return schema_table
+
+
+def get_host_tag(merged_options):
+    """Returns the name used for the host in results."""
+    return merged_options.get('name') or merged_options.get('hostname') or ''
+
+
+def map_concurrently(func, items, threads, deadline=None):
+    """Calls func on each item using up to threads threads.
+
+    Returns a list of (result, error) tuples in the order of items. With a
+    deadline, the items which are not done DEADLINE_GRACE seconds after it
+    are abandoned and get an Error.
+    """
+    items = list(items)
+    outcomes = [None] * len(items)
+    indexes = Queue.Queue()
+    for i in range(len(items)):
+        indexes.put(i)
+
+    def worker():
+        while True:
+            try:
+                i = indexes.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                outcomes[i] = (func(items[i]), None)
+            except Exception, e:
+                log.exception('Exception.')
+                outcomes[i] = (None, e)
+
+    thread_list = []
+    for n in range(min(threads, len(items))):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+        thread_list.append(thread)
+    for thread in thread_list:
+        if deadline is None:
+            thread.join()
+        else:
+            thread.join(max(deadline + DEADLINE_GRACE - time.time(), 0))
+    for i, outcome in enumerate(outcomes):
+        if outcome is None:
+            outcomes[i] = (None, Error('Deadline reached.'))
+    return outcomes
+
+
+def build_select_max(schema, table, columns, partition=None):
+    """Returns a query that selects the max value of each column.
+
+    With partition, only that partition of the table is read.
+    """
+    select_list = ', '.join(
+        'MAX(`%s`)' % (column['column_name'],) for column in columns)
+    partition_clause = ''
+    if partition:
+        partition_clause = 'PARTITION (`%s`)' % (partition,)
+    return """
+        SELECT %s from `%s`.`%s` %s
+        """ % (select_list, schema, table, partition_clause)
+
+
+def fetch_max_row(conn, schema_table, select_max):
+    """Returns the max values of the columns of a work item.
+
+    select_max is the query of the item. An item with partition_search
+    reads its partitions highest first until one has a value: its column
+    is the RANGE partitioning column, so its max value is in the highest
+    non-empty partition.
+    """
+    partition_search = schema_table.get('partition_search')
+    if not partition_search:
+        return fetchone(conn, select_max)
+    row = None
+    for partition in partition_search:
+        select_max = build_select_max(
+            schema_table['schema'], schema_table['table'],
+            schema_table['columns'], partition)
+        log.debug(
+            '[%s] Query: %s', threading.current_thread().name, select_max)
+        row = fetchone(conn, select_max)
+        if row and row[0] is not None:
+            break
+    return row
+
+
+def get_range_column(partitions):
+    """Returns the column a table is RANGE partitioned on, None if none.
+
+    Tables partitioned on an expression or on several columns have no
+    range column.
+    """
+    if not partitions:
+        return None
+    method = partitions[0]['method']
+    expression = (partitions[0]['expression'] or '').strip()
+    if method not in ('RANGE', 'RANGE COLUMNS'):
+        return None
+    name = expression.strip('`')
+    if not name or any(c in name for c in '`,() '):
+        return None
+    return name
+
+
+def get_highest_partition(partitions):
+    """Returns the highest partition which has rows, the first if none."""
+    for partition in reversed(partitions):
+        if partition['rows']:
+            return partition
+    return partitions[0]
+
+
+def process_max_row(merged_options, results, schema_table, row):
+    """Classifies the max values of the columns of a work item.
+
+    The max values of a partition are merged with the other partitions of
+    its table first, and classified when the last partition is done.
+    """
+    merge = schema_table.get('partition_merge')
+    if merge is not None:
+        row = merge.add(row)
+        if row is None:
+            # other partitions are pending, or one was not checked
+            return
+    process_max_ints(merged_options, results, [
+        (schema_table['schema'], schema_table['table'],
+            column['column_name'], column['column_type'],
+            schema_table['row_count'], row[i] if row else 0)
+        for i, column in enumerate(schema_table['columns'])])
+
+
+def put_table_time(
+        results, schema_table, seconds, queue_wait=0, throttle_wait=0,
+        connect_seconds=0):
+    """Reports how long the MAX query of a table took.
+
+    queue_wait is the time the table waited in the work queue,
+    throttle_wait the time it waited for the load controller and
+    connect_seconds the time it waited for a connection.
+    """
+    results.put(dict(table_time=dict(
+        hostname=schema_table.get('hostname'),
+        schema=schema_table['schema'],
+        table=schema_table['table'],
+        partition=schema_table.get('partition'),
+        columns=len(schema_table['columns']),
+        estimated_cost=schema_table.get('estimated_cost', 0),
+        seconds=seconds,
+        queue_wait=queue_wait,
+        throttle_wait=throttle_wait,
+        connect_seconds=connect_seconds,
+        thread=threading.current_thread().name)))
+
+
+def get_lpt_makespan(costs, workers):
+    """Returns the makespan of costs run longest first on workers."""
+    loads = [0] * max(workers, 1)
+    for cost in sorted(costs, reverse=True):
+        heapq.heapreplace(loads, loads[0] + cost)
+    return max(loads)
+
+
+def format_prometheus_metrics(metrics):
+    """Returns the metrics of a run in the Prometheus text format."""
+    lines = []
+
+    def escape(value):
+        return ('%s' % (value,)).replace('\\', '\\\\').replace(
+            '"', '\\"').replace('\n', '\\n')
+
+    def add(name, help_text, samples):
+        name = 'int_overflow_check_%s' % (name,)
+        lines.append('# HELP %s %s' % (name, help_text))
+        lines.append('# TYPE %s gauge' % (name,))
+        for labels, value in samples:
+            label_text = ''
+            if labels:
+                label_text = '{%s}' % (','.join(
+                    '%s="%s"' % (k, escape(v))
+                    for k, v in sorted(labels.iteritems())),)
+            lines.append('%s%s %r' % (name, label_text, float(value)))
+
+    add('last_run_timestamp_seconds', 'Start time of the last run.',
+        [({}, metrics['started'])])
+    add('run_seconds', 'Wall-clock time of the run.',
+        [({}, metrics['run_time'])])
+    add('metadata_seconds', 'Time spent reading the metadata of a host.',
+        [(dict(host=host), seconds)
+            for host, seconds in sorted(metrics['metadata_times'].items())])
+    add('scan_seconds', 'Wall-clock time of the MAX queries.',
+        [({}, metrics['scan_time'])])
+    add('tables', 'Tables whose MAX query completed.',
+        [({}, metrics['tables'])])
+    add('query_seconds', 'Total time of the MAX queries.',
+        [({}, metrics['query_time'])])
+    add('query_max_seconds', 'Time of the slowest MAX query.',
+        [({}, metrics['max_query_time'])])
+    add('queue_wait_seconds', 'Total time tables waited in the work queue.',
+        [({}, metrics['queue_wait'])])
+    add('throttle_wait_seconds',
+        'Total time tables waited for the load controller.',
+        [({}, metrics['throttle_wait'])])
+    add('connections', 'Connections opened during the run.',
+        [({}, metrics['connections'])])
+    add('connect_seconds', 'Time spent opening connections.',
+        [({}, metrics['connect_time'])])
+    add('utilization_ratio',
+        'Fraction of the worker capacity spent on tables.',
+        [({}, metrics['utilization'])])
+    add('thread_utilization_ratio',
+        'Fraction of the capacity of a worker spent on tables.',
+        [(dict(thread=t['name']), t['utilization'])
+            for t in metrics['threads']])
+    add('columns', 'Columns by result.',
+        [(dict(result=result), metrics[result]) for result in (
+            'critical', 'warning', 'investigate', 'unchecked')])
+    add('table_query_seconds', 'Time of the MAX query of the slowest tables.',
+        [(dict(host=t['hostname'], schema=t['schema'], table=t['table']),
+            t['seconds']) for t in metrics['slowest_tables']])
+    return '\n'.join(lines) + '\n'
+
+
+def write_file_atomically(filename, text):
+    """Writes a file so that readers never see it half written."""
+    tmp_filename = '%s.tmp' % (filename,)
+    with open(tmp_filename, 'w') as f:
+        f.write(text)
+    os.rename(tmp_filename, filename)
+
+
+def parse_shard(shard):
+    """Returns the (index, count) of a shard given as 'i/N', i from 1 to N."""
+    try:
+        index, count = [int(n) for n in shard.split('/')]
+    except ValueError:
+        raise Error('Invalid shard %r, expected i/N.' % (shard,))
+    if not 1 <= index <= count:
+        raise Error('Invalid shard %r, i must be between 1 and N.' % (shard,))
+    return index, count
+
+
+def get_shard_index(schema_table, count):
+    """Returns the shard, from 1 to count, of a 'schema.table'.
+
+    The hash is stable across processes and machines, unlike hash().
+    """
+    if isinstance(schema_table, unicode):
+        schema_table = schema_table.encode('utf-8')
+    return int(hashlib.md5(schema_table).hexdigest()[:8], 16) % count + 1
+
+
+def filter_shard(schema_tables, shard):
+    """Returns the schema tables of a shard, an (index, count) tuple."""
+    index, count = shard
+    return dict(
+        (schema_table, v) for schema_table, v in schema_tables.iteritems()
+        if get_shard_index(schema_table, count) == index)
+
+
+def patch_for_async():
+    """Makes sockets cooperative, so PyMySQL queries run as greenlets.
+
+    The socket module is patched once, before any other thread is
+    started, since sockets already used by other threads would be shared
+    with the hub of the async engine.
+    """
+    if gevent.monkey.is_module_patched('socket'):
+        return
+    if threading.active_count() > 1:
+        raise Error(
+            'The async engine has to be selected before other threads '
+            'are started.')
+    gevent.monkey.patch_socket()
+
+
+def get_table_key(schema_table):
+    """Returns the (hostname, schema, table) of a table or a column."""
+    return (
+        schema_table.get('hostname'), schema_table['schema'],
+        schema_table['table'])
+
+
+def put_unchecked_columns(results, schema_table, reason):
+    """Reports the columns of a table which were not checked.
+
+    The columns of a partitioned table are reported once, for the first
+    partition which was not checked.
+    """
+    merge = schema_table.get('partition_merge')
+    if merge is not None and not merge.fail():
+        return
+    for column in schema_table['columns']:
+        results.put(dict(unchecked_column=dict(
+            hostname=schema_table.get('hostname'),
+            schema=schema_table['schema'],
+            table=schema_table['table'],
+            column_name=column['column_name'],
+            column_type=column['column_type'],
+            reason=reason)))
+
+
+def process_max_int(
+        merged_options, results, max_int, schema, table, column_name,
+        column_type, row_count):
+    """Classifies max value of a column and puts flagged columns in results."""
+    process_max_ints(merged_options, results, [
+        (schema, table, column_name, column_type, row_count, max_int)])
+
+
+def process_max_ints(merged_options, results, columns):
+    """Classifies max values of columns and puts flagged columns in results.
+
+    columns is a list of (schema, table, column_name, column_type,
+    row_count, max_int), classified in one batch.
+    """
+    hostname = get_host_tag(merged_options)
+    classified = classification.classify_batch(
+        [(max_int, column_type, row_count)
+            for _, _, _, column_type, row_count, max_int in columns],
+        classification.Thresholds.from_options(merged_options))
+
+    for column, (category, overflow_percentage, row_count_ratio) in zip(
+            columns, classified):
+        schema, table, column_name, column_type, row_count, max_int = column
+        if max_int is None:
+            max_int = 0
+
+        log.debug(
+            '[%s] %s.%s.%s: overflow_percentage=%s, row_count_ratio=%s',
+            threading.current_thread().name, schema, table, column_name,
+            overflow_percentage, row_count_ratio)
+
+        if merged_options.get('state_file'):
+            # every observed value is recorded, not only the flagged columns
+            results.put(dict(scanned_column=dict(
+                hostname=hostname,
+                schema=schema,
+                table=table,
+                column_name=column_name,
+                max_value=max_int,
+                overflow_percentage=overflow_percentage,
+                row_count=row_count)))
+
+        if category is None:
+            continue
+
+        flagged_column = dict(
+            hostname=hostname,
+            schema=schema,
+            table=table,
+            column_name=column_name,
+            column_type=column_type,
+            max_value=max_int,
+            overflow_percentage=overflow_percentage)
+        if category == classification.INVESTIGATE:
+            flagged_column['row_count_ratio'] = row_count_ratio
+        results.put({'%s_column' % (category,): flagged_column})
+        log.debug(
+            '[%s] %s_column: %s', threading.current_thread().name, category,
+            flagged_column)
+
+
 class TableProcessor(threading.Thread):
     """Worker thread for processing a table."""
     def __init__(self, *args, **kwargs):
         self.schema_tables = kwargs.pop('schema_tables')
         self.merged_options = kwargs.pop('merged_options')
         self.results = kwargs.pop('results')
+        self.pool = kwargs.pop('pool')
+        self.host_options = kwargs.pop('host_options', {})
+        self.watchdog = kwargs.pop('watchdog', None)
+        self.routers = kwargs.pop('routers', {})
+        self.controller = kwargs.pop('controller', None)
         super(TableProcessor, self).__init__(*args, **kwargs)
         self.daemon = True
         self.stop_event = threading.Event()
 
     def process_max_int(
-            self, max_int, schema, table, column_name, column_type, row_count):
-        # Initialize constants
-        type_tinyint = 127.0
-        type_smallint = 32767.0
-        type_mediumint = 8388607.0
-        type_int = 2147483647.0
-        type_bigint = 9223372036854775807.0
-
-        type_tinyint_us = 255.0
-        type_smallint_us = 65535.0
-        type_mediumint_us = 16777215.0
-        type_int_us = 4294967295.0
-        type_bigint_us = 18446744073709551615.0
-
-        # Initialize dubious fields
-        if max_int is None:
-            max_int = 0
-
-        # Check if type is signed or unsigned
-        unsigned = False
-        if 'unsigned' in column_type:
-            unsigned = True
-
-        int_type = column_type.split('(')[0]
-
-        row_count_ratio = 0
-
-        # Compute overflow percentage
-        overflow_percentage = 0
-        if not unsigned:
-            if int_type == 'tinyint':
-                overflow_percentage = (max_int / type_tinyint) * 100
-                row_count_ratio = (row_count / type_tinyint) * 100
-            elif int_type == 'smallint':
-                overflow_percentage = (max_int / type_smallint) * 100
-                row_count_ratio = (row_count / type_smallint) * 100
-            elif int_type == 'mediumint':
-                overflow_percentage = (max_int / type_mediumint) * 100
-                row_count_ratio = (row_count / type_mediumint) * 100
-            elif int_type == 'int':
-                overflow_percentage = (max_int / type_int) * 100
-                row_count_ratio = (row_count / type_int) * 100
-            elif int_type == 'bigint':
-                overflow_percentage = (max_int / type_bigint) * 100
-                row_count_ratio = (row_count / type_bigint) * 100
-        else:
-            if int_type == 'tinyint':
-                overflow_percentage = (max_int / type_tinyint_us) * 100
-                row_count_ratio = (row_count / type_tinyint_us) * 100
-            elif int_type == 'smallint':
-                overflow_percentage = (max_int / type_smallint_us) * 100
-                row_count_ratio = (row_count / type_smallint_us) * 100
-            elif int_type == 'mediumint':
-                overflow_percentage = (max_int / type_mediumint_us) * 100
-                row_count_ratio = (row_count / type_mediumint_us) * 100
-            elif int_type == 'int':
-                overflow_percentage = (max_int / type_int_us) * 100
-                row_count_ratio = (row_count / type_int_us) * 100
-            elif int_type == 'bigint':
-                overflow_percentage = (max_int / type_bigint_us) * 100
-                row_count_ratio = (row_count / type_bigint_us) * 100
-
-
-
-        critical_threshold = self.merged_options['critical']
-        warning_threshold = self.merged_options['warning']
-
-        row_count_max_ratio = self.merged_options.get('row_count_max_ratio')
-        display_row_count_max_ratio_columns = self.merged_options.get('display_row_count_max_ratio_columns')
-
-        log.debug('[%s] overflow_percentage=%s, row_count_ratio=%s' % (
-            self.name, overflow_percentage, row_count_ratio))
-
-        if overflow_percentage > critical_threshold:
-            if row_count_ratio >= row_count_max_ratio:
-                critical_column = {
-                    'schema': schema,
-                    'table': table,
-                    'column_name': column_name,
-                    'column_type': column_type,
-                    'max_value': max_int,
-                    'overflow_percentage': overflow_percentage,
-                }
-                self.results.put(dict(critical_column=critical_column))
-                log.debug('[%s] critical_column: \n%s' % (
-                    self.name, pprint.pformat(critical_column)))
-            elif display_row_count_max_ratio_columns:
-                investigate_column = dict(
-                    schema=schema,
-                    table=table,
-                    column_name=column_name,
-                    column_type=column_type,
-                    max_value=max_int,
-                    overflow_percentage=overflow_percentage,
-                    row_count_ratio=row_count_ratio
-                )
-                self.results.put(dict(
-                    investigate_column=investigate_column
-                ))
-                log.debug('[%s] investigate_column: \n%s' % (
-                    self.name, pprint.pformat(investigate_column)))
-
-        elif overflow_percentage > warning_threshold:
-            if row_count_ratio >= row_count_max_ratio:
-                warning_column = {
-                    'schema': schema,
-                    'table': table,
-                    'column_name': column_name,
-                    'column_type': column_type,
-                    'max_value': max_int,
-                    'overflow_percentage': overflow_percentage,
-                }
-                self.results.put(dict(warning_column=warning_column))
-                log.debug('[%s] warning_colun: \n%s' % (
-                    self.name, pprint.pformat(warning_column)))
-            elif display_row_count_max_ratio_columns:
-                investigate_column = dict(
-                    schema=schema,
-                    table=table,
-                    column_name=column_name,
-                    column_type=column_type,
-                    max_value=max_int,
-                    overflow_percentage=overflow_percentage,
-                    row_count_ratio=row_count_ratio
-                )
-                self.results.put(dict(
-                    investigate_column=investigate_column
-                ))
-                log.debug('[%s] investigate_column: \n%s' % (
-                    self.name, pprint.pformat(investigate_column)))
+            self, max_int, schema, table, column_name, column_type, row_count,
+            merged_options=None):
+        process_max_int(
+            merged_options or self.merged_options, self.results, max_int,
+            schema, table, column_name, column_type, row_count)
+
+    def release_server(self, router, connection_options):
+        """Releases the server which ran the query of a table."""
+        if self.controller:
+            self.controller.release(connection_options)
+        if router:
+            router.release(connection_options)
 
     def run(self):
-        log.debug('Thread [%s] started.' % (self.name,))
+        log.debug('Thread [%s] started.', self.name)
+        thread_started = time.time()
+        busy = 0
         try:
             while not self.stop_event.is_set():
                 try:
-                    schema_table = self.schema_tables.get(False, 5)
+                    schema_table = self.schema_tables.get()
+                    if schema_table is None or self.stop_event.is_set():
+                        # no more tables, or the check is stopped
+                        if schema_table is not None:
+                            put_unchecked_columns(
+                                self.results, schema_table, 'stopped')
+                        self.schema_tables.task_done()
+                        break
+                    dequeued = time.time()
                     try:
                         schema = schema_table['schema']
                         table = schema_table['table']
                         columns = schema_table['columns']
-                        row_count = schema_table['row_count']
 
-                        log.debug("[%s] Processing '%s.%s'..." % (
-                            self.name, schema, table))
+                        log.debug(
+                            "[%s] Processing '%s.%s'...",
+                            self.name, schema, table)
 
-                        conn = create_connection(self.merged_options)
+                        merged_options = self.host_options.get(
+                            schema_table.get('hostname'), self.merged_options)
+                        router = self.routers.get(schema_table.get('hostname'))
+                        if router:
+                            connection_options = router.acquire()
+                        else:
+                            connection_options = get_connection_options(
+                                merged_options)
+                        throttled = time.time()
+                        if self.controller and not self.controller.acquire(
+                                connection_options,
+                                schema_table.get('estimated_rows', 0),
+                                merged_options, self.stop_event.wait,
+                                self.stop_event):
+                            if router:
+                                router.release(connection_options)
+                            put_unchecked_columns(
+                                self.results, schema_table, 'stopped')
+                            continue
+                        connecting = time.time()
                         try:
-                            for column in columns:
-                                column_name = column['column_name']
-                                column_type = column['column_type']
-
-                                # Retrieve max value of integer
-                                select_max = """
-                                    SELECT MAX(`%s`) from `%s`.`%s`
-                                    """ % (column_name, schema, table)
-
-                                log.debug('[%s] Query: %s' % (self.name, select_max))
-
-                                row = fetchone(conn, select_max)
-                                max_int = 0
-                                if row:
-                                    max_int = row[0]
-
-                                log.debug('[%s] max_int: %s' % (self.name, max_int))
-
-                                self.process_max_int(
-                                    max_int, schema, table, column_name,
-                                    column_type, row_count)
+                            conn = self.pool.connect(
+                                connection_options,
+                                max_connections=merged_options.get(
+                                    'max_connections'))
+                        except:
+                            self.release_server(router, connection_options)
+                            raise
+                        connected = time.time()
+                        try:
+                            # Retrieve max values of all integer columns
+                            # of the table in a single query
+                            select_max = build_select_max(
+                                schema, table, columns,
+                                schema_table.get('partition'))
+
+                            log.debug(
+                                '[%s] Query: %s', self.name, select_max)
+
+                            token = None
+                            if self.watchdog:
+                                token = self.watchdog.register(
+                                    connection_options, conn.thread_id())
+                            query_started = time.time()
+                            try:
+                                row = fetch_max_row(
+                                    conn, schema_table, select_max)
+                            except MySQLdb.OperationalError:
+                                reason = None
+                                if token is not None:
+                                    reason = self.watchdog.unregister(token)
+                                    token = None
+                                if not reason:
+                                    raise
+                                log.info(
+                                    '[%s] Query killed (%s): %s',
+                                    self.name, reason, select_max)
+                                put_unchecked_columns(
+                                    self.results, schema_table, reason)
+                                continue
+                            finally:
+                                if token is not None:
+                                    self.watchdog.unregister(token)
+
+                            query_seconds = time.time() - query_started
+                            log.debug(
+                                '[%s] max_ints: %s (%.3fs)',
+                                self.name, row, query_seconds)
+                            put_table_time(
+                                self.results, schema_table, query_seconds,
+                                queue_wait=dequeued - schema_table.get(
+                                    'queued', dequeued),
+                                throttle_wait=connecting - throttled,
+                                connect_seconds=connected - connecting)
+
+                            process_max_row(
+                                merged_options, self.results, schema_table,
+                                row)
                         finally:
                             conn.close()
+                            self.release_server(router, connection_options)
                     finally:
                         # ensure that this is called so that the main thread
                         # will not wait forever
+                        self.schema_tables.release(schema_table)
                         self.schema_tables.task_done()
+                        busy += time.time() - dequeued
                         time.sleep(0)
-                except Queue.Empty:
-                    break
-
                 except Exception, e:
                     log.exception('[%s] Exception.' % (self.name,))
                     error = '%s: %s' % (type(e), e)
@@ -266,11 +698,654 @@ class TableProcessor(threading.Thread):
             # just ignore them
             log.exception('[%s] Exception.' % (self.name,))
             pass
+        finally:
+            # tells the main thread that this thread will not add results
+            self.results.put(dict(done=self.name, thread_stats=dict(
+                name=self.name, busy=busy, slots=1,
+                elapsed=time.time() - thread_started)))
 
-        log.debug('Thread [%s] ended.' % (self.name,))
+        log.debug('Thread [%s] ended.', self.name)
 
-def create_connection(merged_options):
-    """Returns mysql connection."""
+
+class AsyncTableProcessor(threading.Thread):
+    """Worker thread for processing tables with greenlets.
+
+    Up to async_queries MAX queries are kept in flight by greenlets
+    running in this thread. Each host gets at most max_connections
+    PyMySQL connections (async_queries if not set), which are reused
+    across tables. Requires gevent and PyMySQL.
+    """
+    def __init__(self, *args, **kwargs):
+        self.schema_tables = kwargs.pop('schema_tables')
+        self.merged_options = kwargs.pop('merged_options')
+        self.results = kwargs.pop('results')
+        self.host_options = kwargs.pop('host_options', {})
+        self.watchdog = kwargs.pop('watchdog', None)
+        self.routers = kwargs.pop('routers', {})
+        self.controller = kwargs.pop('controller', None)
+        super(AsyncTableProcessor, self).__init__(*args, **kwargs)
+        self.daemon = True
+        self.stop_event = threading.Event()
+        self.idle_connections = {}
+        self.connection_slots = {}
+        self.busy = 0
+        self.connections = 0
+        self.connect_seconds = 0
+
+    def connect(self, merged_options, connection_options):
+        """Returns an idle connection to the server, waits if none is left."""
+        key = tuple(sorted(connection_options.iteritems()))
+        if key not in self.connection_slots:
+            self.connection_slots[key] = gevent.lock.BoundedSemaphore(
+                merged_options.get('max_connections') or
+                self.merged_options['async_queries'])
+            self.idle_connections[key] = []
+        self.connection_slots[key].acquire()
+        idle_connections = self.idle_connections[key]
+        if idle_connections:
+            return key, idle_connections.pop()
+        connecting = time.time()
+        try:
+            conn = pymysql.connect(autocommit=True, **connection_options)
+        except:
+            self.connection_slots[key].release()
+            raise
+        self.connections += 1
+        self.connect_seconds += time.time() - connecting
+        return key, conn
+
+    def call_blocking(self, func, *args):
+        """Calls func in a native thread, so the greenlets keep running.
+
+        The load controller and the watchdog use MySQLdb and hold locks
+        while they query, which would block the hub of this thread.
+        """
+        return gevent.get_hub().threadpool.apply(func, args)
+
+    def release(self, key, conn, broken=False):
+        if broken:
+            try:
+                conn.close()
+            except pymysql.Error:
+                pass
+        else:
+            self.idle_connections[key].append(conn)
+        self.connection_slots[key].release()
+
+    def release_server(self, router, connection_options):
+        """Releases the server which ran the query of a table."""
+        if self.controller:
+            self.controller.release(connection_options)
+        if router:
+            router.release(connection_options)
+
+    def process_table(self, schema_table):
+        started = time.time()
+        try:
+            schema = schema_table['schema']
+            table = schema_table['table']
+            columns = schema_table['columns']
+
+            log.debug(
+                "[%s] Processing '%s.%s'...", self.name, schema, table)
+
+            merged_options = self.host_options.get(
+                schema_table.get('hostname'), self.merged_options)
+            router = self.routers.get(schema_table.get('hostname'))
+            if router:
+                connection_options = router.acquire()
+            else:
+                connection_options = get_connection_options(merged_options)
+            throttled = time.time()
+            if self.controller:
+                # the first query to a server waits for its first sample
+                self.call_blocking(
+                    self.controller.get_server, connection_options,
+                    merged_options)
+            if self.controller and not self.controller.acquire(
+                    connection_options, schema_table.get('estimated_rows', 0),
+                    merged_options, gevent.sleep, self.stop_event):
+                if router:
+                    router.release(connection_options)
+                put_unchecked_columns(self.results, schema_table, 'stopped')
+                return
+            connecting = time.time()
+            try:
+                key, conn = self.connect(merged_options, connection_options)
+            except:
+                self.release_server(router, connection_options)
+                raise
+            connected = time.time()
+            broken = True
+            token = None
+            try:
+                select_max = build_select_max(
+                    schema, table, columns, schema_table.get('partition'))
+
+                log.debug('[%s] Query: %s', self.name, select_max)
+
+                if self.watchdog:
+                    token = self.call_blocking(
+                        self.watchdog.register, connection_options,
+                        conn.thread_id())
+                query_started = time.time()
+                try:
+                    row = fetch_max_row(conn, schema_table, select_max)
+                except pymysql.OperationalError:
+                    reason = None
+                    if token is not None:
+                        reason = self.call_blocking(
+                            self.watchdog.unregister, token)
+                        token = None
+                    if not reason:
+                        raise
+                    log.info(
+                        '[%s] Query killed (%s): %s',
+                        self.name, reason, select_max)
+                    put_unchecked_columns(self.results, schema_table, reason)
+                    return
+                broken = False
+
+                query_seconds = time.time() - query_started
+                log.debug(
+                    '[%s] max_ints: %s (%.3fs)',
+                    self.name, row, query_seconds)
+                put_table_time(
+                    self.results, schema_table, query_seconds,
+                    queue_wait=started - schema_table.get('queued', started),
+                    throttle_wait=connecting - throttled,
+                    connect_seconds=connected - connecting)
+            finally:
+                if token is not None:
+                    self.call_blocking(self.watchdog.unregister, token)
+                self.release(key, conn, broken)
+                self.release_server(router, connection_options)
+
+            process_max_row(merged_options, self.results, schema_table, row)
+        except gevent.GreenletExit:
+            # the query in flight was abandoned
+            put_unchecked_columns(self.results, schema_table, 'stopped')
+            raise
+        except Exception, e:
+            log.exception('[%s] Exception.' % (self.name,))
+            error = '%s: %s' % (type(e), e)
+            self.results.put(dict(error=error))
+        finally:
+            self.schema_tables.release(schema_table)
+            self.schema_tables.task_done()
+            self.busy += time.time() - started
+
+    def run(self):
+        log.debug('Thread [%s] started.', self.name)
+        thread_started = time.time()
+        try:
+            # sockets were made cooperative by patch_for_async()
+            greenlets = gevent.pool.Pool(self.merged_options['async_queries'])
+            while True:
+                # the queue is shared with other threads, wait for it in
+                # a native thread while the queries in flight go on
+                schema_table = self.call_blocking(self.schema_tables.get)
+                if schema_table is None:
+                    # no more tables
+                    self.schema_tables.task_done()
+                    break
+                if self.stop_event.is_set():
+                    put_unchecked_columns(
+                        self.results, schema_table, 'stopped')
+                    self.schema_tables.task_done()
+                    break
+                # waits for a free slot when async_queries are in flight
+                greenlets.spawn(self.process_table, schema_table)
+            if self.stop_event.is_set():
+                # abandon the queries in flight
+                greenlets.kill()
+            else:
+                greenlets.join()
+            for idle_connections in self.idle_connections.itervalues():
+                for conn in idle_connections:
+                    conn.close()
+            gevent.get_hub().threadpool.kill()
+        except Exception, e:
+            log.exception('[%s] Exception.' % (self.name,))
+            error = '%s: %s' % (type(e), e)
+            self.results.put(dict(error=error))
+        finally:
+            # tells the main thread that this thread will not add results,
+            # busy is the total time of the greenlets
+            self.results.put(dict(done=self.name, thread_stats=dict(
+                name=self.name, busy=self.busy,
+                slots=self.merged_options['async_queries'],
+                elapsed=time.time() - thread_started,
+                connections=self.connections,
+                connect_seconds=self.connect_seconds)))
+
+        log.debug('Thread [%s] ended.', self.name)
+
+
+class QueryWatchdog(threading.Thread):
+    """Kills MAX queries which run too long with KILL QUERY.
+
+    A query expires query_timeout seconds after it is registered or at
+    the deadline of the run, whichever comes first. expire_all() expires
+    every query at once, e.g. when the check stops at its first critical
+    column. KILL QUERY is sent over a separate connection to each server,
+    so that it does not wait for a connection held by a worker, and
+    without holding the lock, so that only the workers whose query is
+    being killed wait for it.
+    """
+    # seconds between checks for expired queries
+    interval = 0.1
+
+    def __init__(self, *args, **kwargs):
+        self.query_timeout = kwargs.pop('query_timeout', None)
+        self.deadline = kwargs.pop('deadline', None)
+        super(QueryWatchdog, self).__init__(*args, **kwargs)
+        self.daemon = True
+        self.stop_event = threading.Event()
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        self.counter = itertools.count()
+        self.queries = {}
+        self.killing = set()
+        self.killed = {}
+        self.kill_connections = {}
+        # reason of expire_all(), queries registered afterwards expire
+        # immediately
+        self.expired = None
+
+    def register(self, connection_options, thread_id, timeout=True):
+        """Starts the timeout of a query, returns its token.
+
+        Without timeout, only the deadline applies to the query.
+        """
+        expires_at = self.deadline
+        reason = 'deadline'
+        if timeout and self.query_timeout:
+            timeout_at = time.time() + self.query_timeout
+            if expires_at is None or timeout_at < expires_at:
+                expires_at = timeout_at
+                reason = 'query timeout'
+        token = next(self.counter)
+        with self.lock:
+            if self.expired:
+                expires_at, reason = 0, self.expired
+            self.queries[token] = (
+                expires_at, reason, connection_options, thread_id)
+        return token
+
+    def expire_all(self, reason):
+        """Expires the queries in flight and the ones registered later."""
+        with self.lock:
+            self.expired = reason
+            for token, query in self.queries.items():
+                self.queries[token] = (0, reason) + query[2:]
+
+    def unregister(self, token):
+        """Ends the timeout of a query.
+
+        Returns the reason if the query was killed, otherwise None.
+        """
+        with self.lock:
+            self.queries.pop(token, None)
+            # the connection must not run another query before the kill
+            while token in self.killing:
+                self.condition.wait()
+            return self.killed.pop(token, None)
+
+    def kill(self, connection_options, thread_id):
+        key = tuple(sorted(connection_options.iteritems()))
+        conn = self.kill_connections.get(key)
+        if conn is None:
+            options = dict(
+                connection_options, connect_timeout=KILL_CONNECT_TIMEOUT)
+            conn = MySQLdb.connect(**options)
+            self.kill_connections[key] = conn
+        cur = conn.cursor()
+        try:
+            cur.execute('KILL QUERY %d' % (thread_id,))
+        finally:
+            cur.close()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            now = time.time()
+            expired = []
+            with self.lock:
+                for token, query in self.queries.items():
+                    expires_at = query[0]
+                    if expires_at is None or expires_at > now:
+                        continue
+                    del self.queries[token]
+                    self.killing.add(token)
+                    expired.append((token, query))
+            for token, query in expired:
+                _, reason, connection_options, thread_id = query
+                killed = False
+                try:
+                    self.kill(connection_options, thread_id)
+                    killed = True
+                except MySQLdb.Error:
+                    log.exception('Unable to kill query %s.', thread_id)
+                finally:
+                    with self.lock:
+                        self.killing.discard(token)
+                        if killed:
+                            self.killed[token] = reason
+                        self.condition.notify_all()
+        for conn in self.kill_connections.itervalues():
+            conn.close()
+
+
+class ReplicaRouter(object):
+    """Routes the MAX queries of a host to its replicas.
+
+    Only replicas whose lag is at most max_replica_lag when the router is
+    created are used. Each query goes to the replica with the fewest
+    queries of this run in flight, plus its Threads_running when it was
+    probed. Queries go to the primary when no replica is usable.
+    """
+    def __init__(self, primary_options, replicas):
+        self.primary_options = primary_options
+        self.lock = threading.Lock()
+        # list of [load, connection_options]
+        self.replicas = [
+            [load, connection_options]
+            for connection_options, load in replicas]
+
+    def acquire(self):
+        """Returns the connection options of the least loaded server."""
+        if not self.replicas:
+            return self.primary_options
+        with self.lock:
+            replica = min(self.replicas, key=lambda r: r[0])
+            replica[0] += 1
+            return replica[1]
+
+    def release(self, connection_options):
+        with self.lock:
+            for replica in self.replicas:
+                if replica[1] is connection_options:
+                    replica[0] -= 1
+
+
+class LoadController(threading.Thread):
+    """Adapts the concurrent queries on each server to its load.
+
+    Every interval seconds, Threads_running, the rate of
+    Innodb_buffer_pool_reads and the replication lag of each server
+    running MAX queries are sampled. When one is over its limit, the
+    number of concurrent queries allowed on the server is halved, down to
+    one. Otherwise it grows by one, up to max_connections. With
+    max_rows_per_second, a query also waits until the rows examined by
+    the previous queries on the server are paid off (token bucket).
+
+    The connection of a server is only used by one sample at a time, the
+    first sample runs in the worker which first queries the server. The
+    listeners are called when the allowed queries of a server change.
+    """
+    # seconds between samples of each server
+    interval = 5
+    # seconds between checks for a free query slot
+    poll_interval = 0.05
+
+    def __init__(self, *args, **kwargs):
+        super(LoadController, self).__init__(*args, **kwargs)
+        self.daemon = True
+        self.stop_event = threading.Event()
+        self.lock = threading.Lock()
+        self.servers = {}
+        self.listeners = []
+
+    def get_server(self, connection_options, merged_options):
+        key = tuple(sorted(connection_options.iteritems()))
+        with self.lock:
+            server = self.servers.get(key)
+            if server is not None:
+                return server
+            max_queries = merged_options.get('max_connections')
+            if not max_queries:
+                if merged_options.get('engine') == 'async':
+                    max_queries = merged_options['async_queries']
+                else:
+                    max_queries = merged_options['threads']
+            # no query runs until the server is sampled
+            server = dict(
+                connection_options=connection_options,
+                merged_options=merged_options,
+                max_queries=max_queries,
+                allowed=0,
+                active=0,
+                tokens=merged_options.get('max_rows_per_second') or 0,
+                updated=time.time(),
+                sample=None,
+                conn=None,
+                conn_lock=threading.Lock())
+            self.servers[key] = server
+        self.sample(server)
+        return server
+
+    def acquire(
+            self, connection_options, rows, merged_options, sleep,
+            stop_event):
+        """Waits until a query examining rows may run on the server.
+
+        sleep is the function used to wait. Returns False if stop_event
+        is set meanwhile.
+        """
+        server = self.get_server(connection_options, merged_options)
+        rate = merged_options.get('max_rows_per_second')
+        while not stop_event.is_set():
+            wait = self.poll_interval
+            with self.lock:
+                if server['active'] < server['allowed']:
+                    wait = 0
+                    if rate:
+                        now = time.time()
+                        server['tokens'] = min(
+                            rate,
+                            server['tokens'] +
+                            (now - server['updated']) * rate)
+                        server['updated'] = now
+                        if server['tokens'] < 0:
+                            wait = min(-server['tokens'] / rate, 1)
+                    if not wait:
+                        server['active'] += 1
+                        if rate:
+                            server['tokens'] -= rows
+                        return True
+            sleep(wait)
+        return False
+
+    def release(self, connection_options):
+        key = tuple(sorted(connection_options.iteritems()))
+        with self.lock:
+            self.servers[key]['active'] -= 1
+
+    def get_host_limit(self, hostname):
+        """Returns the queries allowed on the sampled servers of a host.
+
+        None if none of the servers of the host was sampled yet.
+        """
+        with self.lock:
+            allowed = [
+                server['allowed'] for server in self.servers.itervalues()
+                if server['allowed'] and
+                get_host_tag(server['merged_options']) == hostname]
+        return sum(allowed) if allowed else None
+
+    def sample(self, server):
+        """Adapts the allowed queries of a server to its current load."""
+        # a MySQLdb connection is not thread safe
+        with server['conn_lock']:
+            changed = self.sample_server(server)
+        if changed:
+            for listener in self.listeners:
+                listener()
+
+    def sample_server(self, server):
+        """Samples the load of a server.
+
+        Returns whether the allowed queries of the server changed.
+        """
+        merged_options = server['merged_options']
+        try:
+            if server['conn'] is None:
+                server['conn'] = MySQLdb.connect(
+                    **server['connection_options'])
+            conn = server['conn']
+            status = dict(
+                (name, int(value)) for name, value in fetchall(conn, """
+                    SHOW GLOBAL STATUS
+                    WHERE Variable_name IN (
+                        'Threads_running', 'Innodb_buffer_pool_reads')
+                    """))
+            replica_status = get_replica_status(conn)
+        except MySQLdb.Error:
+            log.exception('Unable to sample %s.' % (
+                server['connection_options'].get('host'),))
+            server['conn'] = None
+            with self.lock:
+                # the load is unknown, keep the current limit
+                previous = server['allowed']
+                server['allowed'] = previous or server['max_queries']
+                return server['allowed'] != previous
+        now = time.time()
+
+        over = []
+        # this connection is one of the running threads
+        threads_running = status.get('Threads_running', 1) - 1
+        max_threads_running = merged_options.get('max_threads_running')
+        if max_threads_running and threads_running > max_threads_running:
+            over.append('threads running: %s' % (threads_running,))
+        reads = status.get('Innodb_buffer_pool_reads', 0)
+        max_buffer_pool_reads = merged_options.get('max_buffer_pool_reads')
+        if server['sample'] and max_buffer_pool_reads:
+            sampled_at, sampled_reads = server['sample']
+            reads_rate = (
+                float(reads - sampled_reads) / max(now - sampled_at, 1))
+            if reads_rate > max_buffer_pool_reads:
+                over.append('buffer pool reads: %.0f/s' % (reads_rate,))
+        server['sample'] = (now, reads)
+        if replica_status:
+            lag = replica_status.get(
+                'Seconds_Behind_Source',
+                replica_status.get('Seconds_Behind_Master'))
+            if lag is not None and lag > merged_options['max_replica_lag']:
+                over.append('replica lag: %s' % (lag,))
+
+        with self.lock:
+            previous = server['allowed']
+            allowed = previous or server['max_queries']
+            if over:
+                server['allowed'] = max(allowed // 2, 1)
+            elif allowed < server['max_queries']:
+                server['allowed'] = allowed + 1
+            else:
+                server['allowed'] = allowed
+            if server['allowed'] != allowed:
+                log.info(
+                    '%s: %s concurrent queries allowed%s',
+                    server['connection_options'].get('host'),
+                    server['allowed'],
+                    over and ' (%s)' % (', '.join(over),) or '')
+            return server['allowed'] != previous
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            for server in self.servers.values():
+                self.sample(server)
+        for server in self.servers.values():
+            with server['conn_lock']:
+                if server['conn'] is not None:
+                    server['conn'].close()
+
+
+class MetadataStreamer(threading.Thread):
+    """Reads the metadata of the hosts and queues their tables meanwhile.
+
+    The tables of each host are planned and put on the work queue in
+    batches while its metadata is still being read, so the workers start
+    scanning before discovery is done. Once all hosts are read, a
+    sentinel is put for each of the workers. The estimated costs of the
+    queued tables, the skipped columns and the (options, error) of the
+    hosts which failed are collected. An exception of the streamer itself
+    is kept as error.
+    """
+    def __init__(self, *args, **kwargs):
+        self.checker = kwargs.pop('checker')
+        self.targets = kwargs.pop('targets')
+        self.queue = kwargs.pop('schema_tables')
+        self.results = kwargs.pop('results')
+        self.state_store = kwargs.pop('state_store', None)
+        self.host_states = kwargs.pop('host_states', {})
+        self.workers = kwargs.pop('workers')
+        self.threads = kwargs.pop('threads')
+        super(MetadataStreamer, self).__init__(*args, **kwargs)
+        self.daemon = True
+        self.stop_event = threading.Event()
+        self.costs = []
+        self.skipped_columns = []
+        self.errors = []
+        self.error = None
+
+    def run(self):
+        try:
+            outcomes = map_concurrently(
+                self.stream_host, self.targets, self.threads)
+            for options, (_, error) in zip(self.targets, outcomes):
+                if error is not None:
+                    self.errors.append((options, error))
+        except Exception, e:
+            log.exception('[%s] Exception.' % (self.name,))
+            self.error = e
+        finally:
+            for n in range(self.workers):
+                self.queue.put(None)
+
+    def stream_host(self, merged_options):
+        """Queues the tables of a host as its metadata is read."""
+        checker = self.checker
+        hostname = get_host_tag(merged_options)
+        column_states, growth_rates = self.host_states.get(
+            hostname, ({}, {}))
+        metadata_started = time.time()
+        for schema_tables in checker.iter_schema_tables(merged_options):
+            if self.stop_event.is_set():
+                break
+            if merged_options.get('shard'):
+                schema_tables = filter_shard(
+                    schema_tables, merged_options['shard'])
+            schema_tables = checker.plan_schema_tables(
+                schema_tables, merged_options)
+            work, skipped_columns = checker.get_host_work(
+                schema_tables, merged_options, self.results,
+                self.state_store, column_states, growth_rates)
+            self.skipped_columns.extend(skipped_columns)
+            for v in work:
+                self.costs.append(v.get('estimated_cost', 0))
+                self.queue.put(v)
+        checker.metadata_times[hostname] = time.time() - metadata_started
+
+
+def get_replica_status(conn):
+    """Returns SHOW REPLICA STATUS as a dict, None if not a replica."""
+    cur = conn.cursor()
+    try:
+        try:
+            cur.execute('SHOW REPLICA STATUS')
+        except MySQLdb.ProgrammingError:
+            # before MySQL 8.0.22
+            cur.execute('SHOW SLAVE STATUS')
+        row = cur.fetchone()
+        if row is None:
+            return None
+        return dict(zip([d[0] for d in cur.description], row))
+    finally:
+        cur.close()
+
+
+def get_connection_options(merged_options):
+    """Returns MySQLdb.connect() arguments."""
 
     connection_options = {}
     if 'hostname' in merged_options and merged_options['hostname']:
@@ -281,12 +1356,844 @@ def create_connection(merged_options):
         connection_options['user'] = merged_options['user']
     if 'password' in merged_options and merged_options['password']:
         connection_options['passwd'] = merged_options['password']
-    return MySQLdb.connect(**connection_options)
+    return connection_options
+
+
+def create_connection(merged_options):
+    """Returns mysql connection."""
+    return MySQLdb.connect(**get_connection_options(merged_options))
+
+
+def get_time_to_threshold(state, growth_rate, threshold, now):
+    """Returns projected seconds until a column reaches threshold.
+
+    Columns which were never scanned or are already over the threshold
+    are due now. Columns which are not growing never reach it.
+    """
+    if state is None:
+        return 0
+    overflow_percentage = state['overflow_percentage']
+    if overflow_percentage >= threshold:
+        return 0
+    if not growth_rate or growth_rate <= 0:
+        return float('inf')
+    reached_at = (
+        state['timestamp'] +
+        (threshold - overflow_percentage) / growth_rate)
+    return max(reached_at - now, 0)
+
+
+class PartitionMerge(object):
+    """Merges the max values of the partitions of a table.
+
+    The partitions of a table are scanned in parallel by the workers, each
+    worker adds the max values of its partition.
+    """
+    def __init__(self, partitions):
+        self.lock = threading.Lock()
+        self.pending = partitions
+        self.row = None
+        self.failed = False
+
+    def add(self, row):
+        """Adds the max values of a partition.
+
+        Returns the max values of the table after its last partition, None
+        before or if a partition was not checked.
+        """
+        with self.lock:
+            self.pending -= 1
+            if row:
+                if self.row is None:
+                    self.row = list(row)
+                else:
+                    self.row = [
+                        value if merged is None or (
+                            value is not None and value > merged)
+                        else merged
+                        for merged, value in zip(self.row, row)]
+            if self.pending or self.failed:
+                return None
+            return tuple(self.row or ())
+
+    def fail(self):
+        """Marks the table as not checked, returns True the first time."""
+        with self.lock:
+            first = not self.failed
+            self.failed = True
+            return first
+
+
+class WorkQueue(Queue.Queue):
+    """Queue of tables, ordered by their 'priority', lowest first.
+
+    Tables with the same priority are returned in the order they were put.
+    None is the sentinel which stops a worker and is returned after all
+    tables. Each table is stamped with the time it was put as 'queued'.
+
+    host_limits is a dict of hostname to the number of its tables which
+    are processed at once. The tables of a host at its limit are held
+    back until release() is called for one of them, so that the workers
+    take the tables of the other hosts instead of waiting for a
+    connection. Each host is still scanned in priority order. With a
+    load controller, the limit of a host is lowered to the queries the
+    controller currently allows on its servers.
+    """
+    def __init__(self, maxsize=0, host_limits=None, controller=None):
+        self.host_limits = host_limits or {}
+        self.controller = controller
+        Queue.Queue.__init__(self, maxsize)
+        if controller:
+            controller.listeners.append(self.limits_changed)
+
+    def _init(self, maxsize):
+        self.counter = itertools.count()
+        # heap of (priority, counter, table) of each host
+        self.heaps = {}
+        self.tables = 0
+        self.sentinels = 0
+        # tables of each host which were returned and not released
+        self.running = {}
+
+    def has_slot(self, hostname):
+        limit = self.host_limits.get(hostname)
+        if limit is not None and self.controller:
+            allowed = self.controller.get_host_limit(hostname)
+            if allowed is not None:
+                limit = min(limit, allowed)
+        return limit is None or self.running.get(hostname, 0) < limit
+
+    def _qsize(self, len=len):
+        # the tables which can be returned, then the sentinels
+        if not self.tables:
+            return self.sentinels
+        return sum(
+            len(heap) for hostname, heap in self.heaps.iteritems()
+            if self.has_slot(hostname))
+
+    def _put(self, item, heappush=heapq.heappush):
+        if item is None:
+            self.sentinels += 1
+            return
+        item['queued'] = time.time()
+        heappush(
+            self.heaps.setdefault(item.get('hostname'), []),
+            (item.get('priority', 0), next(self.counter), item))
+        self.tables += 1
+
+    def _get(self, heappop=heapq.heappop):
+        if not self.tables:
+            self.sentinels -= 1
+            return None
+        hostname = min(
+            (heap[0], hostname) for hostname, heap in self.heaps.iteritems()
+            if heap and self.has_slot(hostname))[1]
+        self.tables -= 1
+        if hostname in self.host_limits:
+            self.running[hostname] = self.running.get(hostname, 0) + 1
+        return heappop(self.heaps[hostname])[2]
+
+    def limits_changed(self):
+        """Wakes up the workers waiting for a host whose limit grew."""
+        with self.mutex:
+            self.not_empty.notify_all()
+
+    def release(self, item):
+        """Frees the slot of the host of a table which is done."""
+        with self.mutex:
+            hostname = item.get('hostname')
+            if self.running.get(hostname):
+                self.running[hostname] -= 1
+                self.not_empty.notify()
+
+    def drain(self):
+        """Removes and returns the tables left, whatever the host limits."""
+        with self.mutex:
+            items = [
+                entry[2] for heap in self.heaps.itervalues()
+                for entry in sorted(heap)]
+            for heap in self.heaps.itervalues():
+                del heap[:]
+            self.tables = 0
+            return items
+
+
+class StateStore(object):
+    """Last observed max values of columns, stored in a SQLite file.
+
+    Used to skip columns that are far below the warning threshold until
+    they are due for a rescan, and to project when columns will reach the
+    warning threshold from their history.
+    """
+    # observations older than this are removed from the history
+    history_max_age = 90 * 86400
+
+    def __init__(self, filename):
+        self.conn = sqlite3.connect(filename)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS column_history (
+                hostname TEXT NOT NULL,
+                schema_name TEXT NOT NULL,
+                table_name TEXT NOT NULL,
+                column_name TEXT NOT NULL,
+                overflow_percentage REAL,
+                timestamp REAL
+            )
+            """)
+        self.conn.execute("""
+            CREATE INDEX IF NOT EXISTS column_history_column
+            ON column_history (
+                hostname, schema_name, table_name, column_name, timestamp)
+            """)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS column_state (
+                hostname TEXT NOT NULL,
+                schema_name TEXT NOT NULL,
+                table_name TEXT NOT NULL,
+                column_name TEXT NOT NULL,
+                max_value TEXT,
+                overflow_percentage REAL,
+                row_count INTEGER,
+                timestamp REAL,
+                PRIMARY KEY (hostname, schema_name, table_name, column_name)
+            )
+            """)
+
+    def get_column_states(self, hostname):
+        """Returns dict of 'schema.table.column' to last observed state."""
+        column_states = {}
+        cur = self.conn.execute("""
+            SELECT
+                schema_name, table_name, column_name, max_value,
+                overflow_percentage, row_count, timestamp
+            FROM column_state
+            WHERE hostname = ?
+            """, (hostname,))
+        for row in cur:
+            column_states['%s.%s.%s' % (row[0], row[1], row[2])] = dict(
+                max_value=int(row[3]) if row[3] is not None else None,
+                overflow_percentage=row[4],
+                row_count=row[5],
+                timestamp=row[6])
+        return column_states
+
+    def get_growth_rates(self, hostname):
+        """Returns dict of 'schema.table.column' to growth rate.
+
+        The growth rate is the least squares slope of the overflow
+        percentage over time, in percent per second. The sums of the fit
+        are computed by SQLite, so the history is not loaded. Times are
+        relative to now, so that their squares keep their precision.
+        """
+        growth_rates = {}
+        cur = self.conn.execute("""
+            SELECT
+                schema_name, table_name, column_name, COUNT(*), SUM(t),
+                SUM(p), SUM(t * p), SUM(t * t)
+            FROM (
+                SELECT
+                    schema_name, table_name, column_name,
+                    timestamp - ? AS t, overflow_percentage AS p
+                FROM column_history
+                WHERE hostname = ? AND overflow_percentage IS NOT NULL
+            )
+            GROUP BY schema_name, table_name, column_name
+            HAVING COUNT(*) >= 2 AND MIN(t) < MAX(t)
+            """, (time.time(), hostname))
+        for schema, table, column, n, sum_t, sum_p, sum_tp, sum_tt in cur:
+            variance = n * sum_tt - sum_t * sum_t
+            if variance <= 0:
+                continue
+            growth_rates['%s.%s.%s' % (schema, table, column)] = (
+                (n * sum_tp - sum_t * sum_p) / variance)
+        return growth_rates
+
+    def get_due_schema_tables(
+            self, schema_tables, column_states, growth_rates, merged_options):
+        """Returns schema tables without the columns that are not due.
+
+        A column is not due if its last overflow percentage is below
+        state_headroom percent of the warning threshold, it was scanned
+        less than state_rescan_interval seconds ago, the row count of
+        the table has not grown by more than state_row_growth percent and
+        it is not projected to reach the warning threshold before the next
+        rescan.
+        """
+        headroom_percentage = (
+            merged_options['warning'] *
+            merged_options['state_headroom'] / 100.0)
+        rescan_interval = merged_options['state_rescan_interval']
+        row_growth = merged_options['state_row_growth']
+        now = time.time()
+
+        due_schema_tables = {}
+        for schema_table, v in schema_tables.iteritems():
+            row_count = v['row_count'] or 0
+            columns = []
+            for column in v['columns']:
+                key = '%s.%s' % (schema_table, column['column_name'])
+                state = column_states.get(key)
+                if (
+                        state and
+                        state['overflow_percentage'] < headroom_percentage and
+                        now - state['timestamp'] < rescan_interval and
+                        row_count <= (state['row_count'] or 0) * (
+                            1 + row_growth / 100.0) and
+                        get_time_to_threshold(
+                            state, growth_rates.get(key),
+                            merged_options['warning'], now) > rescan_interval):
+                    log.debug(
+                        'Column not due: %s.%s, last overflow_percentage=%s',
+                        schema_table, column['column_name'],
+                        state['overflow_percentage'])
+                else:
+                    columns.append(column)
+            if columns:
+                due_schema_tables[schema_table] = dict(v, columns=columns)
+        return due_schema_tables
+
+    def save_column_states(self, scanned_columns):
+        """Stores the observed max values of scanned columns."""
+        now = time.time()
+        with self.conn:
+            self.conn.executemany("""
+                INSERT OR REPLACE INTO column_state (
+                    hostname, schema_name, table_name, column_name,
+                    max_value, overflow_percentage, row_count, timestamp)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                """, [(
+                    col['hostname'], col['schema'], col['table'],
+                    col['column_name'], str(col['max_value']),
+                    col['overflow_percentage'], col['row_count'], now)
+                    for col in scanned_columns])
+            self.conn.executemany("""
+                INSERT INTO column_history (
+                    hostname, schema_name, table_name, column_name,
+                    overflow_percentage, timestamp)
+                VALUES (?, ?, ?, ?, ?, ?)
+                """, [(
+                    col['hostname'], col['schema'], col['table'],
+                    col['column_name'], col['overflow_percentage'], now)
+                    for col in scanned_columns])
+            self.conn.execute("""
+                DELETE FROM column_history WHERE timestamp < ?
+                """, (now - self.history_max_age,))
+
+    def close(self):
+        self.conn.close()
+
+
+def encode_strings(value):
+    """Returns a value loaded from JSON with its strings as UTF-8 str.
+
+    json returns unicode strings, while MySQLdb returns str, which do not
+    compare equal once they are not ASCII.
+    """
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, list):
+        return [encode_strings(v) for v in value]
+    if isinstance(value, dict):
+        return dict(
+            (encode_strings(k), encode_strings(v))
+            for k, v in value.iteritems())
+    return value
+
+
+class MetadataCache(object):
+    """Computed schema tables of each host, stored in a SQLite file.
+
+    An entry is used while the fingerprint of the tables and their columns
+    is unchanged and it is not older than ttl seconds. A connection is
+    opened for each call since hosts are discovered by several threads.
+    """
+    def __init__(self, filename, ttl):
+        self.filename = filename
+        self.ttl = ttl
+        conn = self.connect()
+        try:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS schema_metadata (
+                    cache_key TEXT PRIMARY KEY,
+                    fingerprint TEXT,
+                    schema_tables TEXT,
+                    timestamp REAL
+                )
+                """)
+        finally:
+            conn.close()
+
+    def connect(self):
+        return sqlite3.connect(self.filename, timeout=60)
+
+    def get(self, cache_key, fingerprint):
+        """Returns the cached schema tables or None."""
+        conn = self.connect()
+        try:
+            row = conn.execute("""
+                SELECT fingerprint, schema_tables, timestamp
+                FROM schema_metadata
+                WHERE cache_key = ?
+                """, (cache_key,)).fetchone()
+        finally:
+            conn.close()
+        if row is None:
+            return None
+        if row[0] != fingerprint:
+            log.debug('Metadata cache of %s is invalid.', cache_key)
+            return None
+        if row[2] < time.time() - self.ttl:
+            log.debug('Metadata cache of %s expired.', cache_key)
+            return None
+        return encode_strings(json.loads(row[1]))
+
+    def put(self, cache_key, fingerprint, schema_tables):
+        conn = self.connect()
+        try:
+            with conn:
+                conn.execute("""
+                    INSERT OR REPLACE INTO schema_metadata (
+                        cache_key, fingerprint, schema_tables, timestamp)
+                    VALUES (?, ?, ?, ?)
+                    """, (
+                        cache_key, fingerprint, json.dumps(schema_tables),
+                        time.time()))
+        finally:
+            conn.close()
+
+
+class ResultsWriter(object):
+    """Writes flagged columns to int_overflow_check_results.
+
+    All rows of a run are written over one connection in one transaction,
+    using executemany() batches of batch_size rows, and are stamped with
+    the same run_id and timestamp. In background mode, a thread writes
+    the rows as they are added so that writes overlap with scanning.
+    """
+    sql = (
+        "INSERT INTO int_overflow_check_results("
+        "  hostname, dbname, table_name, column_name, "
+        "  max_size, percentage, reason, timestamp, run_id) "
+        "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)")
+    # results tables created before run_id was added
+    sql_without_run_id = (
+        "INSERT INTO int_overflow_check_results("
+        "  hostname, dbname, table_name, column_name, "
+        "  max_size, percentage, reason, timestamp) "
+        "VALUES (%s, %s, %s, %s, %s, %s, %s, %s)")
+
+    def __init__(
+            self, pool, connection_options, batch_size=1000,
+            background=False):
+        self.pool = pool
+        self.connection_options = connection_options
+        self.batch_size = batch_size
+        self.run_id = uuid.uuid4().hex
+        self.timestamp = datetime.datetime.now()
+        self.rows = []
+        self.error = None
+        self.commit = True
+        self.thread = None
+        if background:
+            self.queue = Queue.Queue()
+            self.thread = threading.Thread(target=self.run)
+            self.thread.name = 'Results writer'
+            self.thread.daemon = True
+            self.thread.start()
+
+    def add(self, reason, col):
+        """Adds a flagged column."""
+        row = (
+            col.get('hostname'), col.get('schema'),
+            col.get('table'),
+            col.get('column_name'),
+            col.get('max_value'),
+            col.get('overflow_percentage'),
+            reason, self.timestamp, self.run_id)
+        if self.thread:
+            self.queue.put(row)
+        else:
+            self.rows.append(row)
+
+    def get_insert(self, cursor):
+        """Returns the INSERT of the results table and its number of fields.
+
+        A results table without the run_id column is written without it.
+        """
+        cursor.execute(
+            "SHOW COLUMNS FROM int_overflow_check_results LIKE 'run_id'")
+        if cursor.fetchall():
+            return self.sql, 9
+        log.warning(
+            'int_overflow_check_results has no run_id column, rows are '
+            'written without it. See the README to upgrade the table.')
+        return self.sql_without_run_id, 8
+
+    def run(self):
+        """Writes rows from the queue until close() is called."""
+        conn = None
+        closed = False
+        try:
+            conn = self.pool.connect(self.connection_options)
+            cursor = conn.cursor()
+            sql, fields = self.get_insert(cursor)
+            rows = []
+            while True:
+                row = self.queue.get()
+                if row is None:
+                    closed = True
+                if row is None or len(rows) >= self.batch_size:
+                    if rows:
+                        cursor.executemany(sql, rows)
+                    rows = []
+                if row is None:
+                    break
+                rows.append(row[:fields])
+            if self.commit:
+                conn.commit()
+            else:
+                conn.rollback()
+            cursor.close()
+        except Exception, e:
+            log.exception('[%s] Exception.' % (self.thread.name,))
+            self.error = e
+            if not closed:
+                # drain the queue so that close() does not wait forever
+                while self.queue.get() is not None:
+                    pass
+        finally:
+            if conn:
+                conn.close()
+
+    def close(self, commit=True):
+        """Writes the remaining rows and commits the transaction.
+
+        If commit is false, the rows are discarded.
+        """
+        if self.thread:
+            self.commit = commit
+            self.queue.put(None)
+            self.thread.join()
+            if self.error and commit:
+                raise self.error
+            return
+
+        if not commit or not self.rows:
+            return
+        conn = self.pool.connect(self.connection_options)
+        try:
+            cursor = conn.cursor()
+            try:
+                sql, fields = self.get_insert(cursor)
+                for i in range(0, len(self.rows), self.batch_size):
+                    cursor.executemany(sql, [
+                        row[:fields]
+                        for row in self.rows[i:i + self.batch_size]])
+                conn.commit()
+            finally:
+                cursor.close()
+        finally:
+            conn.close()
+
+
+class ResultCollector(object):
+    """Collects the results of the worker threads by category.
+
+    Flagged columns are also added to results_writer, if set, and written
+    to stream as JSON lines, if set. Scanned columns are saved to
+    state_store in batches, if set, instead of being kept in memory.
+    """
+    # number of scanned columns saved to the state store at once
+    state_batch_size = 1000
+
+    def __init__(self, results_writer=None, state_store=None, stream=None):
+        self.results_writer = results_writer
+        self.state_store = state_store
+        self.stream = stream
+        self.critical_columns = []
+        self.warning_columns = []
+        self.investigate_columns = []
+        self.errors = []
+        self.scanned_columns = []
+        self.unchecked_columns = []
+        self.table_times = []
+        self.thread_stats = []
+
+    def add(self, result):
+        if 'critical_column' in result:
+            self.critical_columns.append(result['critical_column'])
+            if self.results_writer:
+                self.results_writer.add(
+                    'critical', result['critical_column'])
+            self.write_stream('critical', result['critical_column'])
+
+        if 'warning_column' in result:
+            self.warning_columns.append(result['warning_column'])
+            if self.results_writer:
+                self.results_writer.add('warning', result['warning_column'])
+            self.write_stream('warning', result['warning_column'])
+
+        if 'error' in result:
+            self.errors.append(result['error'])
+
+        if 'unchecked_column' in result:
+            self.unchecked_columns.append(result['unchecked_column'])
+
+        if 'table_time' in result:
+            self.table_times.append(result['table_time'])
+
+        if 'thread_stats' in result:
+            self.thread_stats.append(result['thread_stats'])
+
+        if 'investigate_column' in result:
+            self.investigate_columns.append(result['investigate_column'])
+            if self.results_writer:
+                self.results_writer.add(
+                    'investigate', result['investigate_column'])
+            self.write_stream(
+                'investigate', result['investigate_column'])
+
+        if 'scanned_column' in result:
+            self.scanned_columns.append(result['scanned_column'])
+            if len(self.scanned_columns) >= self.state_batch_size:
+                self.flush()
+
+    # results may be classified directly into the collector
+    put = add
+
+    def write_stream(self, reason, col):
+        """Writes a flagged column to the stream as a JSON line."""
+        if self.stream:
+            line = dict(col, reason=reason)
+            self.stream.write(json.dumps(line, default=str) + '\n')
+            self.stream.flush()
+
+    def flush(self):
+        """Saves the pending scanned columns to the state store."""
+        if self.state_store and self.scanned_columns:
+            self.state_store.save_column_states(self.scanned_columns)
+        self.scanned_columns = []
+
+
+class StatusCache(object):
+    """Latest status and flagged columns of a daemon, shared with its server.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.status = None
+
+    def update(self, response, flagged_columns, metrics, started):
+        """Stores the response, columns and metrics of a finished run.
+
+        flagged_columns is a dict of lists of columns by reason, None if
+        the run failed, in which case the columns of the previous run are
+        kept.
+        """
+        with self.lock:
+            columns = self.status['columns'] if self.status else []
+            if flagged_columns is not None:
+                columns = [
+                    dict(col, reason=reason)
+                    for reason, reason_columns in sorted(
+                        flagged_columns.iteritems())
+                    for col in reason_columns]
+            self.status = dict(
+                status=response.status.name,
+                exit_code=response.status.exit_code,
+                message=response.message,
+                started=started,
+                finished=time.time(),
+                columns=columns,
+                metrics=metrics)
+
+    def get(self):
+        """Returns the latest status with its age in seconds, None if none."""
+        with self.lock:
+            if self.status is None:
+                return None
+            return dict(self.status, age=time.time() - self.status['finished'])
+
+
+class StatusRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves the StatusCache of the server.
+
+    /status is the latest status as JSON, /metrics its metrics in the
+    Prometheus text format. Both are 503 until the first run is done.
+    """
+    def do_GET(self):
+        path = self.path.split('?', 1)[0].rstrip('/')
+        if path not in ('/status', '/metrics'):
+            return self.reply(404, 'text/plain', 'Not found.\n')
+        status = self.server.cache.get()
+        if status is None:
+            return self.reply(
+                503, 'application/json',
+                json.dumps(dict(error='No run has finished yet.')))
+        if path == '/metrics':
+            if not status['metrics']:
+                return self.reply(503, 'text/plain', 'No metrics.\n')
+            return self.reply(
+                200, 'text/plain; version=0.0.4',
+                format_prometheus_metrics(status['metrics']))
+        return self.reply(
+            200, 'application/json', json.dumps(status, default=str))
+
+    def reply(self, code, content_type, body):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug('%s - %s' % (self.address_string(), format % args))
+
+
+class StatusServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """HTTP server of the status of a daemon."""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, cache):
+        BaseHTTPServer.HTTPServer.__init__(
+            self, address, StatusRequestHandler)
+        self.cache = cache
+
+
+class PooledConnection(object):
+    """A connection borrowed from ConnectionPool.
+
+    Closing it returns the connection to the pool.
+    """
+    def __init__(self, pool, key, conn):
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __enter__(self):
+        return self._conn.__enter__()
+
+    def __exit__(self, *args):
+        return self._conn.__exit__(*args)
+
+    def close(self):
+        if self._conn is not None:
+            self._pool.release(self._key, self._conn)
+            self._conn = None
+
+
+class ConnectionPool(object):
+    """Thread-safe pool of mysql connections.
+
+    Connections are reused across tables, checked with ping() before they
+    are handed out and replaced by a new connection when broken. At most
+    max_connections are open to each server.
+    """
+    def __init__(self, max_connections=None):
+        self.max_connections = max_connections
+        self.condition = threading.Condition()
+        self.idle_connections = {}
+        self.open_connections = {}
+        # new connections and the time spent opening them
+        self.connections = 0
+        self.connect_seconds = 0
+
+    def connect(self, connection_options, max_connections=None):
+        """Returns a connection to the server in connection_options.
+
+        max_connections overrides the limit of the pool for this server.
+        """
+        key = tuple(sorted(connection_options.iteritems()))
+        if max_connections is None:
+            max_connections = self.max_connections
+        conn = None
+        with self.condition:
+            while True:
+                idle_connections = self.idle_connections.setdefault(key, [])
+                if idle_connections:
+                    conn = idle_connections.pop()
+                    break
+                open_connections = self.open_connections.get(key, 0)
+                if (
+                        max_connections is None or
+                        open_connections < max_connections):
+                    self.open_connections[key] = open_connections + 1
+                    break
+                self.condition.wait()
+
+        if conn is not None:
+            try:
+                conn.ping()
+            except MySQLdb.Error:
+                log.debug(
+                    'Reconnecting to %s, ping failed.',
+                    connection_options.get('host'))
+                try:
+                    conn.close()
+                except MySQLdb.Error:
+                    pass
+                conn = None
+
+        if conn is None:
+            connecting = time.time()
+            try:
+                conn = MySQLdb.connect(**connection_options)
+            except:
+                with self.condition:
+                    self.open_connections[key] -= 1
+                    self.condition.notify()
+                raise
+            with self.condition:
+                self.connections += 1
+                self.connect_seconds += time.time() - connecting
+
+        return PooledConnection(self, key, conn)
+
+    def release(self, key, conn):
+        """Returns a connection to the pool."""
+        try:
+            # end the transaction so the next query does not read
+            # from an old snapshot
+            conn.rollback()
+        except MySQLdb.Error:
+            self.discard(key, conn)
+            return
+        with self.condition:
+            self.idle_connections.setdefault(key, []).append(conn)
+            self.condition.notify()
+
+    def discard(self, key, conn):
+        """Closes a connection which can no longer be used."""
+        try:
+            conn.close()
+        except MySQLdb.Error:
+            pass
+        with self.condition:
+            self.open_connections[key] -= 1
+            self.condition.notify()
+
+    def close(self):
+        """Closes all idle connections."""
+        with self.condition:
+            for key, idle_connections in self.idle_connections.iteritems():
+                for conn in idle_connections:
+                    try:
+                        conn.close()
+                    except MySQLdb.Error:
+                        pass
+                    self.open_connections[key] -= 1
+            self.idle_connections = {}
 
 
 class CheckMaxValue(Plugin):
     """A nagios plugin for checking Integer Overflow"""
 
+    # set while check() is run by the daemon
+    daemon_running = False
+
     port = make_option(
         '-P', '--port', dest='port', type='int', default=3306,
         help='The port to be used')
@@ -375,6 +2282,261 @@ class CheckMaxValue(Plugin):
         default=False
     )
 
+    auto_increment_metadata = make_option(
+        '--auto-increment-metadata',
+        action='store_true',
+        help='Auto-increment columns are checked using the AUTO_INCREMENT value in INFORMATION_SCHEMA.TABLES instead of scanning the table.',
+        default=False
+    )
+
+    max_scan_size = make_option(
+        '--max-scan-size',
+        type=int,
+        default=None,
+        help='Columns which need a full table scan are skipped if the table data length is over this size in MB.'
+    )
+
+    dry_run = make_option(
+        '--dry-run',
+        action='store_true',
+        help='Display the query plan, EXPLAIN output and estimated rows examined without running the MAX queries.',
+        default=False
+    )
+
+    max_connections = make_option(
+        '--max-connections',
+        type=int,
+        default=None,
+        help='Maximum number of connections to each server. Defaults to the number of threads.'
+    )
+
+    state_file = make_option(
+        '--state-file',
+        default=None,
+        help='SQLite file where the last observed max value of each column is stored. Columns far below the warning threshold are not rescanned on every run.'
+    )
+
+    state_rescan_interval = make_option(
+        '--state-rescan-interval',
+        type=int,
+        default=86400,
+        help='Seconds after which a column below --state-headroom is rescanned.'
+    )
+
+    state_headroom = make_option(
+        '--state-headroom',
+        type=float,
+        default=50,
+        help='Columns whose last overflow percentage is below this percentage of the warning threshold are skipped until they are due for a rescan.'
+    )
+
+    state_row_growth = make_option(
+        '--state-row-growth',
+        type=float,
+        default=10,
+        help='Columns are rescanned when the table row count has grown by more than this percentage since the last scan.'
+    )
+
+    budget = make_option(
+        '--budget',
+        type=int,
+        default=None,
+        help='Maximum number of columns scanned in a run. Columns projected to reach the warning threshold soonest are scanned first. Requires --state-file.'
+    )
+
+    fleet_output_dir = make_option(
+        '--fleet-output-dir',
+        default=None,
+        help='In fleet mode, directory where the Nagios output of each host is written.'
+    )
+
+    engine = make_option(
+        '--engine',
+        type='choice',
+        choices=['threads', 'async'],
+        default='threads',
+        help='Scan engine: threads runs one query per thread, async keeps up to --async-queries queries in flight with greenlets (requires gevent and PyMySQL).'
+    )
+
+    async_queries = make_option(
+        '--async-queries',
+        type=int,
+        default=100,
+        help='Maximum number of queries in flight with the async engine.'
+    )
+
+    results_batch_size = make_option(
+        '--results-batch-size',
+        type=int,
+        default=1000,
+        help='Number of rows inserted by each statement in the results database.'
+    )
+
+    results_writer_thread = make_option(
+        '--results-writer-thread',
+        action='store_true',
+        help='Write results to the results database in a background thread while tables are scanned.',
+        default=False
+    )
+
+    fail_fast = make_option(
+        '--fail-fast',
+        action='store_true',
+        help='Stop scanning and return CRITICAL as soon as a critical column is found.',
+        default=False
+    )
+
+    stream_output = make_option(
+        '--stream-output',
+        default=None,
+        help='File where each flagged column is written as a JSON line as soon as it is found. Use - for stdout.'
+    )
+
+    metadata_cache = make_option(
+        '--metadata-cache',
+        default=None,
+        help='SQLite file where the columns and indexes of each host are cached. The cache is used until a table is created, dropped or rebuilt, a column is changed, or it is older than --metadata-cache-ttl.'
+    )
+
+    metadata_cache_ttl = make_option(
+        '--metadata-cache-ttl',
+        type=int,
+        default=86400,
+        help='Seconds after which the cached columns and indexes of a host are refreshed.'
+    )
+
+    deadline = make_option(
+        '--deadline',
+        type=float,
+        default=None,
+        help='Seconds after which the check stops, kills the queries in flight and reports the results collected so far.'
+    )
+
+    query_timeout = make_option(
+        '--query-timeout',
+        type=float,
+        default=None,
+        help='Seconds after which a MAX query is killed and its columns are reported as not checked.'
+    )
+
+    replicas = make_option(
+        '--replicas',
+        default=None,
+        help='A comma-separated list of replicas (host or host:port) which run the MAX queries. Metadata is still read from --hostname.'
+    )
+
+    max_replica_lag = make_option(
+        '--max-replica-lag',
+        type=int,
+        default=60,
+        help='Replicas lagging more than this many seconds are not used.'
+    )
+
+    max_threads_running = make_option(
+        '--max-threads-running',
+        type=int,
+        default=None,
+        help='Fewer queries run concurrently on a server whose Threads_running is over this value.'
+    )
+
+    max_buffer_pool_reads = make_option(
+        '--max-buffer-pool-reads',
+        type=int,
+        default=None,
+        help='Fewer queries run concurrently on a server whose Innodb_buffer_pool_reads per second is over this value.'
+    )
+
+    max_rows_per_second = make_option(
+        '--max-rows-per-second',
+        type=int,
+        default=None,
+        help='Maximum estimated rows examined per second on each server.'
+    )
+
+    daemon = make_option(
+        '--daemon',
+        action='store_true',
+        default=False,
+        help='Run the check every --daemon-interval seconds and serve the latest status over HTTP on --daemon-listen.'
+    )
+
+    daemon_interval = make_option(
+        '--daemon-interval',
+        type=int,
+        default=300,
+        help='Seconds between the starts of two runs of the daemon.'
+    )
+
+    daemon_listen = make_option(
+        '--daemon-listen',
+        default='127.0.0.1:8765',
+        help='Address (host:port) where the daemon serves its status.'
+    )
+
+    daemon_url = make_option(
+        '--daemon-url',
+        default=None,
+        help='URL of a daemon, for example http://127.0.0.1:8765. The status cached by the daemon is returned instead of checking the server.'
+    )
+
+    daemon_max_age = make_option(
+        '--daemon-max-age',
+        type=int,
+        default=None,
+        help='With --daemon-url, return UNKNOWN if the cached status is older than this many seconds.'
+    )
+
+    dump = make_option(
+        '--dump',
+        default=None,
+        help='A comma-separated list of mysqldump files and mysqldump --tab directories, optionally gzipped, which are checked instead of the server.'
+    )
+
+    dump_processes = make_option(
+        '--dump-processes',
+        type=int,
+        default=1,
+        help='Number of processes which scan the dump files.'
+    )
+
+    metrics_file = make_option(
+        '--metrics-file',
+        default=None,
+        help='File where a JSON summary of the timings of the run is written.'
+    )
+
+    prometheus_file = make_option(
+        '--prometheus-file',
+        default=None,
+        help='File where the timings of the run are written in the Prometheus text format, for the node_exporter textfile collector.'
+    )
+
+    metrics_top = make_option(
+        '--metrics-top',
+        type=int,
+        default=10,
+        help='Number of slowest tables in the metrics.'
+    )
+
+    stream_metadata = make_option(
+        '--stream-metadata',
+        action='store_true',
+        default=False,
+        help='Scan tables while the metadata is still being read, instead of reading the metadata of all tables first.'
+    )
+
+    shard = make_option(
+        '--shard',
+        default=None,
+        help='Check only the tables of shard i of N, given as i/N. Tables are assigned to shards by a hash of schema.table.'
+    )
+
+    shard_file = make_option(
+        '--shard-file',
+        default=None,
+        help='File where the result of the run is written for the merge command, instead of writing to the results database.'
+    )
+
     def get_options_from_config_file(self):
         """Returns options from YAML file."""
         if self.options.config:
@@ -421,9 +2583,69 @@ class CheckMaxValue(Plugin):
             options['results_password'] = self.options.results_password
         if self.options.results_port:
             options['results_port'] = self.options.results_port
+        options['results_batch_size'] = self.options.results_batch_size
+        options['results_writer_thread'] = self.options.results_writer_thread
 
         options['scan_all_columns'] = self.options.scan_all_columns
         options['secondary_keys'] = self.options.secondary_keys
+        options['auto_increment_metadata'] = (
+            self.options.auto_increment_metadata)
+        if self.options.max_scan_size is not None:
+            options['max_scan_size'] = self.options.max_scan_size
+        options['dry_run'] = self.options.dry_run
+        if self.options.max_connections:
+            options['max_connections'] = self.options.max_connections
+        if self.options.state_file:
+            options['state_file'] = self.options.state_file
+        options['state_rescan_interval'] = self.options.state_rescan_interval
+        options['state_headroom'] = self.options.state_headroom
+        options['state_row_growth'] = self.options.state_row_growth
+        if self.options.budget is not None:
+            options['budget'] = self.options.budget
+        if self.options.fleet_output_dir:
+            options['fleet_output_dir'] = self.options.fleet_output_dir
+        options['engine'] = self.options.engine
+        options['async_queries'] = self.options.async_queries
+        options['fail_fast'] = self.options.fail_fast
+        if self.options.metadata_cache:
+            options['metadata_cache'] = self.options.metadata_cache
+        options['metadata_cache_ttl'] = self.options.metadata_cache_ttl
+        if self.options.deadline:
+            options['deadline'] = self.options.deadline
+        if self.options.query_timeout:
+            options['query_timeout'] = self.options.query_timeout
+        if self.options.replicas:
+            options['replicas'] = self.options.replicas
+        options['max_replica_lag'] = self.options.max_replica_lag
+        if self.options.max_threads_running:
+            options['max_threads_running'] = self.options.max_threads_running
+        if self.options.max_buffer_pool_reads:
+            options['max_buffer_pool_reads'] = (
+                self.options.max_buffer_pool_reads)
+        if self.options.max_rows_per_second:
+            options['max_rows_per_second'] = self.options.max_rows_per_second
+        if self.options.stream_output:
+            options['stream_output'] = self.options.stream_output
+        options['daemon'] = self.options.daemon
+        options['daemon_interval'] = self.options.daemon_interval
+        options['daemon_listen'] = self.options.daemon_listen
+        if self.options.daemon_url:
+            options['daemon_url'] = self.options.daemon_url
+        if self.options.daemon_max_age:
+            options['daemon_max_age'] = self.options.daemon_max_age
+        if self.options.dump:
+            options['dump'] = self.options.dump
+        options['dump_processes'] = self.options.dump_processes
+        if self.options.metrics_file:
+            options['metrics_file'] = self.options.metrics_file
+        if self.options.prometheus_file:
+            options['prometheus_file'] = self.options.prometheus_file
+        options['metrics_top'] = self.options.metrics_top
+        options['stream_metadata'] = self.options.stream_metadata
+        if self.options.shard:
+            options['shard'] = self.options.shard
+        if self.options.shard_file:
+            options['shard_file'] = self.options.shard_file
 
         if additional_options:
             options.update(additional_options)
@@ -462,7 +2684,12 @@ class CheckMaxValue(Plugin):
         merged_options['critical'] = critical
         merged_options['warning'] = warning
 
-        # fix string versions of ignore_dbs, use_dbs, exclude_columns
+        self.normalize_options(merged_options)
+
+        self.merged_options = merged_options
+
+    def normalize_options(self, merged_options):
+        """Fixes string versions of list and dict options."""
         if 'ignore_dbs' in merged_options:
             ignore_dbs = merged_options['ignore_dbs']
             if ignore_dbs and isinstance(ignore_dbs, basestring):
@@ -477,6 +2704,25 @@ class CheckMaxValue(Plugin):
                 use_dbs = use_dbs.strip()
                 if use_dbs:
                     merged_options['use_dbs'] = use_dbs.split(',')
+        if 'replicas' in merged_options:
+            replicas = merged_options['replicas']
+            if replicas and isinstance(replicas, basestring):
+                # convert string to list
+                replicas = replicas.strip()
+                if replicas:
+                    merged_options['replicas'] = replicas.split(',')
+        if 'dump' in merged_options:
+            dump = merged_options['dump']
+            if dump and isinstance(dump, basestring):
+                # convert string to list
+                dump = dump.strip()
+                if dump:
+                    merged_options['dump'] = dump.split(',')
+        if 'shard' in merged_options:
+            shard = merged_options['shard']
+            if shard and isinstance(shard, basestring):
+                # convert string to (index, count)
+                merged_options['shard'] = parse_shard(shard.strip())
         if 'exclude_columns' in merged_options:
             exclude_columns = merged_options['exclude_columns']
             if exclude_columns and isinstance(exclude_columns, basestring):
@@ -486,131 +2732,720 @@ class CheckMaxValue(Plugin):
                     merged_options['exclude_columns'] = (
                         self.create_exclude_columns_dict(exclude_columns))
 
-        self.merged_options = merged_options
+    def get_targets(self):
+        """Returns the options of each host to be checked.
 
-    def get_schema_tables(self):
+        In fleet mode, each item of 'hosts' in the configuration file is
+        either a hostname or a dict of options which override the global
+        options for that host. 'threads' of a host limits its concurrent
+        queries and defaults to host_threads.
+        """
         merged_options = self.merged_options
-
+        if not merged_options.get('hosts'):
+            return [merged_options]
+
+        targets = []
+        for host in merged_options['hosts']:
+            if isinstance(host, basestring):
+                host = dict(hostname=host)
+            options = dict(merged_options)
+            del options['hosts']
+            options['threads'] = (
+                merged_options.get('host_threads') or
+                merged_options['threads'])
+            options.update(host)
+            options['max_connections'] = options['threads']
+            self.normalize_options(options)
+            targets.append(options)
+        return targets
+
+    def get_metadata_query(self, merged_options):
+        """Returns the query of the integer columns of a host and its args."""
+        # only the index which a column leads is joined, MAX() of that
+        # column is a single index lookup
         query = """
             SELECT
                 c.TABLE_SCHEMA, c.TABLE_NAME, c.COLUMN_NAME, c.COLUMN_TYPE,
-                t.TABLE_ROWS, c.COLUMN_KEY, s.SEQ_IN_INDEX
+                t.TABLE_ROWS, c.COLUMN_KEY, s.SEQ_IN_INDEX,
+                t.AUTO_INCREMENT, c.EXTRA, t.DATA_LENGTH, t.CREATE_OPTIONS
             FROM INFORMATION_SCHEMA.COLUMNS c
             LEFT JOIN INFORMATION_SCHEMA.TABLES t
             ON c.TABLE_SCHEMA = t.TABLE_SCHEMA AND c.TABLE_NAME = t.TABLE_NAME
             LEFT JOIN INFORMATION_SCHEMA.STATISTICS s
             ON c.TABLE_SCHEMA = s.TABLE_SCHEMA AND c.TABLE_NAME = s.TABLE_NAME AND c.COLUMN_NAME = s.COLUMN_NAME
-            WHERE c.COLUMN_TYPE LIKE '%int%'
+            AND s.SEQ_IN_INDEX = 1
+            WHERE c.COLUMN_TYPE LIKE '%%int%%'
         """
+        args = []
 
-        if 'use_dbs' in merged_options:
-            # set comma separated schema names enclosed in single-quotes
-            use_dbs = ','.join(
-                "'%s'" % (db,) for db in merged_options['use_dbs'])
-            if use_dbs:
+        if not merged_options['scan_all_columns']:
+            if merged_options['secondary_keys']:
+                # primary keys and columns which lead an index
                 query += """
-                    AND c.TABLE_SCHEMA IN (%s)
-                    """ % (use_dbs,)
-
-        if 'ignore_dbs' in merged_options:
-            # set comma separated schema names enclosed in single-quotes
-            ignore_dbs = ','.join(
-                "'%s'" % (db,) for db in merged_options['ignore_dbs'])
-            if ignore_dbs:
+                    AND (c.COLUMN_KEY = 'PRI' OR s.SEQ_IN_INDEX = 1)
+                    """
+            else:
                 query += """
-                    AND c.TABLE_SCHEMA NOT IN (%s)
-                    """ % (ignore_dbs,)
+                    AND c.COLUMN_KEY = 'PRI'
+                    """
+
+        schema_filter, schema_args = self.get_schema_filter(
+            'c.TABLE_SCHEMA', merged_options)
+        query += schema_filter
+        args.extend(schema_args)
+
+        exclude_columns = []
+        for schema_table, columns in (
+                merged_options.get('exclude_columns') or {}).iteritems():
+            schema, table = schema_table.split('.', 1)
+            for column in columns:
+                exclude_columns.append((schema, table, column))
+        if exclude_columns:
+            query += """
+                AND (c.TABLE_SCHEMA, c.TABLE_NAME, c.COLUMN_NAME) NOT IN (%s)
+                """ % (','.join(['(%s,%s,%s)'] * len(exclude_columns)),)
+            for excluded in exclude_columns:
+                args.extend(excluded)
+        return query, args
+
+    def prepare_metadata_connection(self, conn, merged_options):
+        if merged_options.get('auto_increment_metadata'):
+            # MySQL 8.0 caches table statistics, make sure that
+            # AUTO_INCREMENT values are current
+            try:
+                fetchone(
+                    conn, 'SET SESSION information_schema_stats_expiry = 0')
+            except MySQLdb.OperationalError:
+                # variable is not available in this server version
+                pass
+
+    def watch_metadata_connection(self, conn, connection_options):
+        """Registers the metadata queries of a host with the watchdog.
+
+        The deadline also bounds the discovery of the tables, the query
+        timeout only applies to MAX queries. Returns the token, None
+        without a watchdog.
+        """
+        if not self.watchdog:
+            return None
+        return self.watchdog.register(
+            connection_options, conn.thread_id(), timeout=False)
+
+    def raise_killed_metadata(self, token, hostname):
+        """Raises MetadataKilled if the metadata query was killed."""
+        if token is None:
+            return
+        reason = self.watchdog.unregister(token)
+        if reason:
+            raise MetadataKilled(hostname, reason)
+
+    def get_schema_tables(self, merged_options=None):
+        if merged_options is None:
+            merged_options = self.merged_options
+        hostname = get_host_tag(merged_options)
+        query, args = self.get_metadata_query(merged_options)
 
-        conn = create_connection(merged_options)
+        connection_options = get_connection_options(merged_options)
+        conn = self.pool.connect(connection_options)
+        token = self.watch_metadata_connection(conn, connection_options)
         try:
-            log.debug('%s' % (query,))
-            rows = fetchall(conn, query)
-            log.debug('len(rows)=%s' % (len(rows),))
-            log.debug(pprint.pformat(rows))
-
-            if 'exclude_columns' in self.merged_options:
-                exclude_columns = self.merged_options['exclude_columns']
-            else:
-                exclude_columns = None
+            self.prepare_metadata_connection(conn, merged_options)
+
+            cache_key = fingerprint = table_stats = None
+            if self.metadata_cache:
+                cache_key, fingerprint, table_stats = (
+                    self.get_metadata_fingerprint(conn, merged_options))
+                schema_tables = self.metadata_cache.get(
+                    cache_key, fingerprint)
+                if schema_tables is not None:
+                    log.debug('Using cached metadata of %s.', cache_key)
+                    self.refresh_table_stats(schema_tables, table_stats)
+                    self.add_partitions(conn, schema_tables)
+                    return schema_tables
+
+            log.debug('%s\n%s', query, args)
+            rows = fetchall(conn, query, args)
+            log.debug('len(rows)=%s', len(rows))
+            log.debug('%s', LazyFormat(rows))
 
             schema_tables = {}
-            added_columns = []
-
+            added_columns = set()
             for row in rows:
-                schema = row[0]
-                table = row[1]
-                column = row[2]
-                column_type = row[3]
-                row_count = row[4]
-                column_key = row[5]
-                if column_key is not None:
-                    column_key = column_key.strip().lower()
-                seq_in_index = row[6]
-
-                scan_secondary_keys = merged_options['secondary_keys']
-                scan_all_columns = merged_options['scan_all_columns']
-
-                schema_table = '%s.%s' % (schema, table)
-                if (
-                        exclude_columns and
-                        schema_table in exclude_columns
-                        and column in exclude_columns[schema_table]
-                        ):
-                    # this column is excluded
+                add_metadata_row(schema_tables, added_columns, hostname, row)
+
+            if self.metadata_cache:
+                self.metadata_cache.put(cache_key, fingerprint, schema_tables)
+            self.add_partitions(conn, schema_tables)
+        except MySQLdb.OperationalError:
+            self.raise_killed_metadata(token, hostname)
+            raise
+        finally:
+            if token is not None:
+                self.watchdog.unregister(token)
+            conn.close()
+
+        return schema_tables
 
-                    log.debug('Excluded column: %s.%s.%s' % (
-                        schema, table, column))
+    def iter_schema_tables(self, merged_options):
+        """Yields the schema tables of a host in batches as they are read.
 
-                    pass
-                else:
-                    include_column = False
-
-                    if column_key and column_key == 'pri':
-                        # always include primary keys
-                        include_column = True
-
-                    if scan_secondary_keys:
-                        if (
-                                column_key and column_key != 'pri' and
-                                seq_in_index and seq_in_index == 1):
-                            include_column = True
-
-                    # if (
-                    #         (not merged_options['primary_keys']) and
-                    #         (not merged_options['secondary_keys'])):
-                    #     include_column = True
-                    if scan_all_columns:
-                        include_column = True
-
-                    if include_column:
-                        column_to_add = '%s.%s.%s' % (schema, table, column)
-                        if column_to_add in added_columns:
-                            # prevent duplicates
-                            include_column = False
-                        else:
-                            added_columns.append(column_to_add)
-
-                    if include_column:
-                        if schema_table in schema_tables:
-                            schema_tables[schema_table]['columns'].append(
-                                dict(
-                                    column_name=column,
-                                    column_type=column_type))
-                        else:
-                            schema_tables[schema_table] = dict(
-                                schema=schema,
-                                table=table,
-                                row_count=row_count,
-                                columns=[dict(
-                                    column_name=column,
-                                    column_type=column_type)])
-
-            # end for
+        The metadata is read with a server-side cursor ordered by table,
+        so rows are not held in memory and a table is complete when the
+        next one starts. Partitioned tables are yielded last, once their
+        partitions are read. With a metadata cache, the metadata is read
+        by get_schema_tables() and yielded in batches.
+        """
+        if self.metadata_cache:
+            items = sorted(self.get_schema_tables(merged_options).iteritems())
+            for i in range(0, len(items), STREAM_BATCH_SIZE):
+                yield dict(items[i:i + STREAM_BATCH_SIZE])
+            return
+
+        hostname = get_host_tag(merged_options)
+        query, args = self.get_metadata_query(merged_options)
+        query += """
+            ORDER BY c.TABLE_SCHEMA, c.TABLE_NAME, c.ORDINAL_POSITION
+            """
+        partitioned = {}
+        connection_options = get_connection_options(merged_options)
+        conn = self.pool.connect(connection_options)
+        token = self.watch_metadata_connection(conn, connection_options)
+        try:
+            self.prepare_metadata_connection(conn, merged_options)
+            log.debug('%s\n%s', query, args)
+            cur = conn.cursor(MySQLdb.cursors.SSCursor)
+            try:
+                cur.execute(query, args)
+                schema_tables = {}
+                added_columns = set()
+                schema_table = None
+                for row in cur:
+                    if '%s.%s' % (row[0], row[1]) != schema_table:
+                        # the previous tables are complete
+                        if len(schema_tables) >= STREAM_BATCH_SIZE:
+                            yield schema_tables
+                            schema_tables = {}
+                            added_columns = set()
+                        schema_table = add_metadata_row(
+                            schema_tables, added_columns, hostname, row)
+                        v = schema_tables[schema_table]
+                        if v['partitioned']:
+                            # the partitions are read once the cursor is done
+                            partitioned[schema_table] = schema_tables.pop(
+                                schema_table)
+                    elif schema_table in partitioned:
+                        add_metadata_row(
+                            partitioned, added_columns, hostname, row)
+                    else:
+                        add_metadata_row(
+                            schema_tables, added_columns, hostname, row)
+                if schema_tables:
+                    yield schema_tables
+            finally:
+                cur.close()
+            if partitioned:
+                self.add_partitions(conn, partitioned)
+        except MySQLdb.OperationalError:
+            self.raise_killed_metadata(token, hostname)
+            raise
         finally:
+            if token is not None:
+                self.watchdog.unregister(token)
             conn.close()
+        if partitioned:
+            yield partitioned
+
+    def get_schema_filter(self, column, merged_options):
+        """Returns the use_dbs and ignore_dbs condition and its args."""
+        condition = ''
+        args = []
+        if merged_options.get('use_dbs'):
+            condition += """
+                AND %s IN (%s)
+                """ % (column, ','.join(['%s'] * len(merged_options['use_dbs'])))
+            args.extend(merged_options['use_dbs'])
+
+        if merged_options.get('ignore_dbs'):
+            condition += """
+                AND %s NOT IN (%s)
+                """ % (column, ','.join(['%s'] * len(merged_options['ignore_dbs'])))
+            args.extend(merged_options['ignore_dbs'])
+        return condition, args
+
+    def get_metadata_fingerprint(self, conn, merged_options):
+        """Returns the cache key, fingerprint and stats of the tables.
+
+        Reading INFORMATION_SCHEMA.TABLES and a checksum of the columns of
+        each table is much cheaper than joining the columns and indexes.
+        Creating, dropping, renaming or rebuilding a table changes the
+        fingerprint, and so does any change of the name, type, key or
+        extra of a column, including instant ALTER TABLE which keeps
+        CREATE_TIME. The table stats change on every run and are returned
+        as dict of (schema, table) to (TABLE_ROWS, DATA_LENGTH,
+        AUTO_INCREMENT), so cached metadata can be refreshed.
+        """
+        filter_options = dict(
+            (k, merged_options.get(k)) for k in (
+                'use_dbs', 'ignore_dbs', 'exclude_columns', 'secondary_keys',
+                'scan_all_columns'))
+        cache_key = '%s:%s:%s' % (
+            get_host_tag(merged_options), merged_options.get('port') or '',
+            hashlib.sha1(json.dumps(
+                filter_options, sort_keys=True)).hexdigest())
+
+        query = """
+            SELECT
+                TABLE_SCHEMA, TABLE_NAME, CREATE_TIME, TABLE_ROWS,
+                DATA_LENGTH, AUTO_INCREMENT
+            FROM INFORMATION_SCHEMA.TABLES
+            WHERE TABLE_TYPE = 'BASE TABLE'
+            """
+        schema_filter, args = self.get_schema_filter(
+            'TABLE_SCHEMA', merged_options)
+        query += schema_filter
+        rows = fetchall(conn, query, args)
 
+        query = """
+            SELECT
+                TABLE_SCHEMA, TABLE_NAME, COUNT(*),
+                SUM(CRC32(CONCAT_WS(
+                    ' ', COLUMN_NAME, COLUMN_TYPE, COLUMN_KEY, EXTRA)))
+            FROM INFORMATION_SCHEMA.COLUMNS
+            WHERE 1
+            """
+        schema_filter, args = self.get_schema_filter(
+            'TABLE_SCHEMA', merged_options)
+        query += schema_filter
+        query += """
+            GROUP BY TABLE_SCHEMA, TABLE_NAME
+            """
+        column_checksums = dict(
+            ((row[0], row[1]), row[2:])
+            for row in fetchall(conn, query, args))
+
+        fingerprint = hashlib.sha1()
+        table_stats = {}
+        for row in sorted(rows):
+            count, checksum = column_checksums.get((row[0], row[1]), (0, 0))
+            fingerprint.update('%s.%s %s %s %s\n' % (
+                row[0], row[1], row[2], count, checksum))
+            table_stats[(row[0], row[1])] = row[3:]
+        return cache_key, fingerprint.hexdigest(), table_stats
+
+    def add_partitions(self, conn, schema_tables):
+        """Adds the partitions of the partitioned tables to schema tables.
+
+        Partitions are read from INFORMATION_SCHEMA.PARTITIONS only for
+        the tables which CREATE_OPTIONS shows as partitioned, and are not
+        cached since they are added and dropped without rebuilding the
+        table. Each partition is a dict of name, method, expression, rows
+        and data_length, in partition order. Subpartitions are summed into
+        their partition.
+        """
+        partitioned = dict(
+            ((v['schema'], v['table']), v)
+            for v in schema_tables.itervalues() if v.get('partitioned'))
+        keys = sorted(partitioned)
+        for start in range(0, len(keys), PARTITIONS_BATCH_SIZE):
+            batch = keys[start:start + PARTITIONS_BATCH_SIZE]
+            query = """
+                SELECT
+                    TABLE_SCHEMA, TABLE_NAME, PARTITION_NAME,
+                    PARTITION_METHOD, PARTITION_EXPRESSION, TABLE_ROWS,
+                    DATA_LENGTH
+                FROM INFORMATION_SCHEMA.PARTITIONS
+                WHERE PARTITION_NAME IS NOT NULL
+                AND (TABLE_SCHEMA, TABLE_NAME) IN (%s)
+                ORDER BY
+                    TABLE_SCHEMA, TABLE_NAME, PARTITION_ORDINAL_POSITION,
+                    SUBPARTITION_ORDINAL_POSITION
+                """ % (','.join(['(%s,%s)'] * len(batch)),)
+            args = [value for key in batch for value in key]
+            for row in fetchall(conn, query, args):
+                partitions = partitioned[(row[0], row[1])].setdefault(
+                    'partitions', [])
+                if partitions and partitions[-1]['name'] == row[2]:
+                    partitions[-1]['rows'] += row[5] or 0
+                    partitions[-1]['data_length'] += row[6] or 0
+                else:
+                    partitions.append(dict(
+                        name=row[2],
+                        method=row[3],
+                        expression=row[4],
+                        rows=row[5] or 0,
+                        data_length=row[6] or 0))
+
+    def refresh_table_stats(self, schema_tables, table_stats):
+        """Updates cached schema tables with the current table stats."""
+        for schema_table in schema_tables.itervalues():
+            stats = table_stats.get(
+                (schema_table['schema'], schema_table['table']))
+            if stats:
+                (schema_table['row_count'], schema_table['data_length'],
+                    schema_table['auto_increment']) = stats
         return schema_tables
 
+    def plan_schema_tables(self, schema_tables, merged_options=None):
+        """Chooses how the max value of each column is retrieved.
+
+        Sets the strategy of each column to one of:
+          - metadata: max value is derived from AUTO_INCREMENT
+          - partition: column is the RANGE partitioning column of the
+            table, MAX() reads the highest non-empty partition
+          - index: column leads an index, MAX() is a single index lookup
+          - scan: MAX() needs a full table scan
+          - skip: a full table scan is needed but the table is over
+            max_scan_size, the column is not checked
+        Each table is given the strategy of its query, the estimated
+        number of rows examined and its estimated cost in bytes read.
+        """
+        if merged_options is None:
+            merged_options = self.merged_options
+        auto_increment_metadata = merged_options.get('auto_increment_metadata')
+        max_scan_size = merged_options.get('max_scan_size')
+
+        for v in schema_tables.itervalues():
+            row_count = v['row_count'] or 0
+            data_length = v['data_length'] or 0
+            range_column = get_range_column(v.get('partitions'))
+            strategy = None
+            for column in v['columns']:
+                if (
+                        auto_increment_metadata and column['auto_increment']
+                        and v['auto_increment'] is not None):
+                    column['strategy'] = 'metadata'
+                elif column['column_name'] == range_column:
+                    column['strategy'] = 'partition'
+                    strategy = strategy or 'partition'
+                elif column['index_leading']:
+                    column['strategy'] = 'index'
+                    if strategy in (None, 'partition'):
+                        strategy = 'index'
+                elif (
+                        max_scan_size is not None and
+                        data_length > max_scan_size * 1024 * 1024):
+                    column['strategy'] = 'skip'
+                    log.warning(
+                        'Skipped column: %s.%s.%s, full table scan of %s '
+                        'bytes is over max_scan_size.' % (
+                            v['schema'], v['table'], column['column_name'],
+                            data_length))
+                else:
+                    column['strategy'] = 'scan'
+                    strategy = 'scan'
+
+            v['strategy'] = strategy
+            if strategy == 'scan':
+                v['estimated_rows'] = row_count
+                v['estimated_cost'] = data_length or row_count
+            elif strategy == 'index':
+                v['estimated_rows'] = len([
+                    column for column in v['columns']
+                    if column['strategy'] == 'index'])
+                v['estimated_cost'] = v['estimated_rows'] * INDEX_LOOKUP_COST
+            elif strategy == 'partition':
+                partition = get_highest_partition(v['partitions'])
+                v['estimated_rows'] = partition['rows']
+                v['estimated_cost'] = (
+                    partition['data_length'] or partition['rows'])
+            else:
+                v['estimated_rows'] = 0
+                v['estimated_cost'] = 0
+        return schema_tables
+
+    def split_partitioned_tables(self, work):
+        """Returns the work items of scheduled tables, in the same order.
+
+        The partition columns of a table are one item which reads its
+        partitions highest first. If the other columns of a partitioned
+        table need a full table scan, they are one item per partition, so
+        that the partitions are scanned in parallel, merged by a
+        PartitionMerge. Other tables are one item.
+        """
+        items = []
+        for v in work:
+            partitions = v.get('partitions') or []
+            partition_columns = [
+                column for column in v['columns']
+                if column['strategy'] == 'partition']
+            columns = [
+                column for column in v['columns']
+                if column['strategy'] != 'partition']
+            if partition_columns:
+                partition = get_highest_partition(partitions)
+                items.append(dict(
+                    v, columns=partition_columns,
+                    partition_search=[p['name'] for p in reversed(partitions)],
+                    estimated_rows=partition['rows'],
+                    estimated_cost=(
+                        partition['data_length'] or partition['rows'])))
+            if not columns:
+                continue
+            if len(partitions) > 1 and any(
+                    column['strategy'] == 'scan' for column in columns):
+                merge = PartitionMerge(len(partitions))
+                for partition in partitions:
+                    items.append(dict(
+                        v, columns=columns,
+                        partition=partition['name'],
+                        partition_merge=merge,
+                        estimated_rows=partition['rows'],
+                        estimated_cost=(
+                            partition['data_length'] or partition['rows'])))
+            elif partition_columns:
+                items.append(dict(v, columns=columns))
+            else:
+                items.append(v)
+        return items
+
+    def get_skipped_columns(self, schema_tables):
+        """Returns columns skipped by the planner."""
+        skipped_columns = []
+        for v in schema_tables.itervalues():
+            for column in v['columns']:
+                if column['strategy'] == 'skip':
+                    skipped_columns.append(dict(
+                        hostname=v['hostname'],
+                        schema=v['schema'],
+                        table=v['table'],
+                        column_name=column['column_name'],
+                        column_type=column['column_type']))
+        return skipped_columns
+
+    def explain_plan(self, host_schema_tables):
+        """Returns a response describing the plan without running it.
+
+        host_schema_tables is a list of (options, schema tables) of each
+        host.
+        """
+        lines = []
+        total_tables = 0
+        total_estimated_rows = 0
+        for merged_options, schema_tables in host_schema_tables:
+            total_tables += len(schema_tables)
+            total_estimated_rows += self.explain_host_plan(
+                merged_options, schema_tables, lines)
+
+        msg = 'Dry run: %s tables, estimated rows examined: %s\n%s' % (
+            total_tables, total_estimated_rows, '\n'.join(lines))
+        self.exit_code = pynagios.OK.exit_code
+        return Response(pynagios.OK, msg)
+
+    def explain_host_plan(self, merged_options, schema_tables, lines):
+        """Appends the plan of a host to lines.
+
+        Returns the estimated rows examined.
+        """
+        total_estimated_rows = 0
+        conn = self.pool.connect(get_connection_options(merged_options))
+        try:
+            for schema_table in sorted(schema_tables):
+                v = schema_tables[schema_table]
+                total_estimated_rows += v['estimated_rows']
+                if self.fleet:
+                    schema_table = '%s:%s' % (v['hostname'], schema_table)
+                lines.append('%s\t%s\testimated_rows=%s\t%s' % (
+                    schema_table, v['strategy'], v['estimated_rows'],
+                    ','.join(
+                        '%s(%s)' % (column['column_name'], column['strategy'])
+                        for column in v['columns'])))
+
+                columns = [
+                    column for column in v['columns']
+                    if column['strategy'] in ('index', 'scan')]
+                if not columns:
+                    continue
+                cur = conn.cursor()
+                try:
+                    cur.execute(
+                        'EXPLAIN ' +
+                        build_select_max(v['schema'], v['table'], columns))
+                    names = [d[0] for d in cur.description]
+                    for row in cur.fetchall():
+                        lines.append('\tEXPLAIN: %s' % (' '.join(
+                            '%s=%s' % (name, value)
+                            for name, value in zip(names, row)),))
+                finally:
+                    cur.close()
+        finally:
+            conn.close()
+        return total_estimated_rows
+
+    def process_auto_increment_columns(
+            self, schema_tables, results, merged_options=None):
+        """Classifies auto-increment columns using table metadata.
+
+        The max value of an auto-increment column is derived from the
+        AUTO_INCREMENT value of its table so the table is not scanned.
+        Returns the schema tables that still have columns to scan.
+        """
+        if merged_options is None:
+            merged_options = self.merged_options
+        remaining_schema_tables = {}
+        metadata_columns = []
+        for schema_table, v in schema_tables.iteritems():
+            auto_increment = v['auto_increment']
+            columns = []
+            for column in v['columns']:
+                if column['strategy'] == 'skip':
+                    pass
+                elif column['strategy'] == 'metadata':
+                    # AUTO_INCREMENT is the next value to be generated
+                    max_int = auto_increment - 1
+                    log.debug(
+                        'Auto-increment column: %s.%s, max_int: %s',
+                        schema_table, column['column_name'], max_int)
+                    metadata_columns.append((
+                        v['schema'], v['table'], column['column_name'],
+                        column['column_type'], v['row_count'], max_int))
+                else:
+                    columns.append(column)
+            if columns:
+                remaining_schema_tables[schema_table] = dict(
+                    v, columns=columns)
+        # all metadata columns of the host are classified in one batch
+        process_max_ints(merged_options, results, metadata_columns)
+        return remaining_schema_tables
+
+    def get_host_work(
+            self, schema_tables, merged_options, results, state_store=None,
+            column_states=None, growth_rates=None):
+        """Returns the work items of the planned schema tables of a host.
+
+        Auto-increment columns are classified into results, columns which
+        are not due are dropped with a state store, and the tables are
+        sorted by priority, partitioned tables split into partitions. Also
+        returns the columns skipped by the planner.
+        """
+        column_states = column_states or {}
+        growth_rates = growth_rates or {}
+        skipped_columns = self.get_skipped_columns(schema_tables)
+        schema_tables = self.process_auto_increment_columns(
+            schema_tables, results, merged_options)
+        if state_store:
+            schema_tables = state_store.get_due_schema_tables(
+                schema_tables, column_states, growth_rates, merged_options)
+        schema_tables = self.schedule_schema_tables(
+            schema_tables, column_states, growth_rates, merged_options,
+            results)
+        work = self.split_partitioned_tables(sorted(
+            schema_tables.itervalues(), key=lambda v: v['priority']))
+        return work, skipped_columns
+
+    def schedule_schema_tables(
+            self, schema_tables, column_states, growth_rates,
+            merged_options=None, results=None):
+        """Prioritizes columns by projected time to the warning threshold.
+
+        Columns closest to the warning threshold are scanned first. A
+        column which was not scanned for state_rescan_interval seconds is
+        due as well, the oldest first, so that columns which are not
+        growing are not starved. Among equally urgent columns, the most
+        expensive tables are scanned first (longest processing time
+        first), so that the threads finish at about the same time. If
+        budget is set, only that many columns are scanned, most urgent
+        first, and the others are put in results as not checked. Returns
+        the schema tables to scan, each with a 'priority'.
+        """
+        if merged_options is None:
+            merged_options = self.merged_options
+        warning = merged_options['warning']
+        budget = merged_options.get('budget')
+        rescan_interval = merged_options.get('state_rescan_interval')
+        now = time.time()
+
+        scheduled_columns = []
+        for schema_table, v in schema_tables.iteritems():
+            for column in v['columns']:
+                key = '%s.%s' % (schema_table, column['column_name'])
+                state = column_states.get(key)
+                time_to_threshold = get_time_to_threshold(
+                    state, growth_rates.get(key), warning, now)
+                overflow_percentage = 0
+                age = 0
+                if state:
+                    overflow_percentage = state['overflow_percentage']
+                    age = now - state['timestamp']
+                    if rescan_interval:
+                        time_to_threshold = max(min(
+                            time_to_threshold, rescan_interval - age), 0)
+                scheduled_columns.append((
+                    (time_to_threshold, -overflow_percentage, -age,
+                        -v.get('estimated_cost', 0)),
+                    schema_table, column))
+        scheduled_columns.sort(key=lambda item: item[0])
+
+        if budget is not None and len(scheduled_columns) > budget:
+            log.info(
+                'Budget: scanning %s of %s columns.',
+                budget, len(scheduled_columns))
+            if results is not None:
+                cut_schema_tables = {}
+                for priority, schema_table, column in (
+                        scheduled_columns[budget:]):
+                    cut_schema_tables.setdefault(schema_table, dict(
+                        schema_tables[schema_table], columns=[]))
+                    cut_schema_tables[schema_table]['columns'].append(column)
+                for v in cut_schema_tables.itervalues():
+                    put_unchecked_columns(results, v, 'budget')
+            scheduled_columns = scheduled_columns[:budget]
+
+        scheduled_schema_tables = {}
+        for priority, schema_table, column in scheduled_columns:
+            if schema_table not in scheduled_schema_tables:
+                # columns are sorted, the first column of a table is its
+                # most urgent
+                scheduled_schema_tables[schema_table] = dict(
+                    schema_tables[schema_table], columns=[],
+                    priority=priority)
+            scheduled_schema_tables[schema_table]['columns'].append(column)
+        return scheduled_schema_tables
+
+    def process_dump(self, merged_options, results):
+        """Classifies the columns of the tables in the dump files.
+
+        Columns are selected as on a server, by shard, use_dbs, ignore_dbs,
+        exclude_columns, secondary_keys and scan_all_columns. The row
+        count of a table is its number of rows in the dump.
+        """
+        dump_started = time.time()
+        exclude_columns = merged_options.get('exclude_columns') or {}
+        columns = []
+        for v in dump_scanner.scan_paths(
+                merged_options['dump'], merged_options['dump_processes']):
+            schema = v['schema']
+            if (
+                    merged_options.get('use_dbs') and
+                    schema not in merged_options['use_dbs']):
+                continue
+            if (
+                    merged_options.get('ignore_dbs') and
+                    schema in merged_options['ignore_dbs']):
+                continue
+            schema_table = '%s.%s' % (schema, v['table'])
+            if merged_options.get('shard'):
+                index, count = merged_options['shard']
+                if get_shard_index(schema_table, count) != index:
+                    continue
+            excluded = exclude_columns.get(schema_table, [])
+            for column in v['columns']:
+                if column['column_name'] in excluded:
+                    continue
+                if not (
+                        merged_options['scan_all_columns'] or
+                        column['column_key'] == 'PRI' or (
+                            merged_options['secondary_keys'] and
+                            column['index_leading'])):
+                    continue
+                columns.append((
+                    schema, v['table'], column['column_name'],
+                    column['column_type'], v['row_count'],
+                    column['max_value']))
+        log.info('Scanned %s columns of the dump in %.2fs.' % (
+            len(columns), time.time() - dump_started))
+        # all columns of the dump are classified in one batch
+        process_max_ints(merged_options, results, columns)
+
     def configure_logging(self):
         try:
             from logging.config import dictConfig
@@ -620,15 +3455,496 @@ class CheckMaxValue(Plugin):
         if 'logging' in self.merged_options and self.merged_options['logging']:
             dictConfig(self.merged_options['logging'])
 
+    def get_planned_schema_tables(self, merged_options):
+        """Returns the planned schema tables of a host.
+
+        Only the tables of the shard are planned, if set. The time spent
+        reading the metadata of the host is recorded in metadata_times.
+        """
+        metadata_started = time.time()
+        schema_tables = self.get_schema_tables(merged_options)
+        self.metadata_times[get_host_tag(merged_options)] = (
+            time.time() - metadata_started)
+        if merged_options.get('shard'):
+            schema_tables = filter_shard(
+                schema_tables, merged_options['shard'])
+
+        log.debug('Schema tables:\n%s', LazyFormat(schema_tables))
+
+        return self.plan_schema_tables(schema_tables, merged_options)
+
+    def get_replica_router(self, merged_options):
+        """Returns the ReplicaRouter of a host, None without replicas."""
+        if not merged_options.get('replicas'):
+            return None
+        primary_options = get_connection_options(merged_options)
+        replicas = []
+        for replica in merged_options['replicas']:
+            if isinstance(replica, basestring):
+                hostname, _, port = replica.partition(':')
+                replica = dict(hostname=hostname)
+                if port:
+                    replica['port'] = port
+            options = dict(merged_options)
+            options.update(replica)
+            connection_options = get_connection_options(options)
+            try:
+                conn = MySQLdb.connect(**connection_options)
+                try:
+                    status = get_replica_status(conn)
+                    row = fetchone(
+                        conn, "SHOW GLOBAL STATUS LIKE 'Threads_running'")
+                finally:
+                    conn.close()
+            except MySQLdb.Error, e:
+                log.warning('Replica %s is not usable: %s' % (
+                    options['hostname'], e))
+                continue
+            if status is None:
+                log.warning('%s is not a replica.' % (options['hostname'],))
+                continue
+            lag = status.get(
+                'Seconds_Behind_Source', status.get('Seconds_Behind_Master'))
+            if lag is None or lag > merged_options['max_replica_lag']:
+                log.warning('Replica %s lag is %s, not used.' % (
+                    options['hostname'], lag))
+                continue
+            # this connection is one of the running threads
+            load = int(row[1]) - 1 if row else 0
+            log.debug(
+                'Replica %s lag: %s, threads running: %s',
+                options['hostname'], lag, load)
+            replicas.append((connection_options, load))
+        if not replicas:
+            log.warning('No usable replica of %s, using it for scans.' % (
+                get_host_tag(merged_options),))
+        return ReplicaRouter(primary_options, replicas)
+
+    def get_makespan(self, table_times, costs, concurrency, actual):
+        """Returns the actual, expected and ideal makespan of the scan.
+
+        The expected makespan is the makespan of the estimated costs of
+        all tables run longest first, converted to seconds with the
+        seconds per cost of the scanned tables. The ideal makespan is the
+        total query time divided by the number of concurrent queries.
+        """
+        seconds = sum(t['seconds'] for t in table_times)
+        cost = sum(t['estimated_cost'] for t in table_times)
+        expected = 0
+        if cost:
+            expected = get_lpt_makespan(costs, concurrency) * seconds / cost
+        return dict(
+            actual=actual,
+            expected=expected,
+            ideal=seconds / max(concurrency, 1),
+            tables=len(table_times),
+            concurrency=concurrency)
+
+    def get_metrics(self, collector, started):
+        """Returns the timings of the run.
+
+        The columns of a table are read by one query, so the query time of
+        a column is that of its table divided by its columns. The
+        utilization of a worker is the time it spent on tables over its
+        lifetime times the queries it can run concurrently.
+        """
+        table_times = collector.table_times
+        query_time = sum(t['seconds'] for t in table_times)
+        columns = sum(t['columns'] for t in table_times)
+        threads = []
+        for t in sorted(collector.thread_stats, key=lambda t: t['name']):
+            capacity = t['elapsed'] * t['slots']
+            threads.append(dict(
+                t, utilization=t['busy'] / capacity if capacity else 0))
+        busy = sum(t['busy'] for t in threads)
+        capacity = sum(t['elapsed'] * t['slots'] for t in threads)
+        slowest_tables = sorted(
+            table_times, key=lambda t: t['seconds'],
+            reverse=True)[:self.merged_options['metrics_top']]
+        return dict(
+            started=started,
+            run_time=time.time() - started,
+            metadata_time=sum(self.metadata_times.itervalues()),
+            metadata_times=self.metadata_times,
+            scan_time=self.makespan['actual'],
+            makespan=self.makespan,
+            tables=len(table_times),
+            columns=columns,
+            query_time=query_time,
+            max_query_time=max([t['seconds'] for t in table_times] or [0]),
+            column_query_time=query_time / columns if columns else 0,
+            queue_wait=sum(t['queue_wait'] for t in table_times),
+            max_queue_wait=max(
+                [t['queue_wait'] for t in table_times] or [0]),
+            throttle_wait=sum(t['throttle_wait'] for t in table_times),
+            connect_wait=sum(t['connect_seconds'] for t in table_times),
+            connections=self.pool.connections + sum(
+                t.get('connections', 0) for t in threads),
+            connect_time=self.pool.connect_seconds + sum(
+                t.get('connect_seconds', 0) for t in threads),
+            utilization=busy / capacity if capacity else 0,
+            threads=threads,
+            critical=len(collector.critical_columns),
+            warning=len(collector.warning_columns),
+            investigate=len(collector.investigate_columns),
+            unchecked=len(collector.unchecked_columns),
+            errors=len(collector.errors),
+            slowest_tables=slowest_tables)
+
+    def set_perf_data(self, response, metrics):
+        """Adds the main timings and counts of the run to the response."""
+        for label in (
+                'run_time', 'metadata_time', 'scan_time', 'max_query_time',
+                'queue_wait', 'connect_time'):
+            response.set_perf_data(label, '%.3f' % (metrics[label],), uom='s')
+        for label in ('tables', 'columns', 'critical', 'warning', 'unchecked'):
+            response.set_perf_data(label, metrics[label])
+        response.set_perf_data(
+            'utilization', '%.1f' % (metrics['utilization'] * 100,),
+            uom='%', minval=0, maxval=100)
+
+    def write_metrics(self, metrics):
+        """Writes the metrics to metrics_file and prometheus_file."""
+        if self.merged_options.get('metrics_file'):
+            write_file_atomically(
+                self.merged_options['metrics_file'],
+                json.dumps(metrics, indent=2, sort_keys=True, default=str))
+        if self.merged_options.get('prometheus_file'):
+            write_file_atomically(
+                self.merged_options['prometheus_file'],
+                format_prometheus_metrics(metrics))
+
+    def get_command(self):
+        """Returns the command and its arguments, None if no command.
+
+        The command is the first positional argument. args includes the
+        name of the program when the plugin is run from the command line.
+        """
+        args = list(self.args)
+        if args and args[0] == sys.argv[0]:
+            args = args[1:]
+        if not args:
+            return None, []
+        return args[0], args[1:]
+
+    def write_shard_file(self, status, metrics, skipped_columns, host_errors):
+        """Writes the result of the run to shard_file as compact JSON."""
+        index, count = self.merged_options.get('shard') or (1, 1)
+        shard = dict(
+            shard=index,
+            shards=count,
+            fleet=self.fleet,
+            started=metrics['started'],
+            finished=time.time(),
+            exit_code=status.exit_code,
+            skipped=skipped_columns,
+            host_errors=host_errors,
+            metrics=dict(
+                (label, metrics[label])
+                for label in ('run_time', 'tables', 'columns')))
+        shard.update(self.flagged_columns)
+        write_file_atomically(
+            self.merged_options['shard_file'],
+            json.dumps(
+                shard, separators=(',', ':'), sort_keys=True, default=str))
+
+    def merge_shard_files(self, filenames):
+        """Returns the combined response of the result files of shards.
+
+        The flagged columns of all shards are written to the results
+        database in one batch. If a shard has more than one file, the
+        latest is used. A shard without a file makes an OK check UNKNOWN.
+        """
+        if not filenames:
+            raise Error('merge requires the result files of the shards.')
+        shards = {}
+        for filename in filenames:
+            with open(filename) as f:
+                shard = json.load(f)
+            previous = shards.get(shard['shard'])
+            if previous is None or shard['finished'] > previous['finished']:
+                shards[shard['shard']] = shard
+        counts = sorted(set(shard['shards'] for shard in shards.itervalues()))
+        if len(counts) > 1:
+            raise Error('The shard files have different shard counts: %s' % (
+                ', '.join(str(count) for count in counts),))
+
+        merged = dict(
+            (name, []) for name in (
+                'critical', 'warning', 'investigate', 'unchecked', 'skipped',
+                'host_errors'))
+        for index in sorted(shards):
+            for name, values in merged.iteritems():
+                values.extend(shards[index][name])
+        status, msg = self.get_status_message(
+            merged['critical'], merged['warning'], merged['investigate'],
+            merged['skipped'], merged['host_errors'],
+            any(shard['fleet'] for shard in shards.itervalues()),
+            merged['unchecked'])
+        missing = [
+            str(index) for index in range(1, counts[0] + 1)
+            if index not in shards]
+        if missing:
+            if status == pynagios.OK:
+                status = pynagios.UNKNOWN
+            if msg:
+                msg += '\n'
+            msg += '\nNo result file for shards %s of %d.' % (
+                ', '.join(missing), counts[0])
+
+        if self.results_db_conn_opts:
+            results_writer = ResultsWriter(
+                self.pool, self.results_db_conn_opts,
+                batch_size=self.merged_options['results_batch_size'])
+            for reason in ('critical', 'warning', 'investigate'):
+                for col in merged[reason]:
+                    results_writer.add(reason, col)
+            results_writer.close()
+
+        log.info('status: %s\n\nmsg:\n%s' % (status, msg))
+
+        response = Response(status, msg)
+        response.set_perf_data('run_time', '%.3f' % (max(
+            shard['metrics']['run_time']
+            for shard in shards.itervalues()),), uom='s')
+        for label in ('tables', 'columns'):
+            response.set_perf_data(label, sum(
+                shard['metrics'][label] for shard in shards.itervalues()))
+        for label in ('critical', 'warning', 'unchecked'):
+            response.set_perf_data(label, len(merged[label]))
+        response.set_perf_data('shards', len(shards))
+        response.set_perf_data('age', '%d' % (time.time() - min(
+            shard['finished'] for shard in shards.itervalues()),), uom='s')
+        self.exit_code = status.exit_code
+        return response
+
+    def run_daemon(self):
+        """Runs the check every daemon_interval seconds until interrupted.
+
+        The status, flagged columns and metrics of the latest run are
+        served over HTTP on daemon_listen. The options, including the
+        configuration file, are read again for each run.
+        """
+        host, _, port = self.merged_options['daemon_listen'].rpartition(':')
+        cache = StatusCache()
+        server = StatusServer((host or '127.0.0.1', int(port)), cache)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.name = 'Status server'
+        thread.daemon = True
+        thread.start()
+        log.info('Serving the status on %s:%s.' % server.server_address)
+
+        self.daemon_running = True
+        try:
+            while True:
+                run_started = time.time()
+                response = self.check()
+                cache.update(
+                    response, self.flagged_columns, self.metrics, run_started)
+                log.info('Daemon run finished: %s' % (
+                    response.status.name,))
+                time.sleep(max(
+                    self.merged_options['daemon_interval'] -
+                    (time.time() - run_started), 0))
+        except KeyboardInterrupt:
+            log.info('Daemon stopped.')
+        finally:
+            self.daemon_running = False
+            server.shutdown()
+            server.server_close()
+        self.exit_code = pynagios.OK.exit_code
+        return Response(pynagios.OK, 'Daemon stopped.')
+
+    def query_daemon(self):
+        """Returns the status cached by the daemon at daemon_url.
+
+        The age of the status is added to the message and as perfdata. The
+        check is UNKNOWN if the daemon cannot be reached, has no status yet
+        or its status is older than daemon_max_age.
+        """
+        url = '%s/status' % (self.merged_options['daemon_url'].rstrip('/'),)
+        timeout = self.options.timeout or 10
+        try:
+            f = urllib2.urlopen(url, timeout=timeout)
+            try:
+                cached = json.load(f)
+            finally:
+                f.close()
+        except urllib2.HTTPError, e:
+            self.exit_code = pynagios.UNKNOWN.exit_code
+            return Response(pynagios.UNKNOWN, 'Daemon %s: %s %s' % (
+                url, e.code, e.read().strip()))
+        except (urllib2.URLError, socket.error, ValueError), e:
+            self.exit_code = pynagios.UNKNOWN.exit_code
+            return Response(pynagios.UNKNOWN, 'Daemon %s not reachable: %s' % (
+                url, e))
+
+        statuses = dict(
+            (status.exit_code, status) for status in (
+                pynagios.OK, pynagios.WARNING, pynagios.CRITICAL,
+                pynagios.UNKNOWN))
+        status = statuses.get(cached['exit_code'], pynagios.UNKNOWN)
+        age = cached['age']
+        msg = 'Checked %d seconds ago.' % (age,)
+        if cached['message']:
+            msg = '%s\n\n%s' % (cached['message'], msg)
+        max_age = self.merged_options.get('daemon_max_age')
+        if max_age is not None and age > max_age:
+            status = pynagios.UNKNOWN
+            msg = 'Cached status is %d seconds old, over %d seconds.\n%s' % (
+                age, max_age, msg)
+
+        response = Response(status, msg)
+        if cached.get('metrics'):
+            self.set_perf_data(response, cached['metrics'])
+        response.set_perf_data('age', '%d' % (age,), uom='s')
+        self.exit_code = status.exit_code
+        return response
+
+    def get_status_message(
+            self, critical_columns, warning_columns, investigate_columns,
+            skipped_columns, host_errors, show_hostname,
+            unchecked_columns=()):
+        """Returns the status and message of the check.
+
+        Columns which were not checked because their query was killed or
+        the deadline was reached do not change the status, the check
+        reports the columns found so far.
+        """
+        def format_table(col):
+            if show_hostname:
+                return '%s:%s.%s' % (
+                    col.get('hostname'), col.get('schema'), col.get('table'))
+            return '%s.%s' % (col.get('schema'), col.get('table'))
+
+        if len(critical_columns) > 0:
+            columns = sorted(critical_columns) + sorted(warning_columns)
+            status = pynagios.CRITICAL
+        elif len(warning_columns) > 0:
+            columns = warning_columns
+            status = pynagios.WARNING
+        elif host_errors:
+            status = pynagios.UNKNOWN
+        else:
+            status = pynagios.OK
+
+        msg = ''
+        if status in (pynagios.CRITICAL, pynagios.WARNING):
+            msg = '\n'.join(
+                '%s\t%s\t%s\t%s\t%.2f%%' % (
+                    format_table(col),
+                    col.get('column_name'),
+                    col.get('column_type'),
+                    col.get('max_value'),
+                    col.get('overflow_percentage')) for col in columns)
+            msg = '\n' + msg
+
+        row_count_max_ratio = self.merged_options.get('row_count_max_ratio', 0)
+        if investigate_columns:
+            if msg:
+                msg += '\n'
+            msg += (
+                ('\nColumns containing high values compared to maximum for the column datatype, but number of rows is less than %s%% of maximum for the column type:\n' % (row_count_max_ratio,)) +
+                ('\n'.join(
+                    '%s\t%s\t%s\t%s\t%.2f%%' % (
+                        format_table(col),
+                        col.get('column_name'),
+                        col.get('column_type'),
+                        col.get('max_value'),
+                        col.get('overflow_percentage')) for col in investigate_columns))
+                )
+
+        if skipped_columns:
+            if msg:
+                msg += '\n'
+            msg += (
+                '\nColumns not checked because a full table scan is over max_scan_size:\n' +
+                '\n'.join(
+                    '%s\t%s\t%s' % (
+                        format_table(col),
+                        col.get('column_name'),
+                        col.get('column_type')) for col in skipped_columns))
+
+        if unchecked_columns:
+            if msg:
+                msg += '\n'
+            msg += (
+                '\nColumns not checked:\n' +
+                '\n'.join(
+                    '%s\t%s\t%s\t%s' % (
+                        format_table(col),
+                        col.get('column_name'),
+                        col.get('column_type'),
+                        col.get('reason')) for col in unchecked_columns))
+
+        if host_errors:
+            if msg:
+                msg += '\n'
+            msg += '\nHosts not checked:\n' + '\n'.join(
+                '%s\tERROR: %s' % (error['hostname'], error['error'])
+                for error in host_errors)
+
+        return status, msg
+
+    def write_fleet_outputs(
+            self, host_options, critical_columns, warning_columns,
+            investigate_columns, skipped_columns, host_errors,
+            unchecked_columns=()):
+        """Writes the Nagios output of each host to fleet_output_dir."""
+        def for_host(columns, hostname):
+            return [col for col in columns if col['hostname'] == hostname]
+
+        for hostname in host_options:
+            status, msg = self.get_status_message(
+                for_host(critical_columns, hostname),
+                for_host(warning_columns, hostname),
+                for_host(investigate_columns, hostname),
+                for_host(skipped_columns, hostname),
+                for_host(host_errors, hostname),
+                False,
+                for_host(unchecked_columns, hostname))
+            filename = os.path.join(
+                self.merged_options['fleet_output_dir'], '%s.txt' % (hostname,))
+            with open(filename, 'w') as f:
+                f.write('%s\n' % (Response(status, msg),))
+
     def check(self):
+        started = time.time()
+        self.pool = None
+        self.fleet = False
+        self.metadata_times = {}
+        self.flagged_columns = None
+        self.metrics = None
+        self.watchdog = None
         try:
             self.merge_options()
             self.configure_logging()
 
             merged_options = self.merged_options
-            hostname = ''
-            if 'hostname' in merged_options and merged_options['hostname']:
-                hostname = merged_options['hostname']
+            if merged_options.get('engine') == 'async':
+                if gevent is None:
+                    raise Error(
+                        'The async engine requires gevent and PyMySQL.')
+                patch_for_async()
+            if merged_options.get('daemon_url'):
+                return self.query_daemon()
+            if merged_options.get('daemon') and not self.daemon_running:
+                return self.run_daemon()
+            if (
+                    merged_options.get('budget') is not None and
+                    not merged_options.get('state_file')):
+                # without scan state, the same columns would always be cut
+                raise Error('budget requires state_file.')
+
+            self.pool = ConnectionPool(
+                max_connections=(
+                    merged_options.get('max_connections') or
+                    merged_options['threads']))
+            self.metadata_cache = None
+            if merged_options.get('metadata_cache'):
+                self.metadata_cache = MetadataCache(
+                    merged_options['metadata_cache'],
+                    merged_options['metadata_cache_ttl'])
             self.results_db_conn_opts = {}
 
             if 'results_host' in merged_options and merged_options['results_host']:
@@ -650,174 +3966,419 @@ class CheckMaxValue(Plugin):
                 if not ('db' in self.results_db_conn_opts and self.results_db_conn_opts['db']):
                     raise Error('results_database is required.')
 
-            log.debug('Check started with the following options:\n%s' % (
-                pprint.pformat(self.merged_options),))
-
-            schema_tables = self.get_schema_tables()
-
-            log.debug('Schema tables:\n%s' % (pprint.pformat(schema_tables),))
-
-            q = Queue.Queue()
-            for v in schema_tables.itervalues():
-                q.put(v)
-
-            threads = self.merged_options['threads']
-            results = Queue.Queue()
-            thread_list = []
-            for n in range(threads):
-                thread = TableProcessor(
-                    schema_tables=q,
-                    merged_options=self.merged_options,
-                    results=results)
-                thread.name = 'Thread #%d' % (n,)
-                thread.daemon = True
-                thread.start()
-                thread_list.append(thread)
-
-            # wait for all threads to finish
-            log.debug('Waiting for all threads to finish running.')
-            while True:
-                dead = []
-                for thread in thread_list:
-                    dead.append(not thread.is_alive())
-                if all(dead):
-                    break
-                time.sleep(0.01)
-            log.debug('All threads finished.')
-
-            critical_columns = []
-            warning_columns = []
-            errors = []
-            investigate_columns = []
-            while True:
-                try:
-                    result = results.get_nowait()
-
-                    if 'critical_column' in result:
-                        critical_columns.append(result['critical_column'])
-
-                    if 'warning_column' in result:
-                        warning_columns.append(result['warning_column'])
-
-                    if 'error' in result:
-                        errors.append(result['error'])
-
-                    if 'investigate_column' in result:
-                        investigate_columns.append(result['investigate_column'])
-
-                    results.task_done()
-                except Queue.Empty, e:
-                    break
-
-            log.info('Critical columns:\n%s\n\nWarning columns:\n%s' % (
-                pprint.pformat(critical_columns),
-                pprint.pformat(warning_columns)))
-
-            if len(critical_columns) > 0:
-                columns = sorted(critical_columns) + sorted(warning_columns)
-                status = pynagios.CRITICAL
-            elif len(warning_columns) > 0:
-                columns = warning_columns
-                status = pynagios.WARNING
-            else:
-                status = pynagios.OK
-
-            msg = ''
-            if status != pynagios.OK:
-                msg = '\n'.join(
-                    '%s.%s\t%s\t%s\t%s\t%.2f%%' % (
-                        col.get('schema'),
-                        col.get('table'),
-                        col.get('column_name'),
-                        col.get('column_type'),
-                        col.get('max_value'),
-                        col.get('overflow_percentage')) for col in columns)
-                msg = '\n' + msg
-
-                ##############################################################
-                # store critical/warning columns in db
-                ##############################################################
-                if self.results_db_conn_opts:
-                    conn = MySQLdb.connect(**self.results_db_conn_opts)
-                    with conn as cursor:
-                        sql = (
-                            "INSERT INTO int_overflow_check_results("
-                            "  hostname, dbname, table_name, column_name, "
-                            "  max_size, percentage, reason, timestamp) "
-                            "VALUE (%s, %s, %s, %s, %s, %s, %s, %s)")
-
-                        for col in critical_columns:
-                            cursor.execute(
-                                sql,
-                                (
-                                    hostname, col.get('schema'),
-                                    col.get('table'),
-                                    col.get('column_name'),
-                                    col.get('max_value'),
-                                    col.get('overflow_percentage'),
-                                    'critical', datetime.datetime.now()))
-
-                        for col in warning_columns:
-                            cursor.execute(
-                                sql,
-                                (
-                                    hostname, col.get('schema'),
-                                    col.get('table'),
-                                    col.get('column_name'),
-                                    col.get('max_value'),
-                                    col.get('overflow_percentage'),
-                                    'warning', datetime.datetime.now()))
-
-
-            row_count_max_ratio = self.merged_options.get('row_count_max_ratio', 0)
+            command, command_args = self.get_command()
+            if command == 'merge':
+                return self.merge_shard_files(command_args)
+
+            log.debug(
+                'Check started with the following options:\n%s',
+                LazyFormat(self.merged_options))
+
+            targets = self.get_targets()
+            self.fleet = 'hosts' in merged_options
+            host_options = dict(
+                (get_host_tag(options), options) for options in targets)
+
+            fail_fast = merged_options.get('fail_fast')
+            stopped = False
+            deadline = None
+            if merged_options.get('deadline'):
+                deadline = started + merged_options['deadline']
+            deadline_reached = False
+            # kills the metadata queries at the deadline, then the MAX
+            # queries at the deadline, their timeout or the first critical
+            # column
+            watchdog = None
+            if deadline or fail_fast or merged_options.get('query_timeout'):
+                watchdog = self.watchdog = QueryWatchdog(
+                    query_timeout=merged_options.get('query_timeout'),
+                    deadline=deadline)
+                watchdog.start()
+
+            # discover and plan the tables of all hosts concurrently, the
+            # tables of a dump are read from its files instead
+            scan_targets = targets
+            if merged_options.get('dump'):
+                scan_targets = []
+            streaming = bool(merged_options.get('stream_metadata'))
+            if streaming and (
+                    merged_options.get('dump') or
+                    merged_options.get('dry_run') or
+                    merged_options.get('budget') is not None):
+                log.warning(
+                    'stream_metadata is ignored with dump, dry_run and '
+                    'budget, which need all tables before scanning.')
+                streaming = False
+            # streamed tables are discovered while they are scanned
+            planned_targets = scan_targets
+            if streaming:
+                planned_targets = []
+            host_schema_tables = []
+            host_errors = []
+            outcomes = map_concurrently(
+                self.get_planned_schema_tables, planned_targets,
+                merged_options['threads'], deadline=deadline)
+            for options, (schema_tables, error) in zip(
+                    planned_targets, outcomes):
+                if error is not None:
+                    # the tables found so far are still checked when the
+                    # deadline is reached
+                    if not self.fleet and not isinstance(
+                            error, MetadataKilled):
+                        raise error
+                    host_errors.append(dict(
+                        hostname=get_host_tag(options),
+                        error='%s: %s' % (type(error), error)))
+                else:
+                    host_schema_tables.append((options, schema_tables))
+
+            if self.merged_options.get('dry_run'):
+                return self.explain_plan(host_schema_tables)
+
+            # choose the servers which run the MAX queries of each host
+            routers = {}
+            outcomes = map_concurrently(
+                self.get_replica_router, scan_targets,
+                merged_options['threads'])
+            for options, (router, error) in zip(scan_targets, outcomes):
+                if error is not None:
+                    raise error
+                if router:
+                    routers[get_host_tag(options)] = router
+
+            results = Queue.Queue(RESULTS_QUEUE_SIZE)
+            skipped_columns = []
+            state_store = None
+            if merged_options.get('state_file'):
+                state_store = StateStore(merged_options['state_file'])
+            results_writer = None
+            # the results of a shard are written by the merge command
+            if (
+                    self.results_db_conn_opts and
+                    not merged_options.get('shard_file')):
+                results_writer = ResultsWriter(
+                    self.pool, self.results_db_conn_opts,
+                    batch_size=merged_options['results_batch_size'],
+                    background=merged_options.get('results_writer_thread'))
+            stream = None
+            stream_output = merged_options.get('stream_output')
+            if stream_output == '-':
+                stream = sys.stdout
+            elif stream_output:
+                stream = open(stream_output, 'a')
+            collector = ResultCollector(results_writer, state_store, stream)
+            controller = None
+            if any(
+                    options.get(name) for options in targets
+                    for name in (
+                        'max_threads_running', 'max_buffer_pool_reads',
+                        'max_rows_per_second')):
+                controller = LoadController()
+                controller.start()
+
+            try:
+                if merged_options.get('dump'):
+                    self.process_dump(merged_options, collector)
+
+                host_states = {}
+                if state_store:
+                    for options in scan_targets:
+                        hostname = get_host_tag(options)
+                        host_states[hostname] = (
+                            state_store.get_column_states(hostname),
+                            state_store.get_growth_rates(hostname))
+
+                host_work = []
+                for options, schema_tables in host_schema_tables:
+                    hostname = get_host_tag(options)
+                    column_states, growth_rates = host_states.get(
+                        hostname, ({}, {}))
+                    work, host_skipped_columns = self.get_host_work(
+                        schema_tables, options, collector, state_store,
+                        column_states, growth_rates)
+                    skipped_columns.extend(host_skipped_columns)
+                    host_work.append(work)
+
+                # metadata may already show a critical column
+                stopped_tables = set()
+                if fail_fast and collector.critical_columns:
+                    stopped = True
+                    stopped_tables.update(
+                        get_table_key(v) for work in host_work for v in work)
+                    host_work = []
+
+                costs = [
+                    v.get('estimated_cost', 0)
+                    for items in host_work for v in items]
+
+                # in fleet mode, workers skip the tables of a host which
+                # runs as many queries as it allows, instead of waiting for
+                # one of its connections
+                host_limits = {}
+                if self.fleet:
+                    for options in scan_targets:
+                        hostname = get_host_tag(options)
+                        router = routers.get(hostname)
+                        servers = 1
+                        if router and router.replicas:
+                            servers = len(router.replicas)
+                        host_limits[hostname] = (
+                            options['max_connections'] * servers)
+
+                # interleave the hosts so that workers are spread across hosts
+                q = WorkQueue(host_limits=host_limits, controller=controller)
+                for work in itertools.izip_longest(*host_work):
+                    for v in work:
+                        if v is not None:
+                            q.put(v)
+
+                # each worker stops at a sentinel, after all tables
+                if merged_options.get('engine') == 'async':
+                    workers = 1
+                else:
+                    workers = self.merged_options['threads']
+                if not streaming:
+                    for n in range(workers):
+                        q.put(None)
+
+                scan_started = time.time()
+                thread_list = []
+                if merged_options.get('engine') == 'async':
+                    thread = AsyncTableProcessor(
+                        schema_tables=q,
+                        merged_options=self.merged_options,
+                        results=results,
+                        host_options=host_options,
+                        watchdog=watchdog,
+                        routers=routers,
+                        controller=controller)
+                    thread.name = 'Async'
+                    thread.start()
+                    thread_list.append(thread)
+                else:
+                    for n in range(workers):
+                        thread = TableProcessor(
+                            schema_tables=q,
+                            merged_options=self.merged_options,
+                            results=results,
+                            pool=self.pool,
+                            host_options=host_options,
+                            watchdog=watchdog,
+                            routers=routers,
+                            controller=controller)
+                        thread.name = 'Thread #%d' % (n,)
+                        thread.daemon = True
+                        thread.start()
+                        thread_list.append(thread)
+
+                streamer = None
+                if streaming:
+                    streamer = MetadataStreamer(
+                        checker=self,
+                        targets=scan_targets,
+                        schema_tables=q,
+                        results=results,
+                        state_store=state_store,
+                        host_states=host_states,
+                        workers=workers,
+                        threads=merged_options['threads'])
+                    streamer.name = 'Metadata'
+                    streamer.start()
+
+                # collect results as they arrive until all workers are done
+                log.debug('Waiting for all threads to finish running.')
+                running = len(thread_list)
+                while running:
+                    timeout = None
+                    if deadline_reached:
+                        timeout = max(
+                            deadline + DEADLINE_GRACE - time.time(), 0)
+                    elif deadline:
+                        timeout = max(deadline - time.time(), 0)
+                    try:
+                        result = results.get(True, timeout)
+                    except Queue.Empty:
+                        if deadline_reached:
+                            log.warning(
+                                'Workers did not stop after the deadline.')
+                            break
+                        log.info('Deadline reached, stopping.')
+                        deadline_reached = True
+                        for thread in thread_list:
+                            thread.stop_event.set()
+                        continue
+                    if 'done' in result:
+                        running -= 1
+                    collector.add(result)
+                    if (
+                            fail_fast and not stopped and
+                            collector.critical_columns):
+                        log.info('Critical column found, stopping.')
+                        stopped = True
+                        for thread in thread_list:
+                            thread.stop_event.set()
+                        # the queries in flight are not waited for
+                        watchdog.expire_all('fail fast')
+                if running:
+                    # the workers still running are abandoned
+                    while True:
+                        try:
+                            result = results.get_nowait()
+                        except Queue.Empty:
+                            break
+                        collector.add(result)
+                else:
+                    for thread in thread_list:
+                        thread.join()
+                    log.debug('All threads finished.')
+
+                if streamer:
+                    # the workers are done, stop at the next batch
+                    streamer.stop_event.set()
+                    if deadline:
+                        stop_timeout = deadline + DEADLINE_GRACE
+                    else:
+                        stop_timeout = time.time() + DEADLINE_GRACE
+                    while (
+                            streamer.is_alive() and
+                            time.time() < stop_timeout):
+                        try:
+                            collector.add(results.get(True, 0.1))
+                        except Queue.Empty:
+                            pass
+                    while True:
+                        try:
+                            result = results.get_nowait()
+                        except Queue.Empty:
+                            break
+                        collector.add(result)
+                    if streamer.error:
+                        raise streamer.error
+                    costs.extend(streamer.costs)
+                    skipped_columns.extend(streamer.skipped_columns)
+                    for options, error in streamer.errors:
+                        if isinstance(error, MetadataKilled):
+                            if error.reason == 'fail fast':
+                                # reported as stopped
+                                continue
+                        elif not self.fleet:
+                            raise error
+                        host_errors.append(dict(
+                            hostname=get_host_tag(options),
+                            error='%s: %s' % (type(error), error)))
+                    if streamer.is_alive():
+                        # the streamer is abandoned, the metadata of its
+                        # hosts may not be complete
+                        log.warning('Metadata streamer did not stop.')
+                        for options in scan_targets:
+                            host_errors.append(dict(
+                                hostname=get_host_tag(options),
+                                error='Metadata streaming did not stop.'))
+
+                if merged_options.get('engine') == 'async':
+                    concurrency = merged_options['async_queries']
+                else:
+                    concurrency = workers
+                self.makespan = self.get_makespan(
+                    collector.table_times, costs, concurrency,
+                    time.time() - scan_started)
+                log.info(
+                    'Makespan: %(actual).2fs, expected %(expected).2fs, '
+                    'ideal %(ideal).2fs (%(tables)s tables, %(concurrency)s '
+                    'concurrent queries)' % self.makespan)
+
+                if deadline_reached or stopped:
+                    # tables which were not started before the deadline or
+                    # the first critical column
+                    for schema_table in q.drain():
+                        if deadline_reached:
+                            put_unchecked_columns(
+                                collector, schema_table, 'deadline')
+                        else:
+                            stopped_tables.add(get_table_key(schema_table))
+
+                collector.flush()
+            except:
+                if results_writer:
+                    results_writer.close(commit=False)
+                raise
+            finally:
+                if controller:
+                    controller.stop_event.set()
+                    controller.join()
+                if state_store:
+                    state_store.close()
+                if stream and stream is not sys.stdout:
+                    stream.close()
+
+            if results_writer:
+                results_writer.close()
+
+            critical_columns = collector.critical_columns
+            warning_columns = collector.warning_columns
+            investigate_columns = collector.investigate_columns
+            unchecked_columns = collector.unchecked_columns
+
+            log.info(
+                'Critical columns:\n%s\n\nWarning columns:\n%s',
+                LazyFormat(critical_columns), LazyFormat(warning_columns))
             if investigate_columns:
-                log.info('Investigate columns:\n%s' % (pprint.pformat(
-                    investigate_columns,)))
-                if msg:
-                    msg += '\n'
-                msg += (
-                    ('\nColumns containing high values compared to maximum for the column datatype, but number of rows is less than %s%% of maximum for the column type:\n' % (row_count_max_ratio,)) +
-                    ('\n'.join(
-                        '%s.%s\t%s\t%s\t%s\t%.2f%%' % (
-                            col.get('schema'),
-                            col.get('table'),
-                            col.get('column_name'),
-                            col.get('column_type'),
-                            col.get('max_value'),
-                            col.get('overflow_percentage')) for col in investigate_columns))
-                    )
-
-                ##############################################################
-                # store investigate columns in db
-                ##############################################################
-                if self.results_db_conn_opts:
-                    conn = MySQLdb.connect(**self.results_db_conn_opts)
-                    with conn as cursor:
-                        sql = (
-                            "INSERT INTO int_overflow_check_results("
-                            "  hostname, dbname, table_name, column_name, "
-                            "  max_size, percentage, reason, timestamp) "
-                            "VALUE (%s, %s, %s, %s, %s, %s, %s, %s)")
-
-                        for col in investigate_columns:
-                            cursor.execute(
-                                sql,
-                                (
-                                    hostname, col.get('schema'),
-                                    col.get('table'),
-                                    col.get('column_name'),
-                                    col.get('max_value'),
-                                    col.get('overflow_percentage'),
-                                    'investigate', datetime.datetime.now()))
-
+                log.info(
+                    'Investigate columns:\n%s',
+                    LazyFormat(investigate_columns))
+            if unchecked_columns:
+                log.info(
+                    'Columns not checked:\n%s', LazyFormat(unchecked_columns))
+
+            status, msg = self.get_status_message(
+                critical_columns, warning_columns, investigate_columns,
+                skipped_columns, host_errors, self.fleet, unchecked_columns)
+            if stopped:
+                # tables whose query was killed or which a worker dequeued
+                # after the stop
+                stopped_tables.update(
+                    get_table_key(v) for v in unchecked_columns
+                    if v['reason'] in ('fail fast', 'stopped'))
+                if stopped_tables:
+                    if msg:
+                        msg += '\n'
+                    msg += (
+                        '\nStopped at the first critical column (fail_fast), '
+                        '%d tables were not checked.' % (len(stopped_tables),))
+
+            if merged_options.get('fleet_output_dir'):
+                self.write_fleet_outputs(
+                    host_options, critical_columns, warning_columns,
+                    investigate_columns, skipped_columns, host_errors,
+                    unchecked_columns)
 
             log.info('status: %s\n\nmsg:\n%s' % (status, msg))
 
+            response = Response(status, msg)
+            metrics = self.get_metrics(collector, started)
+            self.set_perf_data(response, metrics)
+            self.write_metrics(metrics)
+            self.metrics = metrics
+            self.flagged_columns = dict(
+                critical=critical_columns,
+                warning=warning_columns,
+                investigate=investigate_columns,
+                unchecked=unchecked_columns)
+            if merged_options.get('shard_file'):
+                self.write_shard_file(
+                    status, metrics, skipped_columns, host_errors)
+
             self.exit_code = status.exit_code
-            return Response(status, msg)
+            return response
         except Exception, e:
             log.exception('Exception.')
             return Response(pynagios.UNKNOWN, 'ERROR: {0}'.format(e))
+        finally:
+            if self.watchdog:
+                self.watchdog.stop_event.set()
+                self.watchdog.join()
+            if self.pool:
+                self.pool.close()
 
 
 if __name__ == "__main__":
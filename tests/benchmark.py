@@ -0,0 +1,341 @@
+#!/usr/bin/env python
+#
+# File: benchmark.py
+# Purpose: Measure how the check scales on a synthetic schema
+#
+# Notes:
+#   - Generates N schemas x M tables x K integer columns on a local MySQL
+#     server, times metadata discovery, scanning at several thread counts,
+#     classification and results writing, and writes the numbers to a
+#     JSON file so that versions can be compared.
+#   - The user needs CREATE and DROP grants. The generated schemas are
+#     dropped at the end unless --keep is given.
+#
+
+import json
+import optparse
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+
+import MySQLdb
+
+# Append module directory to path so we can import the plugin
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(ROOT_DIR)
+
+import classification
+from pdb_check_maxvalue import CheckMaxValue, ConnectionPool, ResultsWriter
+
+SCHEMA_PREFIX = 'pdbbench_'
+RESULTS_SCHEMA = 'pdbbench_results'
+
+# column types of the generated tables, cycled over the columns
+COLUMN_TYPES = [
+    'int(11)', 'bigint(20)', 'int(10) unsigned', 'smallint(6)',
+    'mediumint(9)', 'tinyint(4)']
+
+# rows inserted by each statement
+INSERT_BATCH_SIZE = 1000
+
+RESULTS_TABLE = '''
+    CREATE TABLE `int_overflow_check_results` (
+      `id` int(11) NOT NULL AUTO_INCREMENT,
+      `hostname` varchar(255) DEFAULT NULL,
+      `dbname` varchar(255) DEFAULT NULL,
+      `table_name` varchar(255) DEFAULT NULL,
+      `column_name` varchar(255) DEFAULT NULL,
+      `max_size` bigint(20) unsigned DEFAULT NULL,
+      `percentage` float DEFAULT NULL,
+      `reason` text,
+      `timestamp` datetime DEFAULT NULL,
+      `run_id` char(32) DEFAULT NULL,
+      PRIMARY KEY (`id`),
+      KEY `run_id` (`run_id`)
+    ) ENGINE=InnoDB
+'''
+
+
+def parse_options(argv):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-H', '--hostname', default='localhost')
+    parser.add_option('-P', '--port', type=int, default=3306)
+    parser.add_option('-u', '--user', default=None)
+    parser.add_option('-p', '--password', default=None)
+    parser.add_option(
+        '--schemas', type=int, default=2, help='Number of schemas.')
+    parser.add_option(
+        '--tables', type=int, default=50, help='Tables per schema.')
+    parser.add_option(
+        '--columns', type=int, default=4,
+        help='Integer columns per table, besides the primary key.')
+    parser.add_option(
+        '--indexed-ratio', type=float, default=0.5,
+        help='Fraction of the columns of each table which lead an index.')
+    parser.add_option(
+        '--rows', type=int, default=1000, help='Rows per table.')
+    parser.add_option(
+        '--threads', default='1,2,4,8',
+        help='Comma-separated thread counts of the scan runs.')
+    parser.add_option(
+        '--engines', default='threads',
+        help='Comma-separated scan engines (threads, async).')
+    parser.add_option(
+        '--classify-items', type=int, default=100000,
+        help='Number of values classified in the classification run.')
+    parser.add_option(
+        '--results-rows', type=int, default=10000,
+        help='Number of rows written in the results writing run.')
+    parser.add_option(
+        '--seed', type=int, default=0,
+        help='Random seed, the same seed generates the same data.')
+    parser.add_option(
+        '--output', default='benchmark.json',
+        help='JSON file where the numbers are written.')
+    parser.add_option(
+        '--keep', action='store_true', default=False,
+        help='Keep the generated schemas, and reuse them if they exist.')
+    options, args = parser.parse_args(argv)
+    return options
+
+
+def get_connection_options(options):
+    connection_options = dict(host=options.hostname, port=options.port)
+    if options.user:
+        connection_options['user'] = options.user
+    if options.password:
+        connection_options['passwd'] = options.password
+    return connection_options
+
+
+def get_check_args(options, *args):
+    """Returns the arguments of a check of the generated schemas."""
+    check_args = [
+        '-H', options.hostname, '--port', str(options.port),
+        '-d', ','.join(get_schema_names(options)),
+        '--warning', '80', '--critical', '95', '--row-count-max-ratio', '0',
+        '--scan-all-columns']
+    if options.user:
+        check_args.extend(['-u', options.user])
+    if options.password:
+        check_args.extend(['-p', options.password])
+    return check_args + list(args)
+
+
+def get_schema_names(options):
+    return ['%s%d' % (SCHEMA_PREFIX, i) for i in range(options.schemas)]
+
+
+def timed(func, *args, **kwargs):
+    """Returns the result of func and the seconds it took."""
+    started = time.time()
+    result = func(*args, **kwargs)
+    return result, time.time() - started
+
+
+def generate_schemas(conn, options):
+    """Creates the synthetic schemas, returns the number of rows inserted."""
+    rng = random.Random(options.seed)
+    indexed_columns = int(round(options.columns * options.indexed_ratio))
+    inserted = 0
+    cur = conn.cursor()
+    try:
+        for schema in get_schema_names(options):
+            if options.keep:
+                cur.execute(
+                    'SELECT COUNT(*) FROM INFORMATION_SCHEMA.SCHEMATA '
+                    'WHERE SCHEMA_NAME = %s', (schema,))
+                if cur.fetchone()[0]:
+                    continue
+            cur.execute('CREATE SCHEMA `%s`' % (schema,))
+            for t in range(options.tables):
+                column_types = [
+                    COLUMN_TYPES[(t + k) % len(COLUMN_TYPES)]
+                    for k in range(options.columns)]
+                definitions = ['`id` int(11) NOT NULL AUTO_INCREMENT'] + [
+                    '`c%d` %s DEFAULT NULL' % (k, column_type)
+                    for k, column_type in enumerate(column_types)]
+                definitions.append('PRIMARY KEY (`id`)')
+                definitions.extend(
+                    'KEY `c%d` (`c%d`)' % (k, k)
+                    for k in range(indexed_columns))
+                cur.execute('CREATE TABLE `%s`.`t%d` (%s) ENGINE=InnoDB' % (
+                    schema, t, ', '.join(definitions)))
+
+                # each column is filled up to a random fraction of its type
+                highs = [
+                    int(classification.get_limit(column_type) *
+                        rng.random())
+                    for column_type in column_types]
+                insert = 'INSERT INTO `%s`.`t%d` (%s) VALUES (%s)' % (
+                    schema, t,
+                    ', '.join('`c%d`' % (k,) for k in range(options.columns)),
+                    ', '.join(['%s'] * options.columns))
+                for start in range(0, options.rows, INSERT_BATCH_SIZE):
+                    rows = [
+                        [rng.randint(0, high) for high in highs]
+                        for _ in range(
+                            min(INSERT_BATCH_SIZE, options.rows - start))]
+                    cur.executemany(insert, rows)
+                    inserted += len(rows)
+                conn.commit()
+    finally:
+        cur.close()
+    return inserted
+
+
+def drop_schemas(conn, options):
+    cur = conn.cursor()
+    try:
+        for schema in get_schema_names(options) + [RESULTS_SCHEMA]:
+            cur.execute('DROP SCHEMA IF EXISTS `%s`' % (schema,))
+    finally:
+        cur.close()
+
+
+def bench_metadata(options):
+    """Times discovery and planning of the generated schemas."""
+    checker = CheckMaxValue(args=get_check_args(options))
+    checker.merge_options()
+    checker.pool = ConnectionPool()
+    checker.metadata_cache = None
+    checker.metadata_times = {}
+    try:
+        schema_tables, seconds = timed(
+            checker.get_planned_schema_tables, checker.merged_options)
+    finally:
+        checker.pool.close()
+    return dict(
+        seconds=seconds,
+        tables=len(schema_tables),
+        columns=sum(len(v['columns']) for v in schema_tables.itervalues()))
+
+
+def bench_scan(options, engine, threads):
+    """Times a full check of the generated schemas."""
+    args = ['--threads', str(threads), '--engine', engine]
+    if engine == 'async':
+        args.extend(['--async-queries', str(threads)])
+    checker = CheckMaxValue(args=get_check_args(options, *args))
+    response, seconds = timed(checker.check)
+    return dict(
+        engine=engine,
+        threads=threads,
+        seconds=seconds,
+        exit_code=getattr(checker, 'exit_code', None),
+        makespan=getattr(checker, 'makespan', None))
+
+
+def bench_classification(options):
+    """Times classification of random values of all column types."""
+    rng = random.Random(options.seed)
+    items = []
+    for i in range(options.classify_items):
+        column_type = COLUMN_TYPES[i % len(COLUMN_TYPES)]
+        limit = classification.get_limit(column_type)
+        items.append((rng.randint(0, limit), column_type, rng.randint(0, limit)))
+    thresholds = classification.Thresholds(95, 80, 0)
+
+    runs = []
+    for use_numpy in (False, True):
+        if use_numpy and classification.numpy is None:
+            continue
+        classified, seconds = timed(
+            classification.classify_batch, items, thresholds,
+            use_numpy=use_numpy)
+        runs.append(dict(
+            numpy=use_numpy,
+            items=len(items),
+            seconds=seconds,
+            flagged=len([c for c in classified if c[0]])))
+    return runs
+
+
+def bench_results_writing(conn, options):
+    """Times writing flagged columns to a results database."""
+    cur = conn.cursor()
+    try:
+        cur.execute('CREATE SCHEMA IF NOT EXISTS `%s`' % (RESULTS_SCHEMA,))
+        cur.execute('DROP TABLE IF EXISTS `%s`.`int_overflow_check_results`' % (
+            RESULTS_SCHEMA,))
+        cur.execute('USE `%s`' % (RESULTS_SCHEMA,))
+        cur.execute(RESULTS_TABLE)
+    finally:
+        cur.close()
+
+    connection_options = dict(
+        get_connection_options(options), db=RESULTS_SCHEMA)
+    pool = ConnectionPool()
+    try:
+        writer = ResultsWriter(pool, connection_options)
+        started = time.time()
+        for i in range(options.results_rows):
+            writer.add('warning', dict(
+                hostname=options.hostname, schema='%s0' % (SCHEMA_PREFIX,),
+                table='t%d' % (i,), column_name='c0', max_value=i,
+                overflow_percentage=90.0))
+        writer.close()
+        seconds = time.time() - started
+    finally:
+        pool.close()
+    return dict(rows=options.results_rows, seconds=seconds)
+
+
+def get_version():
+    """Returns the git version of the plugin, None outside a checkout."""
+    try:
+        return subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'],
+            cwd=ROOT_DIR, stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv):
+    options = parse_options(argv)
+    conn = MySQLdb.connect(**get_connection_options(options))
+    try:
+        server_version = conn.get_server_info()
+        inserted, generate_seconds = timed(generate_schemas, conn, options)
+        try:
+            metadata = bench_metadata(options)
+            scans = [
+                bench_scan(options, engine, int(threads))
+                for engine in options.engines.split(',')
+                for threads in options.threads.split(',')]
+            classify = bench_classification(options)
+            results_writing = bench_results_writing(conn, options)
+        finally:
+            if not options.keep:
+                drop_schemas(conn, options)
+    finally:
+        conn.close()
+
+    report = dict(
+        version=get_version(),
+        timestamp=time.strftime('%Y-%m-%dT%H:%M:%S'),
+        python=platform.python_version(),
+        mysql=server_version,
+        parameters=dict(
+            schemas=options.schemas,
+            tables=options.tables,
+            columns=options.columns,
+            indexed_ratio=options.indexed_ratio,
+            rows=options.rows,
+            seed=options.seed),
+        generate=dict(rows=inserted, seconds=generate_seconds),
+        metadata=metadata,
+        scans=scans,
+        classification=classify,
+        results_writing=results_writing)
+    with open(options.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print('Benchmark written to %s' % (options.output,))
+    return report
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
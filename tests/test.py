@@ -53,6 +53,24 @@ class PdbCheckMaxValueTest(unittest.TestCase):
         check_max_value.check()
         return self.assertEqual(check_max_value.exit_code, 2)
 
+    def test_check_max_value_scan_all_columns(self):
+        check_max_value = self.CheckMaxValue(args=shlex.split('-d pdbmaxcheck_test --warning 50 --critical 99 --row-count-max-ratio 0 --scan-all-columns'))
+        check_max_value.check()
+        return self.assertEqual(check_max_value.exit_code, 2)
+
+    def test_check_max_value_auto_increment_metadata(self):
+        # An empty table whose next auto-increment value is near the max of INT
+        cursor = self.db.cursor()
+        cursor.execute('''
+            CREATE TABLE `tbl_auto_increment` (
+              `id` int(11) NOT NULL AUTO_INCREMENT,
+              PRIMARY KEY (`id`)
+            ) ENGINE=InnoDB AUTO_INCREMENT=2147483000 DEFAULT CHARSET=latin1;
+        ''')
+        check_max_value = self.CheckMaxValue(args=shlex.split('-d pdbmaxcheck_test --warning 50 --critical 99 --row-count-max-ratio 0 --auto-increment-metadata'))
+        check_max_value.check()
+        return self.assertEqual(check_max_value.exit_code, 2)
+
     def tearDown(self):
         # Drop Test DATABASE
         cursor = self.db.cursor()
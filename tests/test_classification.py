@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import unittest
+
+# Append module directory to path so we can import the classification module
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import classification
+from classification import CRITICAL, INVESTIGATE, WARNING, Thresholds
+
+
+class ClassificationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.thresholds = Thresholds(99.99, 80, 0)
+
+    def test_limits(self):
+        self.assertEqual(classification.get_limit('tinyint(4)'), 127)
+        self.assertEqual(
+            classification.get_limit('int(10) unsigned'), 4294967295)
+        self.assertEqual(
+            classification.get_limit('bigint(20) unsigned zerofill'),
+            18446744073709551615)
+        self.assertEqual(classification.get_limit('integer'), 2147483647)
+        self.assertEqual(classification.get_limit('point'), None)
+
+    def test_bigint_near_max(self):
+        # 99.99% and 100% of bigint are the same float
+        limit = 2 ** 63 - 1
+        at_threshold = limit * 9999 // 10000
+        self.assertEqual(
+            classification.classify(
+                at_threshold, limit, limit, self.thresholds),
+            WARNING)
+        self.assertEqual(
+            classification.classify(
+                at_threshold + 1, limit, limit, self.thresholds),
+            CRITICAL)
+
+    def test_row_count_max_ratio(self):
+        thresholds = Thresholds(90, 80, 50, display_investigate=True)
+        self.assertEqual(
+            classification.classify(127, 127, 64, thresholds), CRITICAL)
+        self.assertEqual(
+            classification.classify(127, 127, 63, thresholds), INVESTIGATE)
+        thresholds = Thresholds(90, 80, 50)
+        self.assertEqual(
+            classification.classify(127, 127, 63, thresholds), None)
+
+    def test_classify_batch(self):
+        items = [
+            (127, 'tinyint(4)', 127),
+            (110, 'tinyint(4)', 127),
+            (None, 'int(11)', 0),
+            (2 ** 64 - 1, 'bigint(20) unsigned', 1),
+            (5, 'point', 0),
+        ]
+        classified = classification.classify_batch(items, self.thresholds)
+        self.assertEqual(
+            [category for category, _, _ in classified],
+            [CRITICAL, WARNING, None, CRITICAL, None])
+        self.assertEqual(classified[0][1], 100.0)
+        self.assertEqual(classified[4], (None, 0, 0))
+
+    @unittest.skipIf(classification.numpy is None, 'numpy is not installed')
+    def test_classify_batch_numpy(self):
+        items = [
+            (value, column_type, value)
+            for column_type in (
+                'tinyint(4)', 'smallint(5) unsigned', 'int(11)',
+                'bigint(20) unsigned')
+            for value in range(-200, 70000, 97)]
+        self.assertEqual(
+            classification.classify_batch(
+                items, self.thresholds, use_numpy=True),
+            classification.classify_batch(
+                items, self.thresholds, use_numpy=False))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+# Append module directory to path so we can import the check module
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import pynagios
+from pynagios import Response
+
+from pdb_check_maxvalue import (
+    CheckMaxValue, ConnectionPool, ResultCollector, StatusCache, StatusServer)
+
+
+class StatusCacheTest(unittest.TestCase):
+
+    def test_no_run(self):
+        self.assertEqual(StatusCache().get(), None)
+
+    def test_update(self):
+        cache = StatusCache()
+        column = dict(schema='s', table='t', column_name='id')
+        cache.update(
+            Response(pynagios.CRITICAL, 'msg'),
+            dict(critical=[column], warning=[]), dict(tables=1), 0)
+        status = cache.get()
+        self.assertEqual(status['status'], 'CRIT')
+        self.assertEqual(status['exit_code'], 2)
+        self.assertEqual(status['columns'], [dict(column, reason='critical')])
+        self.assertTrue(0 <= status['age'] < 60)
+
+    def test_failed_run_keeps_columns(self):
+        cache = StatusCache()
+        column = dict(schema='s', table='t', column_name='id')
+        cache.update(
+            Response(pynagios.WARNING, 'msg'), dict(warning=[column]), {}, 0)
+        cache.update(Response(pynagios.UNKNOWN, 'ERROR: down'), None, {}, 0)
+        status = cache.get()
+        self.assertEqual(status['status'], 'UNKNOWN')
+        self.assertEqual(status['columns'], [dict(column, reason='warning')])
+
+
+class QueryDaemonTest(unittest.TestCase):
+
+    metrics = dict(
+        run_time=1.0, metadata_time=0.1, scan_time=0.9, max_query_time=0.5,
+        queue_wait=0.0, connect_time=0.0, tables=2, columns=3, critical=1,
+        warning=0, unchecked=0, utilization=0.5)
+
+    def setUp(self):
+        self.cache = StatusCache()
+        self.server = StatusServer(('127.0.0.1', 0), self.cache)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://127.0.0.1:%d' % (self.server.server_address[1],)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def query(self, *args):
+        checker = CheckMaxValue(args=[
+            'pdb_check_maxvalue.py', '--daemon-url', self.url] + list(args))
+        return checker.check()
+
+    def update(self, status, age):
+        self.cache.update(
+            Response(status, 'db1.t\tid'), dict(critical=[]),
+            self.metrics, 0)
+        self.cache.status['finished'] -= age
+
+    def test_no_run(self):
+        response = self.query()
+        self.assertEqual(response.status, pynagios.UNKNOWN)
+        self.assertIn('503', response.message)
+
+    def test_cached_status(self):
+        self.update(pynagios.CRITICAL, 100)
+        response = self.query('--daemon-max-age', '900')
+        self.assertEqual(response.status, pynagios.CRITICAL)
+        self.assertIn('db1.t\tid', response.message)
+        self.assertIn('Checked 100 seconds ago.', response.message)
+        self.assertIn('age=100s', str(response))
+        self.assertIn('tables=2', str(response))
+
+    def test_stale_status(self):
+        self.update(pynagios.CRITICAL, 1000)
+        response = self.query('--daemon-max-age', '900')
+        self.assertEqual(response.status, pynagios.UNKNOWN)
+        self.assertIn('over 900 seconds', response.message)
+        # without max age, old data is still returned
+        self.assertEqual(self.query().status, pynagios.CRITICAL)
+
+    def test_unreachable(self):
+        self.url = 'http://127.0.0.1:1'
+        self.assertEqual(self.query().status, pynagios.UNKNOWN)
+
+
+class StatusMessageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.checker = CheckMaxValue(args=['pdb_check_maxvalue.py'])
+        self.checker.merged_options = dict(row_count_max_ratio=50)
+
+    def column(self, max_value=None, reason=None):
+        return dict(
+            hostname='db1', schema='s', table='t', column_name='id',
+            column_type='int(11)', max_value=max_value,
+            overflow_percentage=95.0, reason=reason)
+
+    def test_status(self):
+        get = self.checker.get_status_message
+        self.assertEqual(get([], [], [], [], [], False)[0], pynagios.OK)
+        self.assertEqual(
+            get([], [self.column(2 ** 31 - 10)], [], [], [], False)[0],
+            pynagios.WARNING)
+        self.assertEqual(
+            get([self.column(2 ** 31 - 1)], [], [], [], [], False)[0],
+            pynagios.CRITICAL)
+        host_errors = [dict(hostname='db2', error='down')]
+        status, msg = get([], [], [], [], host_errors, True)
+        self.assertEqual(status, pynagios.UNKNOWN)
+        self.assertIn('db2\tERROR: down', msg)
+
+    def test_unchecked_columns(self):
+        status, msg = self.checker.get_status_message(
+            [], [], [], [], [], True, [self.column(reason='deadline')])
+        # columns which were not checked do not change the status
+        self.assertEqual(status, pynagios.OK)
+        self.assertIn('Columns not checked:', msg)
+        self.assertIn('db1:s.t\tid\tint(11)\tdeadline', msg)
+
+
+class FleetTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.checker = CheckMaxValue(args=['pdb_check_maxvalue.py'])
+        self.checker.merged_options = dict(
+            user='nagios', threads=10, host_threads=2, use_dbs='db1,db2',
+            row_count_max_ratio=50, fleet_output_dir=self.directory,
+            hosts=['db1', dict(hostname='db2', threads=4, use_dbs='db3')])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_targets(self):
+        db1, db2 = self.checker.get_targets()
+        self.assertEqual(db1['hostname'], 'db1')
+        self.assertEqual(db1['user'], 'nagios')
+        self.assertEqual(db1['threads'], 2)
+        self.assertEqual(db1['max_connections'], 2)
+        self.assertEqual(db1['use_dbs'], ['db1', 'db2'])
+        self.assertNotIn('hosts', db1)
+        # the options of a host override the global options
+        self.assertEqual(db2['threads'], 4)
+        self.assertEqual(db2['max_connections'], 4)
+        self.assertEqual(db2['use_dbs'], ['db3'])
+
+    def test_single_host(self):
+        del self.checker.merged_options['hosts']
+        self.assertEqual(
+            self.checker.get_targets(), [self.checker.merged_options])
+
+    def test_host_outputs(self):
+        critical = dict(
+            hostname='db1', schema='s', table='t', column_name='id',
+            column_type='int(11)', max_value=2 ** 31 - 1,
+            overflow_percentage=100.0)
+        host_errors = [dict(hostname='db2', error='down')]
+        status, msg = self.checker.get_status_message(
+            [critical], [], [], [], host_errors, True)
+        self.assertEqual(status, pynagios.CRITICAL)
+        self.assertIn('db1:s.t\tid', msg)
+        self.assertIn('db2\tERROR: down', msg)
+        self.checker.write_fleet_outputs(
+            ['db1', 'db2'], [critical], [], [], [], host_errors)
+        with open(os.path.join(self.directory, 'db1.txt')) as f:
+            output = f.read()
+        self.assertTrue(output.startswith('CRIT'))
+        self.assertIn('s.t\tid', output)
+        self.assertNotIn('db1:', output)
+        with open(os.path.join(self.directory, 'db2.txt')) as f:
+            self.assertTrue(f.read().startswith('UNKNOWN'))
+
+
+def get_table_time(table, seconds, columns=1):
+    return dict(
+        hostname='db1', schema='s', table=table, partition=None,
+        columns=columns, estimated_cost=seconds * 100, seconds=seconds,
+        queue_wait=0.5, throttle_wait=0, connect_seconds=0.1, thread='w1')
+
+
+class MetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.checker = CheckMaxValue(args=['pdb_check_maxvalue.py'])
+        self.checker.merged_options = dict(
+            metrics_top=1,
+            metrics_file=os.path.join(self.directory, 'metrics.json'),
+            prometheus_file=os.path.join(self.directory, 'metrics.prom'))
+        self.checker.pool = ConnectionPool()
+        self.checker.metadata_times = dict(db1=0.25)
+        self.checker.makespan = dict(actual=3.0)
+        self.collector = ResultCollector()
+        self.collector.add(dict(table_time=get_table_time('t1', 1.0, 3)))
+        self.collector.add(dict(table_time=get_table_time('t2', 2.0)))
+        self.collector.add(dict(critical_column=dict(
+            schema='s', table='t1', column_name='id')))
+        self.collector.add(dict(done='w1', thread_stats=dict(
+            name='w1', busy=3.0, slots=1, elapsed=4.0)))
+        self.collector.add(dict(done='w2', thread_stats=dict(
+            name='w2', busy=2.0, slots=2, elapsed=2.0,
+            connections=2, connect_seconds=0.5)))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_metrics(self):
+        metrics = self.checker.get_metrics(self.collector, 100.0)
+        self.assertEqual(metrics['tables'], 2)
+        self.assertEqual(metrics['columns'], 4)
+        self.assertEqual(metrics['query_time'], 3.0)
+        self.assertEqual(metrics['max_query_time'], 2.0)
+        self.assertEqual(metrics['column_query_time'], 0.75)
+        self.assertEqual(metrics['queue_wait'], 1.0)
+        self.assertEqual(metrics['metadata_time'], 0.25)
+        self.assertEqual(metrics['connections'], 2)
+        self.assertEqual(metrics['connect_time'], 0.5)
+        self.assertEqual(
+            [t['utilization'] for t in metrics['threads']], [0.75, 0.5])
+        # busy over elapsed times slots of all workers
+        self.assertEqual(metrics['utilization'], 5.0 / 8)
+        self.assertEqual(metrics['critical'], 1)
+        self.assertEqual(
+            [t['table'] for t in metrics['slowest_tables']], ['t2'])
+
+    def test_perf_data(self):
+        metrics = self.checker.get_metrics(self.collector, 100.0)
+        response = Response(pynagios.CRITICAL, 'msg')
+        self.checker.set_perf_data(response, metrics)
+        output = str(response)
+        self.assertIn('max_query_time=2.000s', output)
+        self.assertIn('metadata_time=0.250s', output)
+        self.assertIn('tables=2', output)
+        self.assertIn('critical=1', output)
+        self.assertIn('utilization=62.5%', output)
+
+    def test_write_metrics(self):
+        metrics = self.checker.get_metrics(self.collector, 100.0)
+        self.checker.write_metrics(metrics)
+        with open(self.checker.merged_options['metrics_file']) as f:
+            written = json.load(f)
+        self.assertEqual(written['tables'], 2)
+        self.assertEqual(written['slowest_tables'][0]['table'], 't2')
+        with open(self.checker.merged_options['prometheus_file']) as f:
+            lines = f.read().splitlines()
+        self.assertIn('# TYPE int_overflow_check_tables gauge', lines)
+        self.assertIn('int_overflow_check_tables 2.0', lines)
+        self.assertIn(
+            'int_overflow_check_metadata_seconds{host="db1"} 0.25', lines)
+        self.assertIn(
+            'int_overflow_check_thread_utilization_ratio{thread="w1"} 0.75',
+            lines)
+        self.assertIn(
+            'int_overflow_check_columns{result="critical"} 1.0', lines)
+        self.assertIn(
+            'int_overflow_check_table_query_seconds'
+            '{host="db1",schema="s",table="t2"} 2.0', lines)
+        # the files are renamed into place
+        self.assertEqual(
+            sorted(os.listdir(self.directory)),
+            ['metrics.json', 'metrics.prom'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+import gzip
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+# Append module directory to path so we can import the dump scanner
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import dump_scanner
+
+DUMP = r"""-- MySQL dump 10.13
+USE `pdbtest_db1`;
+CREATE TABLE `tb1` (
+  `id` int(11) NOT NULL AUTO_INCREMENT,
+  `name` varchar(20) DEFAULT NULL,
+  `tinyintcol` tinyint(4) DEFAULT NULL,
+  `bigintcol` bigint(20) unsigned DEFAULT NULL,
+  PRIMARY KEY (`id`),
+  KEY `tinyintcol` (`tinyintcol`,`bigintcol`)
+) ENGINE=InnoDB AUTO_INCREMENT=4 DEFAULT CHARSET=utf8;
+INSERT INTO `tb1` VALUES (1,'a, (b) \'c',120,18446744073709551615),(2,NULL,-5,NULL);
+INSERT INTO `tb1` (`id`, `tinyintcol`) VALUES (3,7);
+"""
+
+
+class DumpScannerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, name, data):
+        filename = os.path.join(self.tmpdir, name)
+        if name.endswith('.gz'):
+            f = gzip.open(filename, 'wb')
+        else:
+            f = open(filename, 'wb')
+        with f:
+            f.write(data)
+        return filename
+
+    def test_iter_values(self):
+        self.assertEqual(
+            list(dump_scanner.iter_values(
+                "(1,'x,y',NULL),(2,'it''s (z)',-3);")),
+            [['1', "'x,y'", 'NULL'], ['2', "'it''s (z)'", '-3']])
+
+    def test_sql_dump(self):
+        filename = self.write('dump.sql.gz', DUMP)
+        tables = list(dump_scanner.scan_paths([filename]))
+        self.assertEqual(len(tables), 1)
+        self.assertEqual(tables[0]['schema'], 'pdbtest_db1')
+        self.assertEqual(tables[0]['row_count'], 3)
+        columns = dict(
+            (column['column_name'], column) for column in tables[0]['columns'])
+        self.assertEqual(sorted(columns), ['bigintcol', 'id', 'tinyintcol'])
+        self.assertEqual(columns['id']['max_value'], 3)
+        self.assertEqual(columns['id']['column_key'], 'PRI')
+        self.assertEqual(columns['tinyintcol']['max_value'], 120)
+        self.assertTrue(columns['tinyintcol']['index_leading'])
+        self.assertEqual(
+            columns['bigintcol']['max_value'], 18446744073709551615)
+        self.assertFalse(columns['bigintcol']['index_leading'])
+
+    def test_tab_directory(self):
+        self.write('tb2.sql', (
+            'CREATE TABLE `tb2` (\n'
+            '  `id` int(10) unsigned NOT NULL,\n'
+            '  `note` text,\n'
+            '  `qty` smallint(6) DEFAULT NULL,\n'
+            '  PRIMARY KEY (`id`)\n'
+            ') ENGINE=InnoDB;\n'))
+        # a newline in a value is escaped with a backslash
+        self.write('tb2.txt', '1\tline one\\\nline two\t5\n9\t\\N\t\\N\n')
+        tables = list(dump_scanner.scan_paths([self.tmpdir]))
+        self.assertEqual(len(tables), 1)
+        self.assertEqual(tables[0]['schema'], os.path.basename(self.tmpdir))
+        self.assertEqual(tables[0]['table'], 'tb2')
+        self.assertEqual(tables[0]['row_count'], 2)
+        self.assertEqual(
+            [(column['column_name'], column['max_value'])
+                for column in tables[0]['columns']],
+            [('id', 9), ('qty', 5)])
+
+
+if __name__ == '__main__':
+    unittest.main()
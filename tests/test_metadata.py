@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+# Append module directory to path so we can import the check module
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from pdb_check_maxvalue import CheckMaxValue, MetadataCache
+
+
+class FakeCursor(object):
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.rows = []
+
+    def execute(self, query, args=None):
+        if 'INFORMATION_SCHEMA.COLUMNS' in query:
+            self.rows = self.conn.columns
+        else:
+            self.rows = self.conn.tables
+
+    def fetchall(self):
+        return tuple(self.rows)
+
+    def close(self):
+        pass
+
+
+class FakeConnection(object):
+    """Returns the rows of the tables and the column checksums."""
+
+    def __init__(self):
+        self.tables = [
+            ('db1', 't1', '2020-01-01 00:00:00', 1000, 16384, 1001),
+            ('db1', 't2', '2020-01-01 00:00:00', 10, 16384, None)]
+        self.columns = [('db1', 't1', 2, 123456), ('db1', 't2', 1, 654321)]
+
+    def cursor(self):
+        return FakeCursor(self)
+
+
+class MetadataCacheTest(unittest.TestCase):
+
+    schema_tables = {'db1.t\xc3\xa9': dict(
+        schema='db1', table='t\xc3\xa9', row_count=10,
+        columns=[dict(column_name='id', column_type='int(11)')])}
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = MetadataCache(
+            os.path.join(self.directory, 'metadata.sqlite'), 60)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_hit(self):
+        self.cache.put('db1', 'abc', self.schema_tables)
+        cached = self.cache.get('db1', 'abc')
+        self.assertEqual(cached, self.schema_tables)
+        # the same types as the metadata read from MySQLdb
+        key, = cached.keys()
+        self.assertEqual(type(key), str)
+        self.assertEqual(type(cached[key]['table']), str)
+        self.assertEqual(type(cached[key]['columns'][0]['column_type']), str)
+
+    def test_miss(self):
+        self.assertEqual(self.cache.get('db1', 'abc'), None)
+        self.cache.put('db1', 'abc', self.schema_tables)
+        self.assertEqual(self.cache.get('db1', 'def'), None)
+        self.assertEqual(self.cache.get('db2', 'abc'), None)
+
+    def test_expiry(self):
+        self.cache.put('db1', 'abc', self.schema_tables)
+        conn = self.cache.connect()
+        try:
+            with conn:
+                conn.execute(
+                    'UPDATE schema_metadata SET timestamp = timestamp - 61')
+        finally:
+            conn.close()
+        self.assertEqual(self.cache.get('db1', 'abc'), None)
+
+
+class MetadataFingerprintTest(unittest.TestCase):
+
+    def setUp(self):
+        self.checker = CheckMaxValue(args=['pdb_check_maxvalue.py'])
+        self.merged_options = dict(
+            hostname='db1', port=3306, secondary_keys=False,
+            scan_all_columns=False)
+
+    def get_fingerprint(self, conn):
+        return self.checker.get_metadata_fingerprint(
+            conn, self.merged_options)
+
+    def test_table_stats(self):
+        conn = FakeConnection()
+        cache_key, fingerprint, table_stats = self.get_fingerprint(conn)
+        self.assertEqual(table_stats[('db1', 't1')], (1000, 16384, 1001))
+        # the table stats change on every run
+        conn.tables[0] = conn.tables[0][:3] + (2000, 32768, 2001)
+        self.assertEqual(
+            self.get_fingerprint(conn)[:2], (cache_key, fingerprint))
+
+    def test_rebuilt_table(self):
+        conn = FakeConnection()
+        fingerprint = self.get_fingerprint(conn)[1]
+        conn.tables[1] = ('db1', 't2', '2021-01-01 00:00:00', 10, 16384, None)
+        self.assertNotEqual(self.get_fingerprint(conn)[1], fingerprint)
+
+    def test_changed_columns(self):
+        conn = FakeConnection()
+        fingerprint = self.get_fingerprint(conn)[1]
+        # instant ADD COLUMN keeps CREATE_TIME
+        conn.columns[1] = ('db1', 't2', 2, 987654)
+        self.assertNotEqual(self.get_fingerprint(conn)[1], fingerprint)
+
+    def test_cache_key(self):
+        cache_key = self.get_fingerprint(FakeConnection())[0]
+        self.merged_options['secondary_keys'] = True
+        self.assertNotEqual(
+            self.get_fingerprint(FakeConnection())[0], cache_key)
+
+
+class MetadataQueryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.checker = CheckMaxValue(args=['pdb_check_maxvalue.py'])
+        self.merged_options = dict(
+            scan_all_columns=False, secondary_keys=False)
+
+    def get_query(self):
+        query, args = self.checker.get_metadata_query(self.merged_options)
+        # interpolated as MySQLdb does, one placeholder for each arg
+        sql = ' '.join(query.split()) % tuple("'%s'" % (a,) for a in args)
+        return sql, tuple(args)
+
+    def test_primary_keys(self):
+        sql, args = self.get_query()
+        self.assertIn("WHERE c.COLUMN_TYPE LIKE '%int%'", sql)
+        self.assertTrue(sql.endswith("AND c.COLUMN_KEY = 'PRI'"))
+        self.assertEqual(args, ())
+
+    def test_secondary_keys(self):
+        self.merged_options['secondary_keys'] = True
+        sql = self.get_query()[0]
+        self.assertTrue(
+            sql.endswith("AND (c.COLUMN_KEY = 'PRI' OR s.SEQ_IN_INDEX = 1)"))
+
+    def test_scan_all_columns(self):
+        self.merged_options['scan_all_columns'] = True
+        self.merged_options['secondary_keys'] = True
+        sql = self.get_query()[0]
+        self.assertTrue(sql.endswith("WHERE c.COLUMN_TYPE LIKE '%int%'"))
+        self.assertNotIn('COLUMN_KEY =', sql)
+
+    def test_filters(self):
+        self.merged_options.update(
+            use_dbs=['db1', 'db2'], ignore_dbs=['db3'],
+            exclude_columns={'db1.t1': ['id', 'a']})
+        query, args = self.checker.get_metadata_query(self.merged_options)
+        self.assertEqual(tuple(args), (
+            'db1', 'db2', 'db3', 'db1', 't1', 'id', 'db1', 't1', 'a'))
+        sql = self.get_query()[0]
+        self.assertIn(
+            "AND c.COLUMN_KEY = 'PRI' "
+            "AND c.TABLE_SCHEMA IN ('db1','db2') "
+            "AND c.TABLE_SCHEMA NOT IN ('db3') "
+            "AND (c.TABLE_SCHEMA, c.TABLE_NAME, c.COLUMN_NAME) NOT IN "
+            "(('db1','t1','id'),('db1','t1','a'))", sql)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+
+import os
+import Queue
+import re
+import sys
+import unittest
+
+# Append module directory to path so we can import the check module
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from pdb_check_maxvalue import (
+    CheckMaxValue, PartitionMerge, build_select_max, fetch_max_row,
+    get_highest_partition, get_range_column, process_max_row)
+
+
+def get_partitions(method, expression, rows):
+    return [
+        dict(
+            name=name, method=method, expression=expression, rows=count,
+            data_length=count * 100)
+        for name, count in zip(['p1', 'p2', 'pmax'], rows)]
+
+
+class FakeCursor(object):
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.rows = []
+
+    def execute(self, query, args=None):
+        self.conn.queries.append(query)
+        match = re.search(r'PARTITION \(`(\w+)`\)', query)
+        if match:
+            self.rows = [self.conn.partition_rows[match.group(1)]]
+        else:
+            self.rows = self.conn.rows
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def fetchall(self):
+        return tuple(self.rows)
+
+    def close(self):
+        pass
+
+
+class FakeConnection(object):
+    """Returns the max values of each partition, or rows."""
+
+    def __init__(self, partition_rows=None, rows=()):
+        self.partition_rows = partition_rows or {}
+        self.rows = list(rows)
+        self.queries = []
+
+    def cursor(self):
+        return FakeCursor(self)
+
+
+class SelectMaxTest(unittest.TestCase):
+
+    merged_options = dict(
+        hostname='db1', critical=90, warning=80, row_count_max_ratio=0)
+    columns = [
+        dict(column_name='id', column_type='tinyint(4)'),
+        dict(column_name='a', column_type='int(11)'),
+        dict(column_name='b', column_type='smallint(6)')]
+
+    def test_single_query(self):
+        query = build_select_max('s', 't', self.columns)
+        self.assertEqual(
+            ' '.join(query.split()),
+            'SELECT MAX(`id`), MAX(`a`), MAX(`b`) from `s`.`t`')
+
+    def test_columns_classified_from_one_row(self):
+        conn = FakeConnection(rows=[(127, 5, None)])
+        item = dict(schema='s', table='t', row_count=100, columns=self.columns)
+        row = fetch_max_row(
+            conn, item, build_select_max('s', 't', self.columns))
+        self.assertEqual(len(conn.queries), 1)
+        results = Queue.Queue()
+        process_max_row(self.merged_options, results, item, row)
+        result = results.get_nowait()
+        self.assertEqual(result['critical_column']['column_name'], 'id')
+        self.assertEqual(result['critical_column']['max_value'], 127)
+        # an empty column is not flagged
+        self.assertTrue(results.empty())
+
+
+class RangeColumnTest(unittest.TestCase):
+
+    def test_range_column(self):
+        self.assertEqual(
+            get_range_column(get_partitions('RANGE', '`id`', [1, 1, 0])),
+            'id')
+        self.assertEqual(
+            get_range_column(
+                get_partitions('RANGE COLUMNS', ' `created` ', [1, 1, 0])),
+            'created')
+
+    def test_no_range_column(self):
+        self.assertEqual(get_range_column(None), None)
+        self.assertEqual(get_range_column([]), None)
+        for method, expression in (
+                ('RANGE', 'year(`created`)'),
+                ('RANGE COLUMNS', '`a`,`b`'),
+                ('HASH', '`id`'),
+                ('RANGE', None)):
+            self.assertEqual(
+                get_range_column(get_partitions(method, expression, [1])),
+                None)
+
+    def test_highest_partition(self):
+        # the MAXVALUE partition is empty
+        partitions = get_partitions('RANGE', '`id`', [10, 5, 0])
+        self.assertEqual(get_highest_partition(partitions)['name'], 'p2')
+        partitions = get_partitions('RANGE', '`id`', [10, 0, 3])
+        self.assertEqual(get_highest_partition(partitions)['name'], 'pmax')
+        partitions = get_partitions('RANGE', '`id`', [0, 0, 0])
+        self.assertEqual(get_highest_partition(partitions)['name'], 'p1')
+
+
+class PartitionPruningTest(unittest.TestCase):
+
+    def setUp(self):
+        self.checker = CheckMaxValue(args=['pdb_check_maxvalue.py'])
+        self.merged_options = dict(
+            auto_increment_metadata=False, max_scan_size=None)
+
+    def get_schema_table(self, columns, rows=(10, 5, 0)):
+        return dict(
+            hostname='db1', schema='s', table='t', row_count=sum(rows),
+            data_length=sum(rows) * 100, auto_increment=None,
+            partitioned=True,
+            partitions=get_partitions('RANGE', '`id`', rows),
+            columns=[
+                dict(
+                    column_name=name, column_type='int(11)',
+                    auto_increment=False, index_leading=index_leading)
+                for name, index_leading in columns])
+
+    def get_work(self, schema_table):
+        schema_tables = self.checker.plan_schema_tables(
+            {'s.t': schema_table}, self.merged_options)
+        return self.checker.split_partitioned_tables(schema_tables.values())
+
+    def test_partition_search(self):
+        schema_table = self.get_schema_table([('id', True), ('a', True)])
+        work = self.get_work(schema_table)
+        self.assertEqual(schema_table['strategy'], 'index')
+        self.assertEqual(len(work), 2)
+        item = work[0]
+        self.assertEqual(
+            [column['column_name'] for column in item['columns']], ['id'])
+        self.assertEqual(item['partition_search'], ['pmax', 'p2', 'p1'])
+        # the cost of the highest partition with rows
+        self.assertEqual(item['estimated_rows'], 5)
+        self.assertEqual(
+            [column['column_name'] for column in work[1]['columns']], ['a'])
+        self.assertNotIn('partition_search', work[1])
+
+    def test_empty_maxvalue_partition(self):
+        conn = FakeConnection(dict(pmax=(None,), p2=(42,), p1=(7,)))
+        item = dict(
+            schema='s', table='t', columns=[dict(column_name='id')],
+            partition_search=['pmax', 'p2', 'p1'])
+        self.assertEqual(fetch_max_row(conn, item, 'unused'), (42,))
+        self.assertEqual(len(conn.queries), 2)
+        self.assertIn('PARTITION (`pmax`)', conn.queries[0])
+        self.assertIn('PARTITION (`p2`)', conn.queries[1])
+
+    def test_empty_table(self):
+        conn = FakeConnection(dict(pmax=(None,), p2=(None,), p1=(None,)))
+        item = dict(
+            schema='s', table='t', columns=[dict(column_name='id')],
+            partition_search=['pmax', 'p2', 'p1'])
+        self.assertEqual(fetch_max_row(conn, item, 'unused'), (None,))
+        self.assertEqual(len(conn.queries), 3)
+
+    def test_scan_per_partition(self):
+        schema_table = self.get_schema_table([('id', False), ('a', False)])
+        # id is the partitioning column, a needs a full table scan
+        work = self.get_work(schema_table)
+        self.assertEqual(len(work), 4)
+        self.assertEqual(
+            [item.get('partition') for item in work[1:]],
+            ['p1', 'p2', 'pmax'])
+        merges = set(id(item['partition_merge']) for item in work[1:])
+        self.assertEqual(len(merges), 1)
+        self.assertEqual(work[1]['partition_merge'].pending, 3)
+
+    def test_add_partitions(self):
+        schema_tables = {
+            's.t': self.get_schema_table([('id', False)]),
+            's.u': dict(schema='s', table='u', partitioned=False)}
+        del schema_tables['s.t']['partitions']
+        # the subpartitions of a partition are summed
+        conn = FakeConnection(rows=[
+            ('s', 't', 'p1', 'RANGE', '`id`', 3, 300),
+            ('s', 't', 'p1', 'RANGE', '`id`', 4, 400),
+            ('s', 't', 'pmax', 'RANGE', '`id`', 0, 0)])
+        self.checker.add_partitions(conn, schema_tables)
+        self.assertEqual(len(conn.queries), 1)
+        self.assertEqual(
+            [(p['name'], p['rows'], p['data_length'])
+                for p in schema_tables['s.t']['partitions']],
+            [('p1', 7, 700), ('pmax', 0, 0)])
+        self.assertNotIn('partitions', schema_tables['s.u'])
+
+
+class PartitionMergeTest(unittest.TestCase):
+
+    merged_options = dict(
+        hostname='db1', critical=90, warning=80, row_count_max_ratio=0)
+
+    def test_merge(self):
+        merge = PartitionMerge(3)
+        self.assertEqual(merge.add((5, None)), None)
+        self.assertEqual(merge.add((3, 8)), None)
+        # an empty partition
+        self.assertEqual(merge.add((None, None)), (5, 8))
+
+    def test_fail(self):
+        merge = PartitionMerge(2)
+        self.assertTrue(merge.fail())
+        self.assertFalse(merge.fail())
+        self.assertEqual(merge.add((5,)), None)
+        self.assertEqual(merge.add((6,)), None)
+
+    def test_classified_after_last_partition(self):
+        merge = PartitionMerge(2)
+        results = Queue.Queue()
+        columns = [dict(column_name='id', column_type='tinyint(4)')]
+        for partition, max_value in (('p1', 120), ('pmax', 10)):
+            process_max_row(
+                self.merged_options, results, dict(
+                    schema='s', table='t', row_count=127, columns=columns,
+                    partition=partition, partition_merge=merge),
+                (max_value,))
+            if partition == 'p1':
+                self.assertTrue(results.empty())
+        result = results.get_nowait()
+        self.assertEqual(result['critical_column']['max_value'], 120)
+        self.assertTrue(results.empty())
+
+
+if __name__ == '__main__':
+    unittest.main()
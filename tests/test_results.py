@@ -0,0 +1,358 @@
+#!/usr/bin/env python
+
+import json
+import os
+import Queue
+import sys
+import threading
+import unittest
+from StringIO import StringIO
+
+# Append module directory to path so we can import the check module
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import MySQLdb
+import pynagios
+
+import pdb_check_maxvalue
+from pdb_check_maxvalue import (
+    AsyncTableProcessor, CheckMaxValue, ResultCollector, ResultsWriter,
+    TableProcessor, WorkQueue)
+
+
+class FakeCursor(object):
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, query, args=None):
+        pass
+
+    def fetchall(self):
+        # the results table has a run_id column
+        return (('run_id',),)
+
+    def executemany(self, query, rows):
+        self.conn.batches.append(list(rows))
+        if len(self.conn.batches) == self.conn.fail_at:
+            raise MySQLdb.OperationalError(1213, 'Deadlock found')
+
+    def close(self):
+        pass
+
+
+class FakeConnection(object):
+    """Records the batches written, failing the fail_at-th one."""
+
+    def __init__(self, fail_at=None):
+        self.fail_at = fail_at
+        self.batches = []
+        self.committed = False
+        self.closed = False
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.committed = True
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class FakePool(object):
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def connect(self, connection_options):
+        return self.conn
+
+
+class ResultsWriterTest(unittest.TestCase):
+
+    def write(self, conn, count, background):
+        writer = ResultsWriter(
+            FakePool(conn), {}, batch_size=2, background=background)
+        for n in range(count):
+            writer.add('critical', dict(
+                hostname='db1', schema='s', table='t%d' % (n,),
+                column_name='id', max_value=n, overflow_percentage=95.0))
+        return writer
+
+    def close(self, writer):
+        """Returns the error raised by close(), which must return."""
+        errors = []
+
+        def close():
+            try:
+                writer.close()
+            except Exception, e:
+                errors.append(e)
+        thread = threading.Thread(target=close)
+        thread.daemon = True
+        thread.start()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        return errors[0] if errors else None
+
+    def test_batches(self):
+        for background in (False, True):
+            conn = FakeConnection()
+            self.assertEqual(self.close(self.write(conn, 3, background)), None)
+            self.assertEqual([len(rows) for rows in conn.batches], [2, 1])
+            self.assertTrue(conn.committed)
+            self.assertTrue(conn.closed)
+
+    def test_last_batch_fails(self):
+        conn = FakeConnection(fail_at=2)
+        error = self.close(self.write(conn, 3, True))
+        self.assertTrue(isinstance(error, MySQLdb.OperationalError))
+        self.assertFalse(conn.committed)
+        self.assertTrue(conn.closed)
+
+    def test_batch_fails_before_close(self):
+        conn = FakeConnection(fail_at=1)
+        writer = self.write(conn, 5, True)
+        error = self.close(writer)
+        self.assertTrue(isinstance(error, MySQLdb.OperationalError))
+        self.assertEqual(len(conn.batches), 1)
+
+
+class MaxCursor(object):
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.row = None
+
+    def execute(self, query, args=None):
+        with self.conn.lock:
+            self.conn.queries.append(' '.join(query.split()))
+        table = query.split('`.`')[1].split('`')[0]
+        self.row = self.conn.rows[table]
+        if self.conn.on_query:
+            self.conn.on_query(table)
+
+    def fetchone(self):
+        return self.row
+
+    def close(self):
+        pass
+
+
+class MaxConnection(object):
+    """Returns the max values of each table."""
+
+    def __init__(self, rows, on_query=None):
+        self.rows = rows
+        self.on_query = on_query
+        self.lock = threading.Lock()
+        self.queries = []
+
+    def cursor(self):
+        return MaxCursor(self)
+
+    def thread_id(self):
+        return 1
+
+    def close(self):
+        pass
+
+
+class MaxPool(object):
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def connect(self, connection_options, max_connections=None):
+        return self.conn
+
+
+def get_tables(rows):
+    """Returns the work items of tables with an int(11) id."""
+    return [
+        dict(
+            hostname='db1', schema='s', table=table, row_count=100,
+            priority=n, columns=[
+                dict(column_name='id', column_type='int(11)')])
+        for n, table in enumerate(sorted(rows))]
+
+
+class WorkersTest(unittest.TestCase):
+
+    merged_options = dict(
+        hostname='db1', critical=90, warning=80, row_count_max_ratio=0)
+    rows = dict(t1=(2 ** 31 - 1,), t2=(5,), t3=(7,), t4=(2 ** 31 - 100,))
+
+    def start_workers(self, conn, q, results, count):
+        threads = []
+        for n in range(count):
+            thread = TableProcessor(
+                schema_tables=q, merged_options=self.merged_options,
+                results=results, pool=MaxPool(conn))
+            thread.start()
+            threads.append(thread)
+        return threads
+
+    def test_results_are_collected_as_they_arrive(self):
+        conn = MaxConnection(self.rows)
+        q = WorkQueue()
+        for v in get_tables(self.rows):
+            q.put(v)
+        for n in range(2):
+            q.put(None)
+        # the workers block unless the results are consumed
+        results = Queue.Queue(1)
+        threads = self.start_workers(conn, q, results, 2)
+        collector = ResultCollector()
+        running = len(threads)
+        while running:
+            result = results.get(True, 5)
+            if 'done' in result:
+                running -= 1
+            collector.add(result)
+        for thread in threads:
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+        self.assertEqual(
+            sorted(col['table'] for col in collector.critical_columns),
+            ['t1', 't4'])
+        self.assertEqual(
+            sorted(t['table'] for t in collector.table_times),
+            ['t1', 't2', 't3', 't4'])
+        self.assertEqual(
+            sorted(stats['name'] for stats in collector.thread_stats),
+            sorted(thread.name for thread in threads))
+        self.assertEqual(collector.errors, [])
+        self.assertEqual(len(conn.queries), 4)
+
+    def test_stream(self):
+        stream = StringIO()
+        collector = ResultCollector(stream=stream)
+        conn = MaxConnection(self.rows)
+        q = WorkQueue()
+        for v in get_tables(dict(t1=self.rows['t1'], t2=self.rows['t2'])):
+            q.put(v)
+        q.put(None)
+        results = Queue.Queue()
+        self.start_workers(conn, q, results, 1)[0].join(5)
+        while not results.empty():
+            collector.add(results.get_nowait())
+        line, = stream.getvalue().splitlines()
+        col = json.loads(line)
+        self.assertEqual(col['reason'], 'critical')
+        self.assertEqual(
+            (col['schema'], col['table'], col['column_name']),
+            ('s', 't1', 'id'))
+        self.assertEqual(col['max_value'], 2 ** 31 - 1)
+
+    def test_stop_after_current_table(self):
+        q = WorkQueue()
+        for v in get_tables(self.rows):
+            q.put(v)
+        q.put(None)
+        results = Queue.Queue()
+        pool = MaxPool(None)
+        thread = TableProcessor(
+            schema_tables=q, merged_options=self.merged_options,
+            results=results, pool=pool)
+
+        def on_query(table):
+            # a critical column was found, the check stops the workers
+            thread.stop_event.set()
+        conn = pool.conn = MaxConnection(self.rows, on_query)
+        thread.start()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        results = list(results.queue)
+        self.assertEqual(len(conn.queries), 1)
+        self.assertEqual(
+            [r['critical_column']['table'] for r in results
+                if 'critical_column' in r], ['t1'])
+        self.assertIn('done', results[-1])
+        # the tables left are reported by the check
+        self.assertEqual(
+            [v['table'] for v in q.drain()], ['t2', 't3', 't4'])
+
+    def test_stopped_table_is_unchecked(self):
+        q = WorkQueue()
+        for v in get_tables(dict(t1=self.rows['t1'])):
+            q.put(v)
+        results = Queue.Queue()
+        thread = TableProcessor(
+            schema_tables=q, merged_options=self.merged_options,
+            results=results, pool=MaxPool(MaxConnection(self.rows)))
+        get = q.get
+
+        def stop_and_get():
+            # the check is stopped while the worker waits for a table
+            thread.stop_event.set()
+            return get()
+        q.get = stop_and_get
+        thread.start()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        results = list(results.queue)
+        self.assertEqual(
+            [(r['unchecked_column']['table'], r['unchecked_column']['reason'])
+                for r in results if 'unchecked_column' in r],
+            [('t1', 'stopped')])
+        self.assertFalse([r for r in results if 'table_time' in r])
+        self.assertIn('done', results[-1])
+
+
+class AsyncEngineTest(unittest.TestCase):
+
+    merged_options = dict(
+        hostname='db1', critical=90, warning=80, row_count_max_ratio=0,
+        async_queries=2, max_connections=1)
+    rows = dict(t1=(2 ** 31 - 1,), t2=(5,), t3=(7,))
+
+    @unittest.skipIf(
+        pdb_check_maxvalue.gevent is None, 'gevent is not installed')
+    def test_tables(self):
+        conn = MaxConnection(self.rows)
+        connect = pdb_check_maxvalue.pymysql.connect
+        pdb_check_maxvalue.pymysql.connect = lambda **kwargs: conn
+        try:
+            q = WorkQueue()
+            for v in get_tables(self.rows):
+                q.put(v)
+            q.put(None)
+            results = Queue.Queue()
+            thread = AsyncTableProcessor(
+                schema_tables=q, merged_options=self.merged_options,
+                results=results)
+            thread.start()
+            thread.join(10)
+        finally:
+            pdb_check_maxvalue.pymysql.connect = connect
+        self.assertFalse(thread.is_alive())
+        results = list(results.queue)
+        self.assertEqual(
+            [r['critical_column']['table'] for r in results
+                if 'critical_column' in r], ['t1'])
+        self.assertEqual(
+            len([r for r in results if 'table_time' in r]), 3)
+        done = results[-1]
+        self.assertIn('done', done)
+        self.assertEqual(done['thread_stats']['slots'], 2)
+        # max_connections connections are reused across tables
+        self.assertEqual(done['thread_stats']['connections'], 1)
+        self.assertEqual(len(conn.queries), 3)
+
+    @unittest.skipIf(
+        pdb_check_maxvalue.gevent is not None, 'gevent is installed')
+    def test_requires_gevent(self):
+        checker = CheckMaxValue(args=[
+            'pdb_check_maxvalue.py', '-H', 'db1', '--engine', 'async'])
+        response = checker.check()
+        self.assertEqual(response.status, pynagios.UNKNOWN)
+        self.assertIn('requires gevent and PyMySQL', response.message)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,503 @@
+#!/usr/bin/env python
+
+import os
+import Queue
+import sys
+import threading
+import time
+import unittest
+
+# Append module directory to path so we can import the check module
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import pynagios
+
+import pdb_check_maxvalue
+from pdb_check_maxvalue import (
+    CheckMaxValue, ConnectionPool, LoadController, ReplicaRouter, WorkQueue,
+    get_lpt_makespan)
+
+
+class LptMakespanTest(unittest.TestCase):
+
+    def test_makespan(self):
+        self.assertEqual(get_lpt_makespan([], 4), 0)
+        self.assertEqual(get_lpt_makespan([5, 3, 2], 1), 10)
+        # 7 | 5 2 | 4 3
+        self.assertEqual(get_lpt_makespan([2, 3, 4, 5, 7], 3), 7)
+        # one worker per cost, the longest one
+        self.assertEqual(get_lpt_makespan([1, 8, 2], 5), 8)
+
+    def test_no_workers(self):
+        self.assertEqual(get_lpt_makespan([1, 2], 0), 3)
+
+
+class ScheduleTest(unittest.TestCase):
+
+    def setUp(self):
+        self.checker = CheckMaxValue(args=['pdb_check_maxvalue.py'])
+        self.merged_options = dict(warning=80)
+
+    def get_schema_tables(self, costs):
+        return dict(
+            ('db.%s' % (table,), dict(
+                schema='db', table=table, estimated_cost=cost,
+                columns=[dict(column_name='id', column_type='int(11)')]))
+            for table, cost in costs.iteritems())
+
+    def get_order(self, schema_tables, column_states=None, results=None):
+        scheduled = self.checker.schedule_schema_tables(
+            schema_tables, column_states or {}, {}, self.merged_options,
+            results)
+        return [
+            v['table'] for v in sorted(
+                scheduled.itervalues(), key=lambda v: v['priority'])]
+
+    def test_longest_first(self):
+        schema_tables = self.get_schema_tables(dict(a=10, b=300, c=20))
+        self.assertEqual(self.get_order(schema_tables), ['b', 'c', 'a'])
+
+    def test_urgent_first(self):
+        schema_tables = self.get_schema_tables(dict(a=10, b=300))
+        # over the warning threshold, due now
+        column_states = {'db.a.id': dict(
+            overflow_percentage=90, timestamp=0)}
+        self.assertEqual(
+            self.get_order(schema_tables, column_states), ['a', 'b'])
+
+    def test_old_columns_first(self):
+        self.merged_options['state_rescan_interval'] = 3600
+        schema_tables = self.get_schema_tables(dict(a=10, b=300, c=20))
+        now = time.time()
+        # not growing, a was scanned over the rescan interval ago
+        column_states = dict(
+            ('db.%s.id' % (table,), dict(
+                overflow_percentage=10, timestamp=now - age))
+            for table, age in (('a', 7200), ('b', 60), ('c', 3700)))
+        self.assertEqual(
+            self.get_order(schema_tables, column_states), ['a', 'c', 'b'])
+
+    def test_budget(self):
+        self.merged_options['budget'] = 2
+        schema_tables = self.get_schema_tables(dict(a=10, b=300, c=20))
+        results = Queue.Queue()
+        self.assertEqual(
+            self.get_order(schema_tables, results=results), ['b', 'c'])
+        result = results.get_nowait()
+        self.assertEqual(result['unchecked_column']['table'], 'a')
+        self.assertEqual(result['unchecked_column']['reason'], 'budget')
+        self.assertTrue(results.empty())
+
+    def test_budget_requires_state_file(self):
+        checker = CheckMaxValue(args=[
+            'pdb_check_maxvalue.py', '-H', 'db1', '--budget', '10'])
+        response = checker.check()
+        self.assertEqual(response.status, pynagios.UNKNOWN)
+        self.assertIn('budget requires state_file', response.message)
+
+
+class ExplainCursor(object):
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.description = (('type',), ('rows',))
+
+    def execute(self, query, args=None):
+        self.conn.queries.append(' '.join(query.split()))
+
+    def fetchall(self):
+        return (('ALL', 1000),)
+
+    def close(self):
+        pass
+
+
+class ExplainConnection(object):
+    """Returns the EXPLAIN of a full table scan."""
+
+    def __init__(self):
+        self.queries = []
+
+    def cursor(self):
+        return ExplainCursor(self)
+
+    def close(self):
+        pass
+
+
+class ExplainPool(object):
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def connect(self, connection_options):
+        return self.conn
+
+
+class PlanTest(unittest.TestCase):
+
+    def setUp(self):
+        self.checker = CheckMaxValue(args=['pdb_check_maxvalue.py'])
+        self.checker.fleet = False
+        self.merged_options = dict(
+            hostname='db1', auto_increment_metadata=False,
+            max_scan_size=None)
+
+    def get_schema_tables(self, index_leading):
+        return {'s.t': dict(
+            hostname='db1', schema='s', table='t', row_count=1000,
+            data_length=10 * 1024 * 1024, auto_increment=None,
+            columns=[
+                dict(
+                    column_name=name, column_type='int(11)',
+                    auto_increment=False, index_leading=leading)
+                for name, leading in zip(['id', 'a'], index_leading)])}
+
+    def plan(self, schema_tables):
+        return self.checker.plan_schema_tables(
+            schema_tables, self.merged_options)['s.t']
+
+    def test_index_lookups(self):
+        v = self.plan(self.get_schema_tables([True, True]))
+        self.assertEqual(v['strategy'], 'index')
+        self.assertEqual(v['estimated_rows'], 2)
+
+    def test_full_table_scan(self):
+        v = self.plan(self.get_schema_tables([True, False]))
+        self.assertEqual(v['strategy'], 'scan')
+        self.assertEqual(
+            [column['strategy'] for column in v['columns']],
+            ['index', 'scan'])
+        self.assertEqual(v['estimated_rows'], 1000)
+        self.assertEqual(v['estimated_cost'], 10 * 1024 * 1024)
+
+    def test_max_scan_size(self):
+        self.merged_options['max_scan_size'] = 5
+        schema_tables = self.get_schema_tables([True, False])
+        v = self.plan(schema_tables)
+        self.assertEqual(v['strategy'], 'index')
+        skipped = self.checker.get_skipped_columns(schema_tables)
+        self.assertEqual([column['column_name'] for column in skipped], ['a'])
+
+    def test_dry_run(self):
+        conn = ExplainConnection()
+        self.checker.pool = ExplainPool(conn)
+        schema_tables = self.get_schema_tables([True, False])
+        self.plan(schema_tables)
+        response = self.checker.explain_plan(
+            [(self.merged_options, schema_tables)])
+        self.assertEqual(response.status, pynagios.OK)
+        self.assertIn(
+            'Dry run: 1 tables, estimated rows examined: 1000',
+            response.message)
+        self.assertIn(
+            's.t\tscan\testimated_rows=1000\tid(index),a(scan)',
+            response.message)
+        self.assertIn('EXPLAIN: type=ALL rows=1000', response.message)
+        self.assertEqual(
+            conn.queries, ['EXPLAIN SELECT MAX(`id`), MAX(`a`) from `s`.`t`'])
+
+
+class HostLimitsTest(unittest.TestCase):
+
+    def put(self, q, hostname, table, priority):
+        q.put(dict(hostname=hostname, table=table, priority=priority))
+
+    def test_saturated_host_is_skipped(self):
+        q = WorkQueue(host_limits=dict(h1=2, h2=2))
+        # the tables of h1 are all more expensive than the tables of h2
+        for n in range(4):
+            self.put(q, 'h1', 'a%d' % (n,), -100 + n)
+            self.put(q, 'h2', 'b%d' % (n,), -10 + n)
+        q.put(None)
+        running = [q.get() for n in range(4)]
+        self.assertEqual(
+            [v['table'] for v in running], ['a0', 'a1', 'b0', 'b1'])
+        self.assertRaises(Queue.Empty, q.get_nowait)
+        q.release(running[2])
+        self.assertEqual(q.get()['table'], 'b2')
+        q.release(running[0])
+        self.assertEqual(q.get()['table'], 'a2')
+
+    def test_sentinel_waits_for_held_tables(self):
+        q = WorkQueue(host_limits=dict(h1=1))
+        self.put(q, 'h1', 'a0', 0)
+        self.put(q, 'h1', 'a1', 1)
+        q.put(None)
+        first = q.get()
+        # a1 is held back, the worker must not stop
+        self.assertRaises(Queue.Empty, q.get_nowait)
+        q.release(first)
+        self.assertEqual(q.get()['table'], 'a1')
+        self.assertEqual(q.get(), None)
+
+    def test_drain(self):
+        q = WorkQueue(host_limits=dict(h1=1))
+        self.put(q, 'h1', 'a0', 0)
+        self.put(q, 'h1', 'a1', 1)
+        self.put(q, 'h2', 'b0', 0)
+        q.put(None)
+        q.get()
+        self.assertEqual(
+            sorted(v['table'] for v in q.drain()), ['a1', 'b0'])
+        self.assertEqual(q.get(), None)
+
+    def test_throttled_host_is_skipped(self):
+        controller = LoadController()
+        controller.servers['db1'] = dict(
+            merged_options=dict(hostname='h1'), allowed=1)
+        q = WorkQueue(host_limits=dict(h1=2, h2=2), controller=controller)
+        for n in range(3):
+            self.put(q, 'h1', 'a%d' % (n,), n)
+            self.put(q, 'h2', 'b%d' % (n,), 10 + n)
+        q.put(None)
+        # h1 is allowed one query by the controller
+        self.assertEqual(
+            [q.get()['table'] for n in range(3)], ['a0', 'b0', 'b1'])
+        self.assertRaises(Queue.Empty, q.get_nowait)
+        # a waiting worker is woken up when the limit grows
+        got = []
+        thread = threading.Thread(target=lambda: got.append(q.get()))
+        thread.start()
+        with controller.lock:
+            controller.servers['db1']['allowed'] = 2
+        for listener in controller.listeners:
+            listener()
+        thread.join(5)
+        self.assertEqual(got[0]['table'], 'a1')
+
+
+class FakeCursor(object):
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.description = ()
+
+    def execute(self, query, args=None):
+        with self.conn.lock:
+            self.conn.running += 1
+            self.conn.max_running = max(
+                self.conn.max_running, self.conn.running)
+        time.sleep(0.05)
+        with self.conn.lock:
+            self.conn.running -= 1
+
+    def fetchall(self):
+        return (('Threads_running', '2'),)
+
+    def fetchone(self):
+        return None
+
+    def close(self):
+        pass
+
+
+class FakeConnection(object):
+    """Records how many queries run at once."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.running = 0
+        self.max_running = 0
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def close(self):
+        pass
+
+
+class LoadControllerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = FakeConnection()
+        self.connect = pdb_check_maxvalue.MySQLdb.connect
+        pdb_check_maxvalue.MySQLdb.connect = lambda **kwargs: self.conn
+
+    def tearDown(self):
+        pdb_check_maxvalue.MySQLdb.connect = self.connect
+
+    def test_one_sample_at_a_time(self):
+        controller = LoadController()
+        merged_options = dict(
+            hostname='h1', threads=4, max_threads_running=10,
+            max_replica_lag=60)
+        server = controller.get_server(dict(host='h1'), merged_options)
+        self.assertEqual(server['allowed'], 4)
+        self.assertEqual(controller.get_host_limit('h1'), 4)
+        self.assertEqual(controller.get_host_limit('h2'), None)
+        # the controller thread and a worker sample the same server
+        threads = [
+            threading.Thread(target=controller.sample, args=(server,))
+            for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.conn.max_running, 1)
+
+
+class ReplicaCursor(object):
+
+    def __init__(self, server):
+        self.server = server
+        self.description = ()
+        self.rows = []
+
+    def execute(self, query, args=None):
+        if 'STATUS LIKE' in query:
+            self.rows = [
+                ('Threads_running', str(self.server['threads_running']))]
+        elif self.server['replica']:
+            self.description = (('Seconds_Behind_Source',),)
+            self.rows = [(self.server['lag'],)]
+        else:
+            self.rows = []
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def close(self):
+        pass
+
+
+class ReplicaConnection(object):
+
+    def __init__(self, server):
+        self.server = server
+
+    def cursor(self):
+        return ReplicaCursor(self.server)
+
+    def close(self):
+        pass
+
+
+class ReplicaRouterTest(unittest.TestCase):
+
+    servers = dict(
+        r1=dict(replica=True, lag=5, threads_running=3),
+        r2=dict(replica=True, lag=120, threads_running=1),
+        r3=dict(replica=False, threads_running=1))
+
+    def setUp(self):
+        self.checker = CheckMaxValue(args=['pdb_check_maxvalue.py'])
+        self.connects = []
+        self.connect = pdb_check_maxvalue.MySQLdb.connect
+        pdb_check_maxvalue.MySQLdb.connect = self.connect_server
+
+    def tearDown(self):
+        pdb_check_maxvalue.MySQLdb.connect = self.connect
+
+    def connect_server(self, **kwargs):
+        self.connects.append(kwargs)
+        if kwargs['host'] not in self.servers:
+            raise pdb_check_maxvalue.MySQLdb.OperationalError(
+                2003, "Can't connect to MySQL server")
+        return ReplicaConnection(self.servers[kwargs['host']])
+
+    def get_router(self, replicas):
+        return self.checker.get_replica_router(dict(
+            hostname='db1', replicas=replicas, max_replica_lag=60))
+
+    def test_least_loaded(self):
+        r1 = dict(host='r1')
+        r2 = dict(host='r2')
+        router = ReplicaRouter(dict(host='db1'), [(r1, 2), (r2, 0)])
+        self.assertEqual(
+            [router.acquire() for n in range(3)], [r2, r2, r1])
+        router.release(r1)
+        router.release(r1)
+        self.assertEqual(router.acquire(), r1)
+
+    def test_lagging_replicas_are_not_used(self):
+        router = self.get_router(['r1', 'r2:3307', 'r3', 'r4'])
+        self.assertEqual(
+            [c['host'] for c in self.connects], ['r1', 'r2', 'r3', 'r4'])
+        self.assertEqual(self.connects[1]['port'], 3307)
+        # r1 is the only usable replica, this probe is not counted
+        self.assertEqual(router.replicas, [[2, dict(host='r1')]])
+        self.assertEqual(router.acquire(), dict(host='r1'))
+
+    def test_primary_fallback(self):
+        router = self.get_router(['r2', 'r3'])
+        self.assertEqual(router.replicas, [])
+        self.assertEqual(router.acquire(), dict(host='db1'))
+        self.assertEqual(self.get_router(None), None)
+
+
+class PoolConnection(object):
+
+    def __init__(self):
+        self.broken = False
+        self.rollbacks = 0
+        self.closed = False
+
+    def ping(self):
+        if self.broken:
+            raise pdb_check_maxvalue.MySQLdb.OperationalError(
+                2006, 'MySQL server has gone away')
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = True
+
+
+class ConnectionPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.conns = []
+        self.connect = pdb_check_maxvalue.MySQLdb.connect
+        pdb_check_maxvalue.MySQLdb.connect = self.new_connection
+
+    def tearDown(self):
+        pdb_check_maxvalue.MySQLdb.connect = self.connect
+
+    def new_connection(self, **kwargs):
+        conn = PoolConnection()
+        self.conns.append(conn)
+        return conn
+
+    def test_reuse(self):
+        pool = ConnectionPool()
+        conn = pool.connect(dict(host='db1'))
+        conn.close()
+        pool.connect(dict(host='db1')).close()
+        self.assertEqual(len(self.conns), 1)
+        self.assertEqual(pool.connections, 1)
+        # each table starts a new transaction
+        self.assertEqual(self.conns[0].rollbacks, 2)
+        # another server gets its own connection
+        pool.connect(dict(host='db2')).close()
+        self.assertEqual(len(self.conns), 2)
+
+    def test_reconnect(self):
+        pool = ConnectionPool()
+        pool.connect(dict(host='db1')).close()
+        self.conns[0].broken = True
+        pool.connect(dict(host='db1')).close()
+        self.assertEqual(len(self.conns), 2)
+        self.assertTrue(self.conns[0].closed)
+
+    def test_max_connections(self):
+        pool = ConnectionPool(max_connections=1)
+        conn = pool.connect(dict(host='db1'))
+        connected = threading.Event()
+
+        def connect():
+            pool.connect(dict(host='db1')).close()
+            connected.set()
+        thread = threading.Thread(target=connect)
+        thread.start()
+        # the second worker waits for the connection of the first
+        self.assertFalse(connected.wait(0.2))
+        conn.close()
+        self.assertTrue(connected.wait(5))
+        thread.join()
+        self.assertEqual(len(self.conns), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+# Append module directory to path so we can import the check module
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import pynagios
+
+from pdb_check_maxvalue import (
+    CheckMaxValue, Error, filter_shard, get_shard_index, parse_shard)
+
+
+class ShardTest(unittest.TestCase):
+
+    def test_parse_shard(self):
+        self.assertEqual(parse_shard('1/4'), (1, 4))
+        self.assertEqual(parse_shard('4/4'), (4, 4))
+        for shard in ('0/4', '5/4', '1', '1/a', ''):
+            self.assertRaises(Error, parse_shard, shard)
+
+    def test_stable_index(self):
+        # the same on every machine and in every process
+        self.assertEqual(get_shard_index('db1.t1', 4), 4)
+        self.assertEqual(get_shard_index('db1.t2', 4), 1)
+        self.assertEqual(get_shard_index('db2.orders', 4), 2)
+        self.assertEqual(get_shard_index('db1.t1', 1), 1)
+        self.assertEqual(
+            get_shard_index(u'db1.t\xe9', 4),
+            get_shard_index('db1.t\xc3\xa9', 4))
+
+    def test_each_table_in_one_shard(self):
+        schema_tables = dict(
+            ('db%d.t%d' % (n % 3, n), dict(table='t%d' % (n,)))
+            for n in range(200))
+        shards = [filter_shard(schema_tables, (i, 4)) for i in range(1, 5)]
+        self.assertEqual(
+            sorted(key for shard in shards for key in shard),
+            sorted(schema_tables))
+        for shard in shards:
+            self.assertTrue(shard)
+
+
+class MergeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def column(self, table, max_value):
+        return dict(
+            hostname='db1', schema='s', table=table, column_name='id',
+            column_type='int(11)', max_value=max_value,
+            overflow_percentage=max_value * 100.0 / (2 ** 31 - 1))
+
+    def write(self, name, index, count, critical=(), unchecked=(),
+              finished=None):
+        """Writes a shard file as a shard run does."""
+        filename = os.path.join(self.directory, name)
+        checker = CheckMaxValue(args=['pdb_check_maxvalue.py'])
+        checker.merged_options = dict(
+            shard=(index, count), shard_file=filename)
+        checker.fleet = False
+        checker.flagged_columns = dict(
+            critical=list(critical), warning=[], investigate=[],
+            unchecked=list(unchecked))
+        checker.write_shard_file(
+            pynagios.CRITICAL if critical else pynagios.OK,
+            dict(started=0, run_time=2.0 * index, tables=10, columns=20),
+            [], [])
+        if finished is not None:
+            with open(filename) as f:
+                shard = json.load(f)
+            shard['finished'] = finished
+            with open(filename, 'w') as f:
+                json.dump(shard, f)
+        return filename
+
+    def merge(self, *filenames):
+        checker = CheckMaxValue(args=['merge'] + list(filenames))
+        return checker.check()
+
+    def test_merge(self):
+        critical = self.column('t1', 2 ** 31 - 1)
+        unchecked = dict(self.column('t3', 0), reason='deadline')
+        response = self.merge(
+            self.write('1.json', 1, 2, critical=[critical]),
+            self.write('2.json', 2, 2, unchecked=[unchecked]))
+        self.assertEqual(response.status, pynagios.CRITICAL)
+        self.assertIn('s.t1\tid\tint(11)\t2147483647', response.message)
+        self.assertIn('s.t3\tid\tint(11)\tdeadline', response.message)
+        output = str(response)
+        self.assertIn('shards=2', output)
+        self.assertIn('tables=20', output)
+        self.assertIn('run_time=4.000s', output)
+        self.assertIn('unchecked=1', output)
+
+    def test_missing_shard(self):
+        response = self.merge(
+            self.write('1.json', 1, 3), self.write('3.json', 3, 3))
+        self.assertEqual(response.status, pynagios.UNKNOWN)
+        self.assertIn('No result file for shards 2 of 3.', response.message)
+
+    def test_latest_file_of_a_shard(self):
+        critical = self.column('t1', 2 ** 31 - 1)
+        response = self.merge(
+            self.write('1-old.json', 1, 1, critical=[critical], finished=1),
+            self.write('1-new.json', 1, 1, finished=2))
+        self.assertEqual(response.status, pynagios.OK)
+
+    def test_different_shard_counts(self):
+        response = self.merge(
+            self.write('1.json', 1, 2), self.write('2.json', 2, 3))
+        self.assertEqual(response.status, pynagios.UNKNOWN)
+        self.assertIn('different shard counts', response.message)
+
+    def test_no_files(self):
+        response = self.merge()
+        self.assertEqual(response.status, pynagios.UNKNOWN)
+        self.assertIn('merge requires the result files', response.message)
+
+
+if __name__ == '__main__':
+    unittest.main()
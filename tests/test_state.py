@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+# Append module directory to path so we can import the check module
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from pdb_check_maxvalue import StateStore, WorkQueue
+
+
+class WorkQueueTest(unittest.TestCase):
+
+    def test_priority_order(self):
+        q = WorkQueue()
+        for table, priority in (('a', 2), ('b', 1), ('c', 2), ('d', 0)):
+            q.put(dict(table=table, priority=priority))
+        self.assertEqual(
+            [q.get()['table'] for n in range(4)], ['d', 'b', 'a', 'c'])
+
+    def test_sentinel_last(self):
+        q = WorkQueue()
+        q.put(None)
+        q.put(dict(table='a', priority=5))
+        q.put(None)
+        q.put(dict(table='b'))
+        first = q.get()
+        self.assertEqual(first['table'], 'b')
+        self.assertIn('queued', first)
+        self.assertEqual(q.get()['table'], 'a')
+        self.assertEqual(q.get(), None)
+        self.assertEqual(q.get(), None)
+        self.assertTrue(q.empty())
+
+
+class StateStoreTest(unittest.TestCase):
+
+    merged_options = dict(
+        warning=80, state_headroom=50, state_rescan_interval=86400,
+        state_row_growth=10)
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'state.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def save(self, *columns):
+        store = StateStore(self.filename)
+        try:
+            store.save_column_states([
+                dict(
+                    hostname='db1', schema='s', table='t', column_name=name,
+                    max_value=max_value, overflow_percentage=percentage,
+                    row_count=1000)
+                for name, max_value, percentage in columns])
+        finally:
+            store.close()
+
+    def get_schema_tables(self, row_count=1000):
+        return {'s.t': dict(
+            row_count=row_count,
+            columns=[dict(column_name='low'), dict(column_name='high')])}
+
+    def get_due_columns(self, column_states, row_count=1000):
+        store = StateStore(self.filename)
+        try:
+            due = store.get_due_schema_tables(
+                self.get_schema_tables(row_count), column_states, {},
+                self.merged_options)
+        finally:
+            store.close()
+        return [
+            column['column_name']
+            for column in due.get('s.t', {}).get('columns', [])]
+
+    def test_resume(self):
+        self.save(('low', 10, 1.0), ('high', 2 ** 63, 75.0))
+        store = StateStore(self.filename)
+        try:
+            column_states = store.get_column_states('db1')
+            self.assertEqual(store.get_column_states('db2'), {})
+        finally:
+            store.close()
+        self.assertEqual(
+            sorted(column_states), ['s.t.high', 's.t.low'])
+        # max values are stored as text, bigger than SQLite integers
+        self.assertEqual(column_states['s.t.high']['max_value'], 2 ** 63)
+        self.assertEqual(column_states['s.t.low']['row_count'], 1000)
+
+    def test_skip_columns_below_headroom(self):
+        self.save(('low', 10, 1.0), ('high', 2 ** 31, 75.0))
+        store = StateStore(self.filename)
+        try:
+            column_states = store.get_column_states('db1')
+        finally:
+            store.close()
+        self.assertEqual(self.get_due_columns(column_states), ['high'])
+        self.assertEqual(self.get_due_columns({}), ['low', 'high'])
+
+    def test_rescan(self):
+        self.save(('low', 10, 1.0))
+        store = StateStore(self.filename)
+        try:
+            column_states = store.get_column_states('db1')
+        finally:
+            store.close()
+        # the row count of the table grew
+        self.assertEqual(
+            self.get_due_columns(column_states, row_count=2000),
+            ['low', 'high'])
+        # the column was scanned too long ago
+        column_states['s.t.low']['timestamp'] = time.time() - 2 * 86400
+        self.assertEqual(self.get_due_columns(column_states), ['low', 'high'])
+
+    def test_projected_growth(self):
+        store = StateStore(self.filename)
+        try:
+            now = time.time()
+            # 10% per hour, reaches 80% in less than a day
+            store.conn.executemany("""
+                INSERT INTO column_history (
+                    hostname, schema_name, table_name, column_name,
+                    overflow_percentage, timestamp)
+                VALUES ('db1', 's', 't', 'low', ?, ?)
+                """, [(20.0, now - 3600), (30.0, now)])
+            growth_rates = store.get_growth_rates('db1')
+            self.assertAlmostEqual(growth_rates['s.t.low'], 10.0 / 3600)
+            column_states = {'s.t.low': dict(
+                max_value=10, overflow_percentage=30.0, row_count=1000,
+                timestamp=now)}
+            due = store.get_due_schema_tables(
+                self.get_schema_tables(), column_states, growth_rates,
+                self.merged_options)
+        finally:
+            store.close()
+        self.assertEqual(
+            [column['column_name'] for column in due['s.t']['columns']],
+            ['low', 'high'])
+
+    def test_growth_rate_fit(self):
+        store = StateStore(self.filename)
+        try:
+            now = time.time()
+            points = [(now - 7200, 10.0), (now - 3600, 13.0), (now, 14.0)]
+            rows = [('id', p, t) for t, p in points]
+            # a single sample, and samples at the same time
+            rows.append(('single', 10.0, now))
+            rows.extend([('same', 10.0, now), ('same', 20.0, now)])
+            store.conn.executemany("""
+                INSERT INTO column_history (
+                    hostname, schema_name, table_name, column_name,
+                    overflow_percentage, timestamp)
+                VALUES ('db1', 's', 't', ?, ?, ?)
+                """, rows)
+            growth_rates = store.get_growth_rates('db1')
+        finally:
+            store.close()
+        # least squares: 2% per hour
+        self.assertEqual(growth_rates.keys(), ['s.t.id'])
+        self.assertAlmostEqual(growth_rates['s.t.id'] * 3600, 2.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+
+import os
+import Queue
+import sys
+import unittest
+
+# Append module directory to path so we can import the check module
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import MySQLdb
+
+from pdb_check_maxvalue import (
+    STREAM_BATCH_SIZE, CheckMaxValue, MetadataStreamer)
+
+
+def get_metadata_row(schema, table, column, partitioned=False):
+    return (
+        schema, table, column, 'int(11)', 10, 'PRI', 1, None, '', 1000,
+        'partitioned' if partitioned else '')
+
+
+class FakeCursor(object):
+    """A server-side cursor, rows are read while they are iterated."""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.rows = []
+
+    def execute(self, query, args=None):
+        self.conn.queries.append(query)
+        if 'INFORMATION_SCHEMA.PARTITIONS' in query:
+            self.rows = self.conn.partition_rows
+        else:
+            self.rows = self.conn.rows
+
+    def __iter__(self):
+        for n, row in enumerate(self.rows):
+            if n == self.conn.fail_at:
+                raise MySQLdb.OperationalError(2013, 'Lost connection')
+            self.conn.read += 1
+            yield row
+
+    def fetchall(self):
+        return tuple(self.rows)
+
+    def close(self):
+        pass
+
+
+class FakeConnection(object):
+    """Returns the metadata rows of a host."""
+
+    def __init__(self, rows, partition_rows=(), fail_at=None):
+        self.rows = list(rows)
+        self.partition_rows = list(partition_rows)
+        self.fail_at = fail_at
+        self.queries = []
+        self.read = 0
+        self.closed = False
+
+    def cursor(self, cursorclass=None):
+        return FakeCursor(self)
+
+    def thread_id(self):
+        return 1
+
+    def close(self):
+        self.closed = True
+
+
+class FakePool(object):
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def connect(self, connection_options):
+        return self.conn
+
+
+class StreamingTest(unittest.TestCase):
+
+    merged_options = dict(
+        hostname='db1', scan_all_columns=True, secondary_keys=False,
+        auto_increment_metadata=False, max_scan_size=None, critical=90,
+        warning=80, row_count_max_ratio=0)
+
+    def setUp(self):
+        self.checker = CheckMaxValue(args=['pdb_check_maxvalue.py'])
+        self.checker.metadata_cache = None
+        self.checker.watchdog = None
+        self.checker.metadata_times = {}
+
+    def get_rows(self, count):
+        rows = []
+        for n in range(count):
+            rows.append(get_metadata_row('s', 't%03d' % (n,), 'id'))
+            rows.append(get_metadata_row('s', 't%03d' % (n,), 'a'))
+        return rows
+
+    def test_batches(self):
+        conn = FakeConnection(self.get_rows(250))
+        self.checker.pool = FakePool(conn)
+        batches = self.checker.iter_schema_tables(self.merged_options)
+        first = next(batches)
+        self.assertEqual(len(first), STREAM_BATCH_SIZE)
+        # a table is complete when the next one starts
+        self.assertEqual(len(first['s.t000']['columns']), 2)
+        self.assertEqual(conn.read, 2 * STREAM_BATCH_SIZE + 1)
+        self.assertEqual(
+            [len(batch) for batch in batches], [STREAM_BATCH_SIZE, 50])
+        self.assertTrue(conn.closed)
+
+    def test_partitioned_tables_last(self):
+        rows = [
+            get_metadata_row('s', 'p', 'id', partitioned=True),
+            get_metadata_row('s', 'p', 'a', partitioned=True),
+            get_metadata_row('s', 't', 'id')]
+        conn = FakeConnection(
+            rows, [('s', 'p', 'p1', 'RANGE', '`id`', 10, 1000)])
+        self.checker.pool = FakePool(conn)
+        batches = list(self.checker.iter_schema_tables(self.merged_options))
+        self.assertEqual([sorted(batch) for batch in batches],
+                         [['s.t'], ['s.p']])
+        partitioned = batches[1]['s.p']
+        self.assertEqual(len(partitioned['columns']), 2)
+        self.assertEqual(partitioned['partitions'][0]['name'], 'p1')
+
+    def stream(self, conn, targets=None, workers=2):
+        self.checker.pool = FakePool(conn)
+        q = Queue.Queue()
+        streamer = MetadataStreamer(
+            checker=self.checker,
+            targets=targets or [self.merged_options],
+            schema_tables=q,
+            results=Queue.Queue(),
+            workers=workers,
+            threads=1)
+        streamer.run()
+        items = []
+        while not q.empty():
+            items.append(q.get_nowait())
+        return streamer, items
+
+    def test_streamer(self):
+        streamer, items = self.stream(FakeConnection(self.get_rows(150)))
+        self.assertEqual(len(items), 152)
+        # a sentinel for each worker, after the tables
+        self.assertEqual(items[-2:], [None, None])
+        self.assertEqual(len(streamer.costs), 150)
+        self.assertEqual(streamer.errors, [])
+        self.assertEqual(streamer.error, None)
+        self.assertIn('db1', self.checker.metadata_times)
+
+    def test_host_error(self):
+        streamer, items = self.stream(
+            FakeConnection(self.get_rows(150), fail_at=250))
+        # the first batch is queued before the error
+        self.assertEqual(len(items), STREAM_BATCH_SIZE + 2)
+        self.assertEqual(items[-2:], [None, None])
+        (options, error), = streamer.errors
+        self.assertEqual(options['hostname'], 'db1')
+        self.assertTrue(isinstance(error, MySQLdb.OperationalError))
+
+    def test_streamer_error(self):
+        class Targets(object):
+            def __iter__(self):
+                raise ValueError('broken')
+        streamer, items = self.stream(FakeConnection([]), targets=Targets())
+        self.assertTrue(isinstance(streamer.error, ValueError))
+        # the workers still stop
+        self.assertEqual(items, [None, None])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import threading
+import time
+import unittest
+
+# Append module directory to path so we can import the check module
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import pdb_check_maxvalue
+from pdb_check_maxvalue import QueryWatchdog
+
+
+class FakeCursor(object):
+
+    def __init__(self, queries):
+        self.queries = queries
+
+    def execute(self, query, args=None):
+        self.queries.append(query)
+
+    def close(self):
+        pass
+
+
+class FakeConnection(object):
+
+    def __init__(self, queries):
+        self.queries = queries
+
+    def cursor(self):
+        return FakeCursor(self.queries)
+
+    def close(self):
+        pass
+
+
+class QueryWatchdogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.queries = []
+        self.connects = []
+        self.connected = threading.Event()
+        self.connect = pdb_check_maxvalue.MySQLdb.connect
+        pdb_check_maxvalue.MySQLdb.connect = self.slow_connect
+        self.watchdog = QueryWatchdog(query_timeout=0.05)
+        self.watchdog.start()
+
+    def tearDown(self):
+        self.watchdog.stop_event.set()
+        self.watchdog.join()
+        pdb_check_maxvalue.MySQLdb.connect = self.connect
+
+    def slow_connect(self, **kwargs):
+        """Connects to a struggling server."""
+        self.connects.append(kwargs)
+        self.connected.wait(5)
+        return FakeConnection(self.queries)
+
+    def test_kill(self):
+        self.connected.set()
+        token = self.watchdog.register(dict(host='db1'), 7)
+        time.sleep(0.3)
+        self.assertEqual(self.watchdog.unregister(token), 'query timeout')
+        self.assertEqual(self.queries, ['KILL QUERY 7'])
+        self.assertEqual(
+            self.connects, [dict(host='db1', connect_timeout=5)])
+
+    def test_kill_does_not_block(self):
+        token = self.watchdog.register(dict(host='db1'), 7)
+        time.sleep(0.3)
+        # the watchdog is connecting to kill the query
+        started = time.time()
+        other = self.watchdog.register(dict(host='db1'), 8, timeout=False)
+        self.assertEqual(self.watchdog.unregister(other), None)
+        self.assertTrue(time.time() - started < 0.1)
+        self.assertEqual(self.queries, [])
+        self.connected.set()
+        # the killed query waits for the kill
+        self.assertEqual(self.watchdog.unregister(token), 'query timeout')
+        self.assertEqual(self.queries, ['KILL QUERY 7'])
+
+    def test_expire_all(self):
+        self.connected.set()
+        self.watchdog.expire_all('fail fast')
+        token = self.watchdog.register(dict(host='db1'), 7, timeout=False)
+        time.sleep(0.3)
+        self.assertEqual(self.watchdog.unregister(token), 'fail fast')
+
+
+if __name__ == '__main__':
+    unittest.main()